@@ -2,6 +2,7 @@ from encoder.params_model import model_embedding_size as speaker_embedding_size
 from utils.argutils import print_args
 from synthesizer.inference import Synthesizer
 from encoder import inference as encoder
+from encoder.embedding_cache import EmbeddingCache
 from vocoder import inference as vocoder
 from pathlib import Path
 import numpy as np
@@ -30,6 +31,9 @@ if __name__ == '__main__':
         "overhead but allows to save some GPU memory for lower-end GPUs.")
     parser.add_argument("--no_sound", action="store_true", help=\
         "If True, audio won't be played.")
+    parser.add_argument("--cache_dir", type=Path, default=None, help=\
+        "Directory in which to cache the embeddings of the reference voices across runs. If "
+        "left out, they are only cached in memory.")
     args = parser.parse_args()
     print_args(args, parser)
     if not args.no_sound:
@@ -61,6 +65,7 @@ if __name__ == '__main__':
     encoder.load_model(args.enc_model_fpath)
     synthesizer = Synthesizer(args.syn_model_dir.joinpath("taco_pretrained"), low_mem=args.low_mem)
     vocoder.load_model(args.voc_model_fpath)
+    embedding_cache = EmbeddingCache(cache_dir=args.cache_dir)
     
     
     ## Run a test
@@ -128,17 +133,22 @@ if __name__ == '__main__':
             
             # The following two methods are equivalent:
             # - Directly load from the filepath:
-            preprocessed_wav = encoder.preprocess_wav(in_fpath)
+            #     preprocessed_wav = encoder.preprocess_wav(in_fpath)
             # - If the wav is already loaded:
+            #     preprocessed_wav = encoder.preprocess_wav(original_wav, sampling_rate)
             original_wav, sampling_rate = librosa.load(in_fpath)
-            preprocessed_wav = encoder.preprocess_wav(original_wav, sampling_rate)
             print("Loaded file succesfully")
             
             # Then we derive the embedding. There are many functions and parameters that the 
             # speaker encoder interfaces. These are mostly for in-depth research. You will typically
             # only use this function (with its default parameters):
-            embed = encoder.embed_utterance(preprocessed_wav)
-            print("Created the embedding")
+            #     embed = encoder.embed_utterance(preprocessed_wav)
+            # Reference voices are often reused, so we go through an embedding cache instead. It 
+            # performs both steps above, but returns the embedding directly when it has already 
+            # seen this audio with the same encoder:
+            embed = embedding_cache.embed_utterance(original_wav, sampling_rate)
+            print("Created the embedding (cache hits: %d, misses: %d)" % 
+                  (embedding_cache.hits, embedding_cache.misses))
             
             
             ## Generating the spectrogram
@@ -2,10 +2,13 @@ from scipy.ndimage.morphology import binary_dilation
 from encoder.params_data import *
 from pathlib import Path
 from typing import Optional, Union
+from utils import logmmse, spectrogram
 import numpy as np
-import webrtcvad
 import librosa
-import struct
+try:
+    import webrtcvad
+except ImportError:
+    webrtcvad = None
 
 int16_max = (2 ** 15) - 1
 
@@ -40,27 +43,43 @@ def preprocess_wav(fpath_or_wav: Union[str, Path, np.ndarray],
     return wav
 
 
+def mel_engine():
+    return spectrogram.get_engine(
+        sampling_rate,
+        n_fft=int(sampling_rate * mel_window_length / 1000),
+        hop_length=int(sampling_rate * mel_window_step / 1000),
+        n_mels=mel_n_channels,
+        power=2.
+    )
+
+
 def wav_to_mel_spectrogram(wav):
     """
     Derives a mel spectrogram ready to be used by the encoder from a preprocessed audio waveform.
     Note: this not a log-mel spectrogram.
     """
-    frames = librosa.feature.melspectrogram(
-        wav,
-        sampling_rate,
-        n_fft=int(sampling_rate * mel_window_length / 1000),
-        hop_length=int(sampling_rate * mel_window_step / 1000),
-        n_mels=mel_n_channels
-    )
-    return frames.astype(np.float32).T
+    return mel_engine().mel(wav).T
+
+
+def wavs_to_mel_spectrograms(wavs):
+    """
+    Same as wav_to_mel_spectrogram() for several waveforms at once, which is faster than 
+    calling it on each waveform.
+    
+    :param wavs: a list of preprocessed waveforms as numpy arrays of floats
+    :return: a list of mel spectrograms as numpy arrays of float32 of shape (n_frames, 
+    mel_n_channels)
+    """
+    return [frames.T for frames in mel_engine().mels(wavs)]
 
 
-def trim_long_silences(wav):
+def trim_long_silences(wav, backend=vad_backend):
     """
     Ensures that segments without voice in the waveform remain no longer than a 
     threshold determined by the VAD parameters in params.py.
 
     :param wav: the raw waveform as a numpy array of floats 
+    :param backend: the voice activation detection backend, see detect_voice()
     :return: the same waveform with silences trimmed away (length <= original wav length)
     """
     # Compute the voice detection window size
@@ -69,17 +88,8 @@ def trim_long_silences(wav):
     # Trim the end of the audio to have a multiple of the window size
     wav = wav[:len(wav) - (len(wav) % samples_per_window)]
     
-    # Convert the float waveform to 16-bit mono PCM
-    pcm_wave = struct.pack("%dh" % len(wav), *(np.round(wav * int16_max)).astype(np.int16))
-    
     # Perform voice activation detection
-    voice_flags = []
-    vad = webrtcvad.Vad(mode=3)
-    for window_start in range(0, len(wav), samples_per_window):
-        window_end = window_start + samples_per_window
-        voice_flags.append(vad.is_speech(pcm_wave[window_start * 2:window_end * 2],
-                                         sample_rate=sampling_rate))
-    voice_flags = np.array(voice_flags)
+    voice_flags = detect_voice(wav, samples_per_window, backend)
     
     # Smooth the voice detection with a moving average
     def moving_average(array, width):
@@ -89,7 +99,7 @@ def trim_long_silences(wav):
         return ret[width - 1:] / width
     
     audio_mask = moving_average(voice_flags, vad_moving_average_width)
-    audio_mask = np.round(audio_mask).astype(np.bool)
+    audio_mask = np.round(audio_mask).astype(bool)
     
     # Dilate the voiced regions
     audio_mask = binary_dilation(audio_mask, np.ones(vad_max_silence_length + 1))
@@ -98,6 +108,44 @@ def trim_long_silences(wav):
     return wav[audio_mask == True]
 
 
+def detect_voice(wav, samples_per_window, backend=vad_backend, webrtc_vad=None):
+    """
+    Flags the windows of a waveform that contain voice.
+    
+    :param wav: the waveform as a numpy array of floats, of a length multiple of 
+    <samples_per_window>
+    :param samples_per_window: the size of the windows. With the "webrtc" backend, this must 
+    correspond to 10, 20 or 30 milliseconds.
+    :param backend: either "webrtc" to use webrtcvad or "energy" to use the vectorized 
+    spectral VAD of utils/logmmse.py. The latter does not require webrtcvad, but it is slower 
+    and agrees with webrtc on about 93% of the windows.
+    :param webrtc_vad: with the "webrtc" backend, a webrtcvad.Vad instance to use. Its state 
+    adapts to the audio, so reuse the same instance when processing a waveform in chunks. If 
+    None, a new instance is created.
+    :return: the voice flags as a numpy array of bools of shape (len(wav) // samples_per_window,)
+    """
+    if backend == "webrtc":
+        if webrtcvad is None:
+            raise ImportError("webrtcvad is not installed. Install it or set vad_backend to "
+                              "\"energy\" in params_data.py.")
+        
+        # Convert the float waveform to 16-bit mono PCM, and split the buffer in windows 
+        # without copying it
+        pcm_wave = memoryview(np.round(wav * int16_max).astype(np.int16).tobytes())
+        bytes_per_window = samples_per_window * 2
+        if webrtc_vad is None:
+            webrtc_vad = webrtcvad.Vad(mode=3)
+        is_speech = webrtc_vad.is_speech
+        voice_flags = [is_speech(pcm_wave[i:i + bytes_per_window], sampling_rate) 
+                       for i in range(0, len(pcm_wave), bytes_per_window)]
+        return np.array(voice_flags, dtype=bool)
+    
+    if backend == "energy":
+        return logmmse.vad(wav, samples_per_window)
+    
+    raise ValueError("Unknown VAD backend: %s" % backend)
+
+
 def normalize_volume(wav, target_dBFS, increase_only=False, decrease_only=False):
     if increase_only and decrease_only:
         raise ValueError("Both increase only and decrease only are set")
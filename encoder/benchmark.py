@@ -0,0 +1,325 @@
+from encoder.params_model import model_embedding_size
+from encoder.params_data import *
+from encoder import inference as encoder
+from encoder.model import SpeakerEncoder, equal_error_rate
+from encoder import audio
+from pathlib import Path
+from time import perf_counter as timer
+from typing import List
+import numpy as np
+import librosa
+import torch
+
+
+def synthetic_wav(duration=10, snr=20, seed=0):
+    """
+    Generates a crude speech-like waveform to benchmark on when no audio is provided: harmonic 
+    bursts of random pitch and length separated by pauses, with white noise added.
+    
+    :param duration: the approximate duration of the waveform in seconds
+    :param snr: the signal to noise ratio in dB
+    :param seed: the random seed
+    :return: the waveform as a numpy array of floats, at the sampling rate of the encoder
+    """
+    rng = np.random.RandomState(seed)
+    segments = []
+    while sum(map(len, segments)) < duration * sampling_rate:
+        t = np.arange(int(rng.uniform(0.3, 1.2) * sampling_rate)) / sampling_rate
+        f0 = rng.uniform(100, 220)
+        burst = sum(np.sin(2 * np.pi * f0 * k * t + rng.uniform(0, 2 * np.pi)) / k 
+                    for k in range(1, 15))
+        burst *= 1 + 0.5 * np.sin(2 * np.pi * 4 * t)
+        segments.append(0.1 * burst / np.abs(burst).max())
+        segments.append(np.zeros(int(rng.uniform(0.2, 1.0) * sampling_rate)))
+    wav = np.concatenate(segments)
+    
+    power = np.mean(wav[wav != 0] ** 2)
+    wav += rng.normal(0, np.sqrt(power / 10 ** (snr / 10)), len(wav))
+    return wav.astype(np.float32)
+
+
+def load_wavs(fpaths: List[Path], n_synthetic=8):
+    """
+    Loads and resamples the audio files to benchmark on. If there are none, synthetic 
+    waveforms are generated instead.
+    """
+    if len(fpaths) == 0:
+        return [synthetic_wav(seed=i) for i in range(n_synthetic)]
+    
+    wavs = []
+    for fpath in fpaths:
+        wav, _ = librosa.load(str(fpath), sr=sampling_rate)
+        wavs.append(audio.normalize_volume(wav, audio_norm_target_dBFS, increase_only=True))
+    return wavs
+
+
+def benchmark_vad(wavs: List[np.ndarray], n_repeats=5, backends=("webrtc", "energy")):
+    """
+    Times the voice activation detection backends of encoder.audio on the same waveforms, and 
+    measures how often their decisions agree with the ones of the first backend.
+    
+    :param wavs: the waveforms to benchmark on, at the sampling rate of the encoder
+    :param n_repeats: the number of times each backend is run on all waveforms
+    :param backends: the names of the backends to compare, see encoder.audio.detect_voice()
+    :return: a dictionary mapping each backend to its results
+    """
+    samples_per_window = (vad_window_length * sampling_rate) // 1000
+    wavs = [wav[:len(wav) - (len(wav) % samples_per_window)] for wav in wavs]
+    total_duration = sum(map(len, wavs)) / sampling_rate
+    
+    results = {}
+    reference_flags = None
+    for backend in backends:
+        try:
+            audio.detect_voice(wavs[0], samples_per_window, backend)
+        except ImportError as e:
+            print("Skipping the %s backend: %s" % (backend, e))
+            continue
+        
+        start = timer()
+        for _ in range(n_repeats):
+            flags = [audio.detect_voice(wav, samples_per_window, backend) for wav in wavs]
+        duration = (timer() - start) / n_repeats
+        flags = np.concatenate(flags)
+        
+        if reference_flags is None:
+            reference_flags = flags
+        results[backend] = {
+            "seconds": duration,
+            "realtime_factor": total_duration / duration,
+            "voiced_ratio": np.mean(flags),
+            "agreement": np.mean(flags == reference_flags),
+        }
+    
+    print("VAD on %d utterances (%.1f seconds of audio), agreement relative to %s:" % 
+          (len(wavs), total_duration, next(iter(results), None)))
+    for backend, result in results.items():
+        print("    %-8s %8.2fms   %8.0fx realtime   voiced: %5.1f%%   agreement: %5.1f%%" % 
+              (backend, result["seconds"] * 1000, result["realtime_factor"], 
+               result["voiced_ratio"] * 100, result["agreement"] * 100))
+    print("")
+    
+    return results
+
+
+def benchmark_inference(weights_fpath: Path, wavs: List[np.ndarray], n_repeats=5, device="cpu",
+                        variants=("fp32", "jit", "int8", "int8+jit")):
+    """
+    Compares the inference variants of encoder.load_model(): the load time, the throughput in 
+    partial embeddings per second, and the cosine similarity of the utterance embeddings with 
+    the ones of the plain fp32 model.
+    
+    :param weights_fpath: the path to saved model weights
+    :param wavs: the waveforms to benchmark on, at the sampling rate of the encoder. They are 
+    preprocessed before the benchmark.
+    :param n_repeats: the number of times all partial utterances are embedded
+    :param device: the device to run the model on. Quantized variants only run on the CPU.
+    :param variants: the names of the variants, as combinations of "fp32", "jit" and "int8" 
+    joined by "+"
+    :return: a dictionary mapping each variant to its results
+    """
+    wavs = [audio.preprocess_wav(wav) for wav in wavs]
+    splits = encoder._split_partials(wavs)
+    frames = np.concatenate([frames_batch for frames_batch, _ in splits])
+    boundaries = np.cumsum([len(frames_batch) for frames_batch, _ in splits])[:-1]
+    
+    results = {}
+    reference_embeds = None
+    for variant in variants:
+        options = variant.split("+")
+        start = timer()
+        encoder.load_model(weights_fpath, device, jit="jit" in options, 
+                           quantize="int8" in options)
+        load_duration = timer() - start
+        
+        # Warm up once, then time
+        encoder.embed_frames_batch(frames[:inference_batch_size])
+        start = timer()
+        for _ in range(n_repeats):
+            partial_embeds = np.concatenate([
+                encoder.embed_frames_batch(frames[i:i + inference_batch_size])
+                for i in range(0, len(frames), inference_batch_size)
+            ])
+        duration = (timer() - start) / n_repeats
+        
+        raw_embeds = np.array([np.mean(p, axis=0) for p in np.split(partial_embeds, boundaries)])
+        embeds = raw_embeds / np.linalg.norm(raw_embeds, 2, axis=1, keepdims=True)
+        if reference_embeds is None:
+            reference_embeds = embeds
+        results[variant] = {
+            "load_seconds": load_duration,
+            "embeds_per_second": len(frames) / duration,
+            "min_similarity": np.min(np.sum(embeds * reference_embeds, axis=1)),
+        }
+    
+    print("Encoder inference on %d partial utterances (batches of %d) on %s, similarity "
+          "relative to %s:" % (len(frames), inference_batch_size, device, variants[0]))
+    for variant, result in results.items():
+        print("    %-9s load: %6.2fs   %8.1f embeddings/s   min similarity: %.5f" % 
+              (variant, result["load_seconds"], result["embeds_per_second"], 
+               result["min_similarity"]))
+    print("")
+    
+    return results
+
+
+def similarity_matrix_loop(model: SpeakerEncoder, embeds):
+    """
+    The former implementation of SpeakerEncoder.similarity_matrix(), with a python loop over 
+    the speakers, kept as a reference for benchmark_loss().
+    """
+    speakers_per_batch, utterances_per_speaker = embeds.shape[:2]
+    
+    centroids_incl = torch.mean(embeds, dim=1, keepdim=True)
+    centroids_incl = centroids_incl.clone() / torch.norm(centroids_incl, dim=2, keepdim=True)
+    centroids_excl = (torch.sum(embeds, dim=1, keepdim=True) - embeds)
+    centroids_excl /= (utterances_per_speaker - 1)
+    centroids_excl = centroids_excl.clone() / torch.norm(centroids_excl, dim=2, keepdim=True)
+    
+    sim_matrix = torch.zeros(speakers_per_batch, utterances_per_speaker,
+                             speakers_per_batch).to(embeds.device)
+    mask_matrix = 1 - np.eye(speakers_per_batch, dtype=int)
+    for j in range(speakers_per_batch):
+        mask = np.where(mask_matrix[j])[0]
+        sim_matrix[mask, :, j] = (embeds[mask] * centroids_incl[j]).sum(dim=2)
+        sim_matrix[j, :, j] = (embeds[j] * centroids_excl[j]).sum(dim=1)
+    
+    return sim_matrix * model.similarity_weight + model.similarity_bias
+
+
+def benchmark_loss(shapes=((64, 10), (128, 10), (256, 10)), n_repeats=5, device="cpu"):
+    """
+    Compares the vectorized similarity matrix of SpeakerEncoder with the former loop 
+    implementation: the time of the forward and backward passes of the GE2E loss, and the 
+    largest difference between their similarity matrices and between their gradients.
+    
+    :param shapes: the (speakers_per_batch, utterances_per_speaker) shapes to benchmark on
+    :param n_repeats: the number of times each implementation is run per shape
+    :param device: the device on which to compute the loss
+    :return: a dictionary mapping each shape to its results
+    """
+    device = torch.device(device)
+    model = SpeakerEncoder(device, device)
+    
+    def sync():
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+    
+    def run(similarity_fn, embeds):
+        embeds = embeds.clone().requires_grad_()
+        sim_matrix = similarity_fn(embeds)
+        target = torch.arange(len(embeds), device=device).repeat_interleave(embeds.shape[1])
+        loss = model.loss_fn(sim_matrix.reshape(-1, len(embeds)), target)
+        loss.backward()
+        return sim_matrix.detach(), embeds.grad
+    
+    results = {}
+    for speakers_per_batch, utterances_per_speaker in shapes:
+        embeds = torch.randn(speakers_per_batch, utterances_per_speaker, model_embedding_size, 
+                             device=device)
+        embeds = embeds / torch.norm(embeds, dim=2, keepdim=True)
+        
+        durations = []
+        outputs = []
+        for similarity_fn in [lambda e: similarity_matrix_loop(model, e), 
+                              model.similarity_matrix]:
+            outputs.append(run(similarity_fn, embeds))
+            sync()
+            start = timer()
+            for _ in range(n_repeats):
+                run(similarity_fn, embeds)
+            sync()
+            durations.append((timer() - start) / n_repeats)
+        
+        (loop_sim, loop_grad), (sim, grad) = outputs
+        results[(speakers_per_batch, utterances_per_speaker)] = {
+            "loop_seconds": durations[0],
+            "vectorized_seconds": durations[1],
+            "max_sim_diff": torch.max(torch.abs(sim - loop_sim)).item(),
+            "max_grad_diff": torch.max(torch.abs(grad - loop_grad)).item(),
+        }
+    
+    print("GE2E loss forward and backward on %s:" % device)
+    for (n_speakers, n_utterances), result in results.items():
+        print("    %3dx%-3d loop: %8.2fms   vectorized: %8.2fms   max difference: %.1e "
+              "(similarity), %.1e (gradient)" % 
+              (n_speakers, n_utterances, result["loop_seconds"] * 1000, 
+               result["vectorized_seconds"] * 1000, result["max_sim_diff"], 
+               result["max_grad_diff"]))
+    print("")
+    
+    return results
+
+
+def equal_error_rate_sklearn(sim_matrix: np.ndarray):
+    """
+    The former computation of the EER in SpeakerEncoder.loss(), with sklearn and scipy, kept as 
+    a reference for benchmark_eer().
+    
+    :param sim_matrix: the similarity matrix as a numpy array of shape 
+    (speakers_per_batch * utterances_per_speaker, speakers_per_batch)
+    """
+    from scipy.interpolate import interp1d
+    from sklearn.metrics import roc_curve
+    from scipy.optimize import brentq
+    
+    speakers_per_batch = sim_matrix.shape[1]
+    utterances_per_speaker = len(sim_matrix) // speakers_per_batch
+    ground_truth = np.repeat(np.arange(speakers_per_batch), utterances_per_speaker)
+    inv_argmax = lambda i: np.eye(1, speakers_per_batch, i, dtype=int)[0]
+    labels = np.array([inv_argmax(i) for i in ground_truth])
+    fpr, tpr, thresholds = roc_curve(labels.flatten(), sim_matrix.flatten())
+    return brentq(lambda x: 1. - x - interp1d(fpr, tpr)(x), 0., 1.)
+
+
+def benchmark_eer(shapes=((64, 10), (128, 10), (256, 10)), n_repeats=5, device="cpu"):
+    """
+    Compares the sort-based EER of SpeakerEncoder.loss() with the former sklearn implementation, 
+    on similarity matrices of random embeddings: the time per batch and the largest difference 
+    between the two EERs.
+    
+    :param shapes: the (speakers_per_batch, utterances_per_speaker) shapes to benchmark on
+    :param n_repeats: the number of times each implementation is run per shape
+    :param device: the device on which to compute the EER
+    :return: a dictionary mapping each shape to its results
+    """
+    device = torch.device(device)
+    model = SpeakerEncoder(device, device)
+    
+    results = {}
+    for speakers_per_batch, utterances_per_speaker in shapes:
+        # Embeddings clustered around one random direction per speaker
+        centers = torch.randn(speakers_per_batch, 1, model_embedding_size, device=device)
+        embeds = centers + 4 * torch.randn(speakers_per_batch, utterances_per_speaker, 
+                                           model_embedding_size, device=device)
+        embeds = embeds / torch.norm(embeds, dim=2, keepdim=True)
+        with torch.no_grad():
+            sim_matrix = model.similarity_matrix(embeds)
+            sim_matrix = sim_matrix.reshape(-1, speakers_per_batch)
+        labels = torch.eye(speakers_per_batch, dtype=torch.bool, device=device)
+        labels = labels.repeat_interleave(utterances_per_speaker, dim=0).flatten()
+        
+        eers, durations = [], []
+        for eer_fn in [lambda: equal_error_rate_sklearn(sim_matrix.cpu().numpy()), 
+                       lambda: equal_error_rate(sim_matrix.flatten(), labels).item()]:
+            start = timer()
+            for _ in range(n_repeats):
+                eer = eer_fn()
+            durations.append((timer() - start) / n_repeats)
+            eers.append(eer)
+        
+        results[(speakers_per_batch, utterances_per_speaker)] = {
+            "sklearn_seconds": durations[0],
+            "torch_seconds": durations[1],
+            "eer": eers[1],
+            "eer_diff": abs(eers[0] - eers[1]),
+        }
+    
+    print("EER on %s:" % device)
+    for (n_speakers, n_utterances), result in results.items():
+        print("    %3dx%-3d sklearn: %8.2fms   torch: %8.2fms   EER: %.4f   difference: %.1e" % 
+              (n_speakers, n_utterances, result["sklearn_seconds"] * 1000, 
+               result["torch_seconds"] * 1000, result["eer"], result["eer_diff"]))
+    print("")
+    
+    return results
@@ -0,0 +1,105 @@
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+import threading
+import uuid
+
+
+class PackedFrames:
+    """
+    The mel spectrograms of all utterances of a speaker, concatenated in a single array saved as 
+    <speaker_dir>/_packed.<id>.npy, where <id> is unique to each packing. The index 
+    <speaker_dir>/_packed.txt names this file on its first line, followed by one 
+    "frames_fname,offset,length" line per utterance, where frames_fname is the name of the 
+    original .npy file of the utterance, as listed in _sources.txt. The frames are packed in the 
+    type they were stored in (float32 or float16, see utils.mel_storage) and read as such.
+    
+    The array is memory-mapped, so that reading a partial utterance only reads its frames from 
+    the disk. Memory maps are shared between the speakers of a process and the least recently 
+    used ones are closed beyond <max_open_files>, to stay under the limit of open file 
+    descriptors.
+    """
+    data_fname_format = "_packed.%s.npy"
+    index_fname = "_packed.txt"
+    max_open_files = 256
+    _open_files = OrderedDict()
+    _open_files_lock = threading.Lock()
+    
+    def __init__(self, speaker_dir: Path):
+        with speaker_dir.joinpath(self.index_fname).open("r") as index_file:
+            self.fpath = speaker_dir.joinpath(index_file.readline().rstrip())
+            index = [line.rstrip().split(",") for line in index_file]
+        self.index = {fname: (int(offset), int(length)) for fname, offset, length in index}
+    
+    @classmethod
+    def exists(cls, speaker_dir: Path):
+        return speaker_dir.joinpath(cls.index_fname).exists()
+    
+    def _data(self):
+        key = str(self.fpath)
+        with self._open_files_lock:
+            data = self._open_files.get(key)
+            if data is None:
+                data = np.load(self.fpath, mmap_mode="r")
+                self._open_files[key] = data
+                while len(self._open_files) > self.max_open_files:
+                    self._open_files.popitem(last=False)
+            else:
+                self._open_files.move_to_end(key)
+        return data
+    
+    def read(self, offset, start, end):
+        """
+        Reads frames [start, end) of the utterance that starts at <offset> in the packed array.
+        """
+        return np.array(self._data()[offset + start:offset + end])
+    
+    @classmethod
+    def pack(cls, speaker_dir: Path, frames_fnames, get_frames):
+        """
+        Writes the packed array and its index for a speaker. The array is written to a new file 
+        and the index, which names it, replaces the previous one atomically once the array is 
+        complete: an interrupted packing leaves the previous index and array in use. The arrays of 
+        the previous packings are deleted afterwards.
+        
+        :param speaker_dir: the directory of the speaker
+        :param frames_fnames: the names of the .npy files of the utterances to pack
+        :param get_frames: a function returning the frames of an utterance given its file name, 
+        as stored
+        :return: the total number of frames packed
+        """
+        all_frames = [get_frames(fname) for fname in frames_fnames]
+        lengths = [len(frames) for frames in all_frames]
+        offsets = np.cumsum([0] + lengths[:-1])
+        n_channels = all_frames[0].shape[1] if all_frames else 0
+        dtype = np.result_type(*{frames.dtype for frames in all_frames}, np.float16)
+        
+        # Write the array to a new file and the index to a temporary file
+        data_fname = cls.data_fname_format % uuid.uuid4().hex[:8]
+        data_fpath = speaker_dir.joinpath(data_fname)
+        index_fpath = speaker_dir.joinpath(cls.index_fname)
+        tmp_index_fpath = speaker_dir.joinpath("_packed.tmp.txt")
+        data = np.lib.format.open_memmap(data_fpath, mode="w+", dtype=dtype, 
+                                         shape=(sum(lengths), n_channels))
+        for frames, offset, length in zip(all_frames, offsets, lengths):
+            data[offset:offset + length] = frames
+        data.flush()
+        del data
+        with tmp_index_fpath.open("w") as index_file:
+            index_file.write(data_fname + "\n")
+            for fname, offset, length in zip(frames_fnames, offsets, lengths):
+                index_file.write("%s,%d,%d\n" % (fname, offset, length))
+        
+        # Switch to the new array by replacing the index, then delete the previous arrays and those 
+        # of interrupted packings
+        tmp_index_fpath.replace(index_fpath)
+        for fpath in speaker_dir.glob(cls.data_fname_format % "*"):
+            if fpath.name != data_fname:
+                with cls._open_files_lock:
+                    cls._open_files.pop(str(fpath), None)
+                try:
+                    fpath.unlink()
+                except OSError:
+                    # Still open in another process on Windows, deleted at the next packing
+                    pass
+        return sum(lengths)
@@ -1,37 +1,137 @@
-import random
+import numpy as np
+
+
+def _rng_state_to_list(rng: np.random.RandomState):
+    name, keys, pos, has_gauss, cached_gaussian = rng.get_state()
+    return [name, keys.tolist(), pos, has_gauss, cached_gaussian]
+
+
+def _rng_state_from_list(rng: np.random.RandomState, state):
+    name, keys, pos, has_gauss, cached_gaussian = state
+    rng.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+
 
 class RandomCycler:
     """
-    Creates an internal copy of a sequence and allows access to its items in a constrained random 
-    order. For a source sequence of n items and one or several consecutive queries of a total 
+    Creates an internal copy of a sequence and allows access to its items in a constrained random
+    order. For a source sequence of n items and one or several consecutive queries of a total
     of m items, the following guarantees hold (one implies the other):
         - Each item will be returned between m // n and ((m - 1) // n) + 1 times.
         - Between two appearances of the same item, there may be at most 2 * (n - 1) other items.
+
+    The order is kept as a permutation of the indices of the items with a cursor in it, so that
+    a query only costs the number of items returned. The state of the cycler can be saved with
+    state_dict() and restored with load_state_dict() to continue the same cycle.
     """
-    
-    def __init__(self, source):
+
+    def __init__(self, source, rng: np.random.RandomState=None):
+        """
+        :param source: the sequence of items
+        :param rng: the random generator of the cycler. Give it its own generator for its state
+        to be fully restored by load_state_dict(). Defaults to the global numpy generator.
+        """
         if len(source) == 0:
             raise Exception("Can't create RandomCycler from an empty collection")
         self.all_items = list(source)
-        self.next_items = []
-    
+        self._rng = rng
+        self._order = np.zeros(0, dtype=np.int64)
+        self._cursor = 0
+
+    @property
+    def rng(self):
+        return np.random if self._rng is None else self._rng
+
     def sample(self, count: int):
-        shuffle = lambda l: random.sample(l, len(l))
-        
-        out = []
+        n = len(self.all_items)
+        indices = []
         while count > 0:
-            if count >= len(self.all_items):
-                out.extend(shuffle(list(self.all_items)))
-                count -= len(self.all_items)
+            if count >= n:
+                indices.append(self.rng.permutation(n))
+                count -= n
                 continue
-            n = min(count, len(self.next_items))
-            out.extend(self.next_items[:n])
-            count -= n
-            self.next_items = self.next_items[n:]
-            if len(self.next_items) == 0:
-                self.next_items = shuffle(list(self.all_items))
+            if self._cursor == len(self._order):
+                self._order = self.rng.permutation(n)
+                self._cursor = 0
+            k = min(count, len(self._order) - self._cursor)
+            indices.append(self._order[self._cursor:self._cursor + k])
+            self._cursor += k
+            count -= k
+
+        if not indices:
+            return []
+        return [self.all_items[i] for i in np.concatenate(indices)]
+
+    def __next__(self):
+        return self.sample(1)[0]
+
+    def state_dict(self):
+        # The state is made of python types only, so that it can be saved in a checkpoint that 
+        # torch.load() opens with weights_only=True
+        state = {"n_items": len(self.all_items), "order": self._order.tolist(),
+                 "cursor": self._cursor}
+        if self._rng is not None:
+            state["rng_state"] = _rng_state_to_list(self._rng)
+        return state
+
+    def load_state_dict(self, state):
+        if state["n_items"] != len(self.all_items):
+            raise Exception("Can't restore the state of a RandomCycler of %d items in one of %d "
+                            "items" % (state["n_items"], len(self.all_items)))
+        self._order = np.array(state["order"], dtype=np.int64)
+        self._cursor = state["cursor"]
+        if self._rng is not None and "rng_state" in state:
+            _rng_state_from_list(self._rng, state["rng_state"])
+
+
+class WeightedRandomCycler:
+    """
+    Cycles through several groups of items (e.g. the speakers of different datasets), choosing
+    the group of each item at random according to the weights of the groups. Within a group,
+    items are returned in the order of a RandomCycler, so that its guarantees hold for the items
+    drawn from that group.
+    """
+
+    def __init__(self, groups, weights, rng: np.random.RandomState=None):
+        """
+        :param groups: a list of non-empty sequences of items
+        :param weights: the relative frequency of each group, one non-negative number per group
+        :param rng: see RandomCycler
+        """
+        assert len(groups) == len(weights)
+        weights = np.asarray(weights, dtype=np.float64)
+        if len(groups) == 0 or np.any(weights < 0) or np.sum(weights) == 0:
+            raise Exception("Can't create WeightedRandomCycler without a group of positive weight")
+        self._rng = rng
+        self.probabilities = weights / np.sum(weights)
+        self.cyclers = [RandomCycler(group, rng) for group in groups]
+
+    @property
+    def rng(self):
+        return np.random if self._rng is None else self._rng
+
+    def sample(self, count: int):
+        group_ids = self.rng.choice(len(self.cyclers), size=count, p=self.probabilities)
+        out = [None] * count
+        for group_id in np.unique(group_ids):
+            positions = np.flatnonzero(group_ids == group_id)
+            for position, item in zip(positions, self.cyclers[group_id].sample(len(positions))):
+                out[position] = item
         return out
-    
+
     def __next__(self):
         return self.sample(1)[0]
 
+    def state_dict(self):
+        state = {"cyclers": [cycler.state_dict() for cycler in self.cyclers]}
+        if self._rng is not None:
+            state["rng_state"] = _rng_state_to_list(self._rng)
+        return state
+
+    def load_state_dict(self, state):
+        if len(state["cyclers"]) != len(self.cyclers):
+            raise Exception("Can't restore the state of a WeightedRandomCycler of %d groups in one "
+                            "of %d groups" % (len(state["cyclers"]), len(self.cyclers)))
+        for cycler, cycler_state in zip(self.cyclers, state["cyclers"]):
+            cycler.load_state_dict(cycler_state)
+        if self._rng is not None and "rng_state" in state:
+            _rng_state_from_list(self._rng, state["rng_state"])
@@ -1,5 +1,6 @@
 from encoder.data_objects.random_cycler import RandomCycler
 from encoder.data_objects.utterance import Utterance
+from encoder.data_objects.packed_frames import PackedFrames
 from pathlib import Path
 
 # Contains the set of utterances of a single speaker
@@ -14,8 +15,39 @@ class Speaker:
         with self.root.joinpath("_sources.txt").open("r") as sources_file:
             sources = [l.split(",") for l in sources_file]
         sources = {frames_fname: wave_fpath for frames_fname, wave_fpath in sources}
-        self.utterances = [Utterance(self.root.joinpath(f), w) for f, w in sources.items()]
+        
+        # Read the utterances from the packed frames if the speaker was packed, and from their own 
+        # files otherwise (or if they were added after the speaker was packed)
+        packed = PackedFrames(self.root) if PackedFrames.exists(self.root) else None
+        self.utterances = [
+            Utterance(self.root.joinpath(f), w, packed if packed and f in packed.index else None) 
+            for f, w in sources.items()
+        ]
         self.utterance_cycler = RandomCycler(self.utterances)
+    
+    def pack(self):
+        """
+        Packs the frames of all utterances of the speaker in a single memory-mapped file, see 
+        PackedFrames. Utterances that were already packed are read from the previous packed file, 
+        so the original .npy files may be deleted after packing.
+        
+        :return: the number of frames packed
+        """
+        self._load_utterances()
+        utterances = {u.frames_fpath.name: u for u in self.utterances}
+        n_frames = PackedFrames.pack(self.root, list(utterances), 
+                                     lambda fname: utterances[fname].get_frames(decode=False))
+        self.utterances = None
+        return n_frames
+               
+    def sample_utterances(self, count):
+        """
+        Samples <count> utterances of the speaker, in the same constrained random order as 
+        random_partial().
+        """
+        if self.utterances is None:
+            self._load_utterances()
+        return self.utterance_cycler.sample(count)
                
     def random_partial(self, count, n_frames):
         """
@@ -30,10 +62,7 @@ class Speaker:
         frames are the frames of the partial utterances and range is the range of the partial 
         utterance with regard to the complete utterance.
         """
-        if self.utterances is None:
-            self._load_utterances()
-
-        utterances = self.utterance_cycler.sample(count)
+        utterances = self.sample_utterances(count)
 
         a = [(u,) + u.random_partial(n_frames) for u in utterances]
 
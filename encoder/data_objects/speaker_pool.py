@@ -0,0 +1,213 @@
+from encoder.data_objects.random_cycler import RandomCycler
+from encoder.data_objects.speaker_batch import SpeakerBatch
+from encoder.data_objects.speaker import Speaker
+from encoder.params_data import partials_n_frames
+from multiprocessing.pool import ThreadPool
+from time import perf_counter as timer
+from collections import deque
+import numpy as np
+import random
+
+
+class PooledSpeaker:
+    """
+    A speaker of the pool, with the frames of a subset of its utterances held in memory.
+    """
+    def __init__(self, speaker: Speaker, utterances, frames, n_uses: int, load_duration: float):
+        self.speaker = speaker
+        self.entries = list(zip(utterances, frames))
+        self.entry_cycler = RandomCycler(self.entries)
+        self.n_uses_left = n_uses
+        self.nbytes = sum(f.nbytes for f in frames)
+        self.load_duration = load_duration
+
+    def random_partial(self, count, n_frames):
+        """
+        Same as Speaker.random_partial(), with the utterances in memory.
+        """
+        self.n_uses_left -= 1
+        entries = self.entry_cycler.sample(count)
+        return [(u,) + u.random_partial(n_frames, frames) for u, frames in entries]
+
+
+def _load_speaker(speaker: Speaker, n_utterances: int, n_uses: int):
+    start = timer()
+    utterances = speaker.sample_utterances(n_utterances)
+    frames = [u.get_frames() for u in utterances]
+    return PooledSpeaker(speaker, utterances, frames, n_uses, timer() - start)
+
+
+class SpeakerPoolDataLoader:
+    """
+    Generates the same batches as SpeakerVerificationDataLoader, but from a pool of speakers
+    whose frames are kept in memory. Each batch draws its speakers from the pool and crops its
+    partial utterances from the frames in memory, so that nothing is read from the disk when
+    generating a batch. A speaker is replaced after it was used in <batches_per_speaker>
+    batches, and its replacement is loaded in the background by a pool of threads while the
+    training goes on.
+
+    Every utterance loaded is cropped <batches_per_speaker> * <utterances_per_speaker> /
+    <utterances_per_load> times on average, at different random positions, which is where the
+    data efficiency comes from: fewer utterances are read from the disk per batch.
+
+    The speakers of the pool are not part of the state of the dataset saved with the model, so a
+    resumed training only approximately continues the cycle over the speakers, see
+    SpeakerVerificationDataset.state_dict().
+    """
+    def __init__(self, dataset, speakers_per_batch, utterances_per_speaker, pool_size=256,
+                 max_pool_bytes=2 * 1024 ** 3, utterances_per_load=20, batches_per_speaker=8,
+                 num_workers=8):
+        """
+        :param dataset: a SpeakerVerificationDataset, which gives the order in which speakers
+        enter the pool
+        :param speakers_per_batch: the number of speakers per batch
+        :param utterances_per_speaker: the number of utterances per speaker in a batch
+        :param pool_size: the maximum number of speakers in the pool
+        :param max_pool_bytes: the maximum size of the frames held in the pool. Speakers are
+        not loaded beyond that, except to keep <speakers_per_batch> speakers in the pool.
+        :param utterances_per_load: the number of utterances loaded per speaker
+        :param batches_per_speaker: the number of batches a speaker is used in before being
+        replaced
+        :param num_workers: the number of threads loading speakers
+        """
+        pool_size = min(pool_size, len(dataset.speakers))
+        if pool_size < speakers_per_batch:
+            raise Exception("The speaker pool must hold at least %d speakers, got %d." %
+                            (speakers_per_batch, pool_size))
+        self.dataset = dataset
+        self.speakers_per_batch = speakers_per_batch
+        self.utterances_per_speaker = utterances_per_speaker
+        self.pool_size = pool_size
+        self.max_pool_bytes = max_pool_bytes
+        self.utterances_per_load = max(utterances_per_load, utterances_per_speaker)
+        self.batches_per_speaker = batches_per_speaker
+        self.max_pending = 4 * num_workers
+
+        self._workers = ThreadPool(num_workers)
+        self._pool = {}
+        self._pending = {}
+        self._pool_bytes = 0
+        self._loaded_bytes = 0
+
+        # Statistics
+        self.n_batches = 0
+        self.n_blocked_batches = 0
+        self.n_loaded = 0
+        self.wait_duration = 0.
+        self._load_durations = deque(maxlen=1000)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        while True:
+            yield self.next_batch()
+
+    def next_batch(self):
+        """
+        Generates the next batch, waiting for speakers to be loaded only if there are not
+        enough in the pool.
+        """
+        self._collect()
+        self._refill()
+
+        # Wait for loads to complete if the pool doesn't have enough speakers
+        if len(self._pool) < self.speakers_per_batch:
+            self.n_blocked_batches += 1
+            start = timer()
+            while len(self._pool) < self.speakers_per_batch:
+                if not self._pending:
+                    self._refill(force=True)
+                next(iter(self._pending.values())).wait()
+                self._collect()
+            self.wait_duration += timer() - start
+
+        # Draw the speakers and crop their partial utterances
+        pooled_speakers = random.sample(list(self._pool.values()), self.speakers_per_batch)
+        speakers = [p.speaker for p in pooled_speakers]
+        partials = {
+            p.speaker: p.random_partial(self.utterances_per_speaker, partials_n_frames)
+            for p in pooled_speakers
+        }
+        batch = SpeakerBatch(speakers, self.utterances_per_speaker, partials_n_frames, partials)
+        self.n_batches += 1
+
+        # Retire the speakers that were used enough
+        for pooled_speaker in pooled_speakers:
+            if pooled_speaker.n_uses_left <= 0:
+                del self._pool[pooled_speaker.speaker]
+                self._pool_bytes -= pooled_speaker.nbytes
+        self._refill()
+
+        return batch
+
+    def _collect(self):
+        """
+        Adds the speakers that finished loading to the pool.
+        """
+        for speaker, result in list(self._pending.items()):
+            if result.ready():
+                del self._pending[speaker]
+                pooled_speaker = result.get()
+                self._pool[speaker] = pooled_speaker
+                self._pool_bytes += pooled_speaker.nbytes
+                self._loaded_bytes += pooled_speaker.nbytes
+                self.n_loaded += 1
+                self._load_durations.append(pooled_speaker.load_duration)
+
+    def _refill(self, force=False):
+        """
+        Starts loading new speakers while the pool isn't full, within the memory budget. The
+        size of the speakers being loaded is estimated from the ones loaded so far.
+        """
+        mean_bytes = self._loaded_bytes / self.n_loaded if self.n_loaded else 0
+        while len(self._pool) + len(self._pending) < self.pool_size and \
+                len(self._pending) < self.max_pending:
+            expected_bytes = self._pool_bytes + (len(self._pending) + 1) * mean_bytes
+            if expected_bytes > self.max_pool_bytes and not force:
+                break
+            speaker = self._next_speaker()
+            if speaker is None:
+                break
+            self._pending[speaker] = self._workers.apply_async(
+                _load_speaker, (speaker, self.utterances_per_load, self.batches_per_speaker))
+            force = False
+
+    def _next_speaker(self):
+        """
+        Returns the next speaker of the dataset that is neither in the pool nor being loaded.
+        """
+        for _ in range(len(self.dataset.speakers)):
+            speaker = self.dataset.next_speaker()
+            if speaker not in self._pool and speaker not in self._pending:
+                return speaker
+        return None
+
+    def stats(self):
+        """
+        Returns statistics on the pool: the hit rate is the proportion of batches generated
+        without waiting for speakers to be loaded.
+        """
+        durations = np.array(self._load_durations) if self._load_durations else np.zeros(1)
+        return {
+            "batches": self.n_batches,
+            "hit_rate": 1 - self.n_blocked_batches / max(1, self.n_batches),
+            "wait_seconds": self.wait_duration,
+            "speakers_loaded": self.n_loaded,
+            "refill_mean_ms": np.mean(durations) * 1000,
+            "refill_p95_ms": np.percentile(durations, 95) * 1000,
+            "pool_speakers": len(self._pool),
+            "pending_speakers": len(self._pending),
+            "pool_mb": self._pool_bytes / 1024 ** 2,
+        }
+
+    def log_string(self):
+        stats = self.stats()
+        return ("Speaker pool: %d speakers (%d loading, %.0fMB)   hit rate: %.1f%%   "
+                "waited: %.1fs   refill latency: mean %.0fms, p95 %.0fms" %
+                (stats["pool_speakers"], stats["pending_speakers"], stats["pool_mb"],
+                 stats["hit_rate"] * 100, stats["wait_seconds"], stats["refill_mean_ms"],
+                 stats["refill_p95_ms"]))
+
+    def close(self):
+        self._workers.terminate()
@@ -1,27 +1,105 @@
-from encoder.data_objects.random_cycler import RandomCycler
+from encoder.data_objects.random_cycler import RandomCycler, WeightedRandomCycler
 from encoder.data_objects.speaker_batch import SpeakerBatch
 from encoder.data_objects.speaker import Speaker
 from encoder.params_data import partials_n_frames
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
+from collections import deque
+from typing import Dict
 from pathlib import Path
+import numpy as np
 
-# TODO: improve with a pool of speakers for data efficiency
+# See SpeakerPoolDataLoader for a loader that reuses the speakers loaded in memory
 
 class SpeakerVerificationDataset(Dataset):
-    def __init__(self, datasets_root: Path):
+    def __init__(self, datasets_root: Path, dataset_weights: Dict[str, float]=None, shard=0, 
+                 n_shards=1):
+        """
+        :param datasets_root: the directory containing all preprocessed speaker directories
+        :param dataset_weights: an optional dictionary mapping dataset names to their relative 
+        frequency in the batches. Speakers belong to the longest dataset name that prefixes the 
+        name of their directory (e.g. "VoxCeleb1" for "VoxCeleb1_wav_id10001"), and those of 
+        unlisted datasets have a weight of 1. If None, all speakers are equally frequent.
+        :param shard: the index of the subset of the speakers to use, out of <n_shards> disjoint 
+        subsets. This splits the speakers between the processes of a distributed training.
+        :param n_shards: the number of subsets
+        """
+        assert 0 <= shard < n_shards
         self.root = datasets_root
-        speaker_dirs = [f for f in self.root.glob("*") if f.is_dir()]
+        speaker_dirs = sorted(f for f in self.root.glob("*") if f.is_dir())[shard::n_shards]
         if len(speaker_dirs) == 0:
             raise Exception("No speakers found. Make sure you are pointing to the directory "
                             "containing all preprocessed speaker directories.")
         self.speakers = [Speaker(speaker_dir) for speaker_dir in speaker_dirs]
-        self.speaker_cycler = RandomCycler(self.speakers)
+        
+        # The cycler draws indices of speakers, with its own generator so that its state can be 
+        # saved with the model
+        rng = np.random.RandomState()
+        if dataset_weights is None:
+            self.dataset_names = None
+            self.speaker_cycler = RandomCycler(range(len(self.speakers)), rng)
+        else:
+            groups = {}
+            for i, speaker in enumerate(self.speakers):
+                groups.setdefault(self._dataset_name(speaker.name, dataset_weights), []).append(i)
+            self.dataset_names = sorted(groups)
+            weights = [dataset_weights.get(name, 1.) for name in self.dataset_names]
+            self.speaker_cycler = WeightedRandomCycler(
+                [groups[name] for name in self.dataset_names], weights, rng)
+        
+        # The state of the cycler after the speakers of the last batch trained on, which is behind 
+        # the cycler when a SpeakerVerificationDataLoader prefetches batches
+        self.batch_cycler_state = None
+        
+    @staticmethod
+    def _dataset_name(speaker_name, dataset_weights):
+        matches = [name for name in dataset_weights if speaker_name.startswith(name)]
+        if matches:
+            return max(matches, key=len)
+        # Speakers of unlisted datasets are grouped by the prefix of their directory name
+        return speaker_name.rsplit("_", 1)[0]
 
     def __len__(self):
         return int(1e10)
         
     def __getitem__(self, index):
-        return next(self.speaker_cycler)
+        return self.speakers[index]
+    
+    def next_speaker(self):
+        return self.speakers[next(self.speaker_cycler)]
+    
+    def state_dict(self):
+        """
+        Returns the state of the random order of the speakers, see RandomCycler. With a 
+        SpeakerVerificationDataLoader, it is the state after the last batch the loader yielded, so 
+        that the speakers of the batches prefetched by its workers are drawn again on resume. 
+        With a SpeakerPoolDataLoader, it is the current state of the cycler, which is ahead of 
+        the training by the speakers in the pool or being loaded: these speakers are skipped on 
+        resume, so resuming only approximately continues the cycle.
+        """
+        if self.batch_cycler_state is not None:
+            cycler_state = self.batch_cycler_state
+        else:
+            cycler_state = self.speaker_cycler.state_dict()
+        return {
+            "speakers": [speaker.name for speaker in self.speakers],
+            "dataset_names": self.dataset_names,
+            "cycler": cycler_state,
+        }
+    
+    def load_state_dict(self, state):
+        """
+        Restores the order of the speakers from a state_dict(), so that a resumed training 
+        continues the same cycle. The state is ignored if the speakers or the dataset weights 
+        changed in the meantime.
+        
+        :return: whether the state was restored
+        """
+        if state["speakers"] != [speaker.name for speaker in self.speakers] or \
+                state["dataset_names"] != self.dataset_names:
+            return False
+        self.speaker_cycler.load_state_dict(state["cycler"])
+        self.batch_cycler_state = None
+        return True
     
     def get_logs(self):
         log_string = ""
@@ -30,16 +108,41 @@ class SpeakerVerificationDataset(Dataset):
                 log_string += "".join(log_file.readlines())
         return log_string
     
+
+class SpeakerBatchSampler(Sampler):
+    """
+    Draws the indices of the speakers of each batch from the cycler of the dataset. The sampler 
+    runs in the main process, so that there is a single cycle over the speakers (rather than one 
+    per worker) and that its state can be saved. The state of the cycler after each batch is 
+    kept in <states> until the loader yields the batch.
+    """
+    def __init__(self, dataset: SpeakerVerificationDataset, speakers_per_batch):
+        self.dataset = dataset
+        self.speakers_per_batch = speakers_per_batch
+        self.states = deque()
+        
+    def __iter__(self):
+        self.states.clear()
+        while True:
+            indices = [next(self.dataset.speaker_cycler) for _ in range(self.speakers_per_batch)]
+            self.states.append(self.dataset.speaker_cycler.state_dict())
+            yield indices
+            
+    def __len__(self):
+        return len(self.dataset)
+    
     
 class SpeakerVerificationDataLoader(DataLoader):
     def __init__(self, dataset, speakers_per_batch, utterances_per_speaker, sampler=None, 
                  batch_sampler=None, num_workers=0, pin_memory=False, timeout=0, 
                  worker_init_fn=None):
         self.utterances_per_speaker = utterances_per_speaker
-
+        if sampler is None and batch_sampler is None:
+            batch_sampler = SpeakerBatchSampler(dataset, speakers_per_batch)
+        
         super().__init__(
             dataset=dataset, 
-            batch_size=speakers_per_batch, 
+            batch_size=speakers_per_batch if batch_sampler is None else 1, 
             shuffle=False, 
             sampler=sampler, 
             batch_sampler=batch_sampler, 
@@ -50,6 +153,14 @@ class SpeakerVerificationDataLoader(DataLoader):
             timeout=timeout, 
             worker_init_fn=worker_init_fn
         )
+    
+    def __iter__(self):
+        # Record the state of the cycler of each batch once it is yielded rather than drawn, 
+        # since the workers prefetch batches
+        for batch in super().__iter__():
+            if isinstance(self.batch_sampler, SpeakerBatchSampler):
+                self.dataset.batch_cycler_state = self.batch_sampler.states.popleft()
+            yield batch
 
     def collate(self, speakers):
         return SpeakerBatch(speakers, self.utterances_per_speaker, partials_n_frames) 
@@ -1,26 +1,57 @@
+from utils.mel_storage import decode_mel
 import numpy as np
 
 
 class Utterance:
-    def __init__(self, frames_fpath, wave_fpath):
+    def __init__(self, frames_fpath, wave_fpath, packed=None):
+        """
+        :param frames_fpath: the path to the .npy file of the mel spectrogram
+        :param wave_fpath: the path to the source audio file
+        :param packed: the PackedFrames of the speaker if the utterance is packed, in which case 
+        the frames are read from there instead of <frames_fpath>
+        """
         self.frames_fpath = frames_fpath
         self.wave_fpath = wave_fpath
+        self.packed = packed
+        if packed is not None:
+            self.packed_offset, self.n_frames = packed.index[frames_fpath.name]
         
-    def get_frames(self):
-        return np.load(self.frames_fpath)
+    def get_frames(self, decode=True):
+        """
+        :param decode: if False, the frames are returned as stored, possibly in float16 (see 
+        utils.mel_storage), rather than in float32
+        """
+        if self.packed is not None:
+            frames = self.packed.read(self.packed_offset, 0, self.n_frames)
+        else:
+            frames = np.load(self.frames_fpath)
+        return decode_mel(frames) if decode else frames
 
-    def random_partial(self, n_frames):
+    def random_partial(self, n_frames, frames=None):
         """
-        Crops the frames into a partial utterance of n_frames
+        Crops the frames into a partial utterance of n_frames. Only the frames of the partial 
+        utterance are read from the disk if the utterance is packed.
         
         :param n_frames: The number of frames of the partial utterance
+        :param frames: the frames of the utterance if they were already loaded, in which case 
+        nothing is read from the disk
         :return: the partial utterance frames and a tuple indicating the start and end of the 
         partial utterance in the complete utterance.
         """
-        frames = self.get_frames()
-        if frames.shape[0] == n_frames:
+        if frames is not None:
+            total_frames = frames.shape[0]
+        elif self.packed is not None:
+            total_frames = self.n_frames
+        else:
+            frames = self.get_frames()
+            total_frames = frames.shape[0]
+        
+        if total_frames == n_frames:
             start = 0
         else:
-            start = np.random.randint(0, frames.shape[0] - n_frames)
+            start = np.random.randint(0, total_frames - n_frames)
         end = start + n_frames
-        return frames[start:end], (start, end)
\ No newline at end of file
+        
+        if frames is None and self.packed is not None:
+            return decode_mel(self.packed.read(self.packed_offset, start, end)), (start, end)
+        return frames[start:end], (start, end)
@@ -0,0 +1,171 @@
+from encoder import inference as encoder
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Union
+import numpy as np
+import hashlib
+import librosa
+import os
+
+
+class EmbeddingCache:
+    """
+    Caches utterance embeddings so that audio that was already seen is not preprocessed and
+    embedded again. Entries are keyed by a hash of the raw audio samples (before preprocessing)
+    and of the identity of the loaded encoder checkpoint, so that loading another encoder never
+    returns stale embeddings.
+
+    There are two tiers: an LRU cache in memory and an optional directory on the disk, which is
+    also evicted in LRU order and can be shared between runs.
+    """
+    def __init__(self, max_memory_entries=256, cache_dir: Optional[Path]=None,
+                 max_disk_entries=10000):
+        """
+        :param max_memory_entries: the maximum number of embeddings kept in memory.
+        :param cache_dir: a directory in which to store the embeddings on the disk. If None, only
+        the memory tier is used.
+        :param max_disk_entries: the maximum number of embeddings kept in <cache_dir>. The least
+        recently used ones are deleted beyond that.
+        """
+        assert max_memory_entries > 0 and max_disk_entries > 0
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+
+        # Index the entries already on the disk, least recently used first
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        self._disk = OrderedDict()
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            entries = sorted(self.cache_dir.glob("*.npz"), key=lambda f: f.stat().st_mtime)
+            self._disk.update((fpath.stem, None) for fpath in entries)
+
+    @staticmethod
+    def key(wav: np.ndarray, source_sr: Optional[int]=None):
+        """
+        Computes the cache key of a raw waveform for the currently loaded encoder.
+        """
+        wav = np.ascontiguousarray(wav)
+        key = hashlib.sha1()
+        key.update(encoder.get_model_identity().encode())
+        key.update(("%s:%s:%s" % (source_sr, wav.dtype.str, wav.shape)).encode())
+        key.update(wav.data)
+        return key.hexdigest()
+
+    def get(self, key):
+        """
+        Returns the (embed, partial_embeds) tuple cached under <key>, or None if there is none.
+        """
+        # Memory tier
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return self._memory[key]
+
+        # Disk tier
+        if key in self._disk:
+            fpath = self._fpath(key)
+            try:
+                with np.load(fpath) as entry:
+                    value = (entry["embed"], entry["partial_embeds"])
+                os.utime(fpath)
+            except (OSError, KeyError, ValueError):
+                # The file was evicted by another process or is corrupted
+                del self._disk[key]
+            else:
+                self._disk.move_to_end(key)
+                self._put_memory(key, value)
+                self.disk_hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    def put(self, key, embed: np.ndarray, partial_embeds: np.ndarray):
+        """
+        Caches the embedding and the partial embeddings of an utterance under <key>.
+        """
+        value = (embed, partial_embeds)
+        self._put_memory(key, value)
+        if self.cache_dir is None:
+            return
+
+        # Write the entry atomically, so that a concurrent reader never sees a partial file
+        fpath = self._fpath(key)
+        tmp_fpath = fpath.with_name("%s.%d.tmp" % (key, os.getpid()))
+        with tmp_fpath.open("wb") as tmp_file:
+            np.savez(tmp_file, embed=embed, partial_embeds=partial_embeds)
+        os.replace(tmp_fpath, fpath)
+        self._disk[key] = None
+        self._disk.move_to_end(key)
+        while len(self._disk) > self.max_disk_entries:
+            evicted_key, _ = self._disk.popitem(last=False)
+            try:
+                self._fpath(evicted_key).unlink()
+            except FileNotFoundError:
+                pass
+
+    def embed_utterance(self, fpath_or_wav: Union[str, Path, np.ndarray],
+                        source_sr: Optional[int]=None, return_partials=False):
+        """
+        Equivalent to encoder.embed_utterance(encoder.preprocess_wav(fpath_or_wav, source_sr)),
+        except that the result is taken from the cache if this audio was embedded before with the
+        same encoder.
+
+        :param fpath_or_wav: see encoder.preprocess_wav()
+        :param source_sr: see encoder.preprocess_wav()
+        :param return_partials: if True, the partial embeddings are returned along with the
+        embedding. Contrary to encoder.embed_utterance(), the wav slices are not returned.
+        :return: the embedding, and possibly the partial embeddings
+        """
+        if isinstance(fpath_or_wav, str) or isinstance(fpath_or_wav, Path):
+            wav, source_sr = librosa.load(str(fpath_or_wav), sr=None)
+        else:
+            wav = fpath_or_wav
+
+        key = self.key(wav, source_sr)
+        value = self.get(key)
+        if value is None:
+            preprocessed_wav = encoder.preprocess_wav(wav, source_sr)
+            embed, partial_embeds, _ = encoder.embed_utterance(preprocessed_wav,
+                                                               return_partials=True)
+            self.put(key, embed, partial_embeds)
+            value = (embed, partial_embeds)
+
+        return value if return_partials else value[0]
+
+    def clear(self):
+        """
+        Empties the memory tier. The disk tier is left untouched.
+        """
+        self._memory.clear()
+
+    @property
+    def hits(self):
+        return self.memory_hits + self.disk_hits
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(1, self.hits + self.misses)
+
+    def stats(self):
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "memory_entries": len(self._memory),
+            "disk_entries": len(self._disk),
+        }
+
+    def _put_memory(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _fpath(self, key):
+        return self.cache_dir.joinpath("%s.npz" % key)
@@ -0,0 +1,285 @@
+from encoder.params_model import model_embedding_size
+from pathlib import Path
+from typing import List, Optional
+import numpy as np
+import os
+
+
+class EmbeddingIndex:
+    """
+    A persistent index of L2-normalized embeddings with their speaker and utterance ids, that
+    supports cosine similarity top-k queries. Use it to find the closest existing voices to new
+    embeddings, e.g. to deduplicate enrollments.
+
+    The index is a directory holding:
+        - embeds.npy: the embeddings, as a memory-mapped matrix that doubles in size when full
+        - ids.txt: one "speaker_id|utterance_id" line per embedding, in the same order. Only the
+        embeddings with an id line are part of the index, so that an interrupted add() leaves the
+        index consistent.
+        - ivf_centroids.npy and ivf_assignments.bin: the coarse quantizer, if trained with
+        train_ivf()
+
+    Searches are exact by default: the embeddings are scanned by blocks with one matrix product
+    per block. Once a coarse quantizer is trained, searches may instead only scan the
+    embeddings of the <n_probe> clusters closest to each query (IVF), which is much faster on
+    large indices but may miss some neighbours.
+    """
+    block_size = 65536
+
+    def __init__(self, index_dir: Path, embedding_size=model_embedding_size,
+                 initial_capacity=1024):
+        """
+        Opens the index in <index_dir>, creating it if it doesn't exist.
+
+        :param index_dir: the directory of the index
+        :param embedding_size: the size of the embeddings, for a new index
+        :param initial_capacity: the number of rows of the matrix of a new index
+        """
+        self.index_dir = Path(index_dir)
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        self._embeds_fpath = self.index_dir.joinpath("embeds.npy")
+        self._ids_fpath = self.index_dir.joinpath("ids.txt")
+        self._centroids_fpath = self.index_dir.joinpath("ivf_centroids.npy")
+        self._assignments_fpath = self.index_dir.joinpath("ivf_assignments.bin")
+
+        # Load the embeddings and their ids
+        if self._embeds_fpath.exists():
+            self._embeds = np.load(self._embeds_fpath, mmap_mode="r+")
+        else:
+            self._embeds = np.lib.format.open_memmap(
+                self._embeds_fpath, mode="w+", dtype=np.float32,
+                shape=(initial_capacity, embedding_size))
+        self.speaker_ids, self.utterance_ids = [], []
+        if self._ids_fpath.exists():
+            with self._ids_fpath.open("r", encoding="utf-8") as ids_file:
+                for line in ids_file:
+                    speaker_id, utterance_id = line.rstrip("\n").split("|")
+                    self.speaker_ids.append(speaker_id)
+                    self.utterance_ids.append(utterance_id)
+        assert len(self.speaker_ids) <= len(self._embeds), "The index is corrupted"
+
+        # Load the coarse quantizer
+        self._centroids = None
+        self._lists = None
+        if self._centroids_fpath.exists():
+            self._centroids = np.load(self._centroids_fpath)
+            assignments = np.fromfile(self._assignments_fpath, dtype=np.int32)[:len(self)]
+            if len(assignments) < len(self):
+                # Assign the embeddings that were added after an interruption
+                missing = self._assign(self._embeds[len(assignments):len(self)])
+                with self._assignments_fpath.open("ab") as assignments_file:
+                    missing.tofile(assignments_file)
+                assignments = np.concatenate((assignments, missing))
+            self._build_lists(assignments)
+
+    def __len__(self):
+        return len(self.speaker_ids)
+
+    @property
+    def embedding_size(self):
+        return self._embeds.shape[1]
+
+    @property
+    def embeds(self):
+        """
+        The embeddings of the index, as a read-only memory-mapped array of shape
+        (len(self), embedding_size).
+        """
+        embeds = self._embeds[:len(self)]
+        embeds.flags.writeable = False
+        return embeds
+
+    @property
+    def is_ivf_trained(self):
+        return self._centroids is not None
+
+    def add(self, embeds: np.ndarray, speaker_ids: List[str], utterance_ids: List[str]):
+        """
+        Adds embeddings to the index. They are normalized before being stored.
+
+        :param embeds: the embeddings as a numpy array of shape (n_embeds, embedding_size)
+        :param speaker_ids: the speaker ids of the embeddings, as a list of n_embeds strings
+        :param utterance_ids: the utterance ids of the embeddings, as a list of n_embeds strings
+        :return: the indices of the new embeddings in the index, as a numpy array of int
+        """
+        embeds = self._normalize(embeds)
+        assert len(embeds) == len(speaker_ids) == len(utterance_ids)
+        assert all("|" not in i and "\n" not in i for i in list(speaker_ids) + list(utterance_ids))
+        start, end = len(self), len(self) + len(embeds)
+
+        # Grow the matrix if needed, then write the embeddings before their ids
+        if end > len(self._embeds):
+            self._grow(end)
+        self._embeds[start:end] = embeds
+        self._embeds.flush()
+        with self._ids_fpath.open("a", encoding="utf-8") as ids_file:
+            for speaker_id, utterance_id in zip(speaker_ids, utterance_ids):
+                ids_file.write("%s|%s\n" % (speaker_id, utterance_id))
+        self.speaker_ids.extend(speaker_ids)
+        self.utterance_ids.extend(utterance_ids)
+
+        # Assign the embeddings to their cluster
+        if self.is_ivf_trained:
+            assignments = self._assign(embeds)
+            with self._assignments_fpath.open("ab") as assignments_file:
+                assignments.tofile(assignments_file)
+            for list_index in np.unique(assignments):
+                new_indices = np.arange(start, end)[assignments == list_index]
+                self._lists[list_index] = np.concatenate((self._lists[list_index], new_indices))
+
+        return np.arange(start, end)
+
+    def search(self, queries: np.ndarray, k=10, n_probe: Optional[int]=None):
+        """
+        Finds the embeddings of the index that are the most similar to each query.
+
+        :param queries: the query embeddings as a numpy array of shape (n_queries,
+        embedding_size) or (embedding_size,). They don't need to be normalized.
+        :param k: the number of neighbours to return per query
+        :param n_probe: if None, the search is exact. Otherwise, the index must have been trained
+        with train_ivf() and only the embeddings of the <n_probe> clusters closest to each query
+        are compared.
+        :return: the cosine similarities and the indices of the neighbours, as two numpy arrays of
+        shape (n_queries, min(k, len(self))) sorted by decreasing similarity. With IVF search,
+        missing neighbours have an index of -1 and a similarity of -inf. For a single query, the
+        first dimension is dropped.
+        """
+        single_query = queries.ndim == 1
+        queries = self._normalize(queries[None, ...] if single_query else queries)
+        k = min(k, len(self))
+
+        if k == 0:
+            scores = np.zeros((len(queries), 0), dtype=np.float32)
+            indices = np.zeros((len(queries), 0), dtype=np.int64)
+        elif n_probe is None:
+            scores, indices = self._search_exact(queries, k)
+        else:
+            if not self.is_ivf_trained:
+                raise Exception("The index must be trained with train_ivf() before IVF search.")
+            scores, indices = self._search_ivf(queries, k, n_probe)
+
+        if single_query:
+            return scores[0], indices[0]
+        return scores, indices
+
+    def train_ivf(self, n_lists: Optional[int]=None, n_iter=20, max_train_size=None, seed=0):
+        """
+        Trains the coarse quantizer of the index with spherical k-means, and assigns all
+        embeddings to their cluster. Embeddings added afterwards are assigned as they are added.
+        Retrain when the distribution of the embeddings has changed a lot.
+
+        :param n_lists: the number of clusters. Defaults to about the square root of the number
+        of embeddings.
+        :param n_iter: the number of k-means iterations
+        :param max_train_size: the number of embeddings sampled to train the clusters. Defaults
+        to 256 per cluster.
+        :param seed: the random seed of the sampling and of the initialization
+        """
+        if n_lists is None:
+            n_lists = max(1, int(np.sqrt(len(self))))
+        if max_train_size is None:
+            max_train_size = 256 * n_lists
+        assert 0 < n_lists <= len(self), "Not enough embeddings to train %d lists" % n_lists
+
+        # Spherical k-means on a sample of the embeddings
+        rng = np.random.RandomState(seed)
+        sample = np.sort(rng.choice(len(self), min(len(self), max_train_size), replace=False))
+        train_embeds = np.asarray(self._embeds[sample])
+        centroids = train_embeds[rng.choice(len(train_embeds), n_lists, replace=False)]
+        for _ in range(n_iter):
+            assignments = np.argmax(np.dot(train_embeds, centroids.T), axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, train_embeds)
+            # Reinitialize empty clusters on random embeddings
+            empty = np.bincount(assignments, minlength=n_lists) == 0
+            sums[empty] = train_embeds[rng.choice(len(train_embeds), np.sum(empty))]
+            centroids = self._normalize(sums)
+        self._centroids = centroids.astype(np.float32)
+
+        # Assign all embeddings
+        assignments = np.concatenate([self._assign(self._embeds[i:i + self.block_size])
+                                      for i in range(0, len(self), self.block_size)])
+        np.save(self._centroids_fpath, self._centroids)
+        assignments.tofile(str(self._assignments_fpath))
+        self._build_lists(assignments)
+
+    def _search_exact(self, queries, k):
+        scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        indices = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self), self.block_size):
+            block = self._embeds[start:min(start + self.block_size, len(self))]
+            scores = np.concatenate((scores, np.dot(queries, block.T)), axis=1)
+            indices = np.concatenate(
+                (indices, np.broadcast_to(np.arange(start, start + len(block)),
+                                          (len(queries), len(block)))), axis=1)
+            scores, indices = self._top_k(scores, indices, k)
+        return self._sort(scores, indices)
+
+    def _search_ivf(self, queries, k, n_probe):
+        n_probe = min(n_probe, len(self._centroids))
+        probes = np.argpartition(-np.dot(queries, self._centroids.T), n_probe - 1,
+                                 axis=1)[:, :n_probe]
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+
+        # Scan each probed list once for all the queries that probe it
+        query_indices = np.repeat(np.arange(len(queries)), n_probe)
+        probes = probes.ravel()
+        order = np.argsort(probes, kind="stable")
+        bounds = np.flatnonzero(np.diff(probes[order])) + 1
+        for group in np.split(order, bounds):
+            candidates = self._lists[probes[group[0]]]
+            if len(candidates) == 0:
+                continue
+            group_queries = query_indices[group]
+            group_scores = np.concatenate(
+                (scores[group_queries], np.dot(queries[group_queries],
+                                               self._embeds[candidates].T)), axis=1)
+            group_indices = np.concatenate(
+                (indices[group_queries], np.broadcast_to(candidates, (len(group),
+                                                                      len(candidates)))), axis=1)
+            scores[group_queries], indices[group_queries] = \
+                self._top_k(group_scores, group_indices, k)
+        return self._sort(scores, indices)
+
+    @staticmethod
+    def _top_k(scores, indices, k):
+        if scores.shape[1] <= k:
+            return scores, indices
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        return np.take_along_axis(scores, top, 1), np.take_along_axis(indices, top, 1)
+
+    @staticmethod
+    def _sort(scores, indices):
+        order = np.argsort(-scores, axis=1, kind="stable")
+        return np.take_along_axis(scores, order, 1), np.take_along_axis(indices, order, 1)
+
+    def _normalize(self, embeds):
+        embeds = np.asarray(embeds, dtype=np.float32)
+        assert embeds.ndim == 2 and embeds.shape[1] == self.embedding_size
+        norms = np.linalg.norm(embeds, axis=1, keepdims=True)
+        return embeds / np.maximum(norms, 1e-12)
+
+    def _assign(self, embeds):
+        return np.argmax(np.dot(embeds, self._centroids.T), axis=1).astype(np.int32)
+
+    def _build_lists(self, assignments):
+        order = np.argsort(assignments, kind="stable")
+        bounds = np.searchsorted(assignments[order], np.arange(len(self._centroids) + 1))
+        self._lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(self._centroids))]
+
+    def _grow(self, min_capacity):
+        # Copy the embeddings to a larger file, then swap the files
+        capacity = max(len(self._embeds), 1)
+        while capacity < min_capacity:
+            capacity *= 2
+        tmp_fpath = self._embeds_fpath.with_name("embeds.tmp.npy")
+        embeds = np.lib.format.open_memmap(tmp_fpath, mode="w+", dtype=np.float32,
+                                           shape=(capacity, self.embedding_size))
+        for start in range(0, len(self), self.block_size):
+            end = min(start + self.block_size, len(self))
+            embeds[start:end] = self._embeds[start:end]
+        embeds.flush()
+        del embeds, self._embeds
+        os.replace(tmp_fpath, self._embeds_fpath)
+        self._embeds = np.load(self._embeds_fpath, mmap_mode="r+")
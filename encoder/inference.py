@@ -1,18 +1,23 @@
 from encoder.params_data import *
+from encoder.params_model import model_embedding_size
 from encoder.model import SpeakerEncoder
 from encoder.audio import preprocess_wav   # We want to expose this function from here
 from matplotlib import cm
 from encoder import audio
 from pathlib import Path
+from time import perf_counter as timer
+from torch import nn
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
 
 _model = None # type: SpeakerEncoder
 _device = None # type: torch.device
+_model_identity = None # type: str
+_forward = None # The model, possibly compiled with TorchScript
 
 
-def load_model(weights_fpath: Path, device=None):
+def load_model(weights_fpath: Path, device=None, jit=False, quantize=False):
     """
     Loads the model in memory. If this function is not explicitely called, it will be run on the 
     first call to embed_frames() with the default weights file.
@@ -21,25 +26,66 @@ def load_model(weights_fpath: Path, device=None):
     :param device: either a torch device or the name of a torch device (e.g. "cpu", "cuda"). The 
     model will be loaded and will run on this device. Outputs will however always be on the cpu. 
     If None, will default to your GPU if it"s available, otherwise your CPU.
+    :param jit: if True, the model is compiled with TorchScript (by tracing), which removes the 
+    python overhead of the forward pass.
+    :param quantize: if True, the weights of the LSTM and linear layers are quantized to int8 
+    with dynamic quantization. This makes inference faster on CPU at the cost of slightly 
+    different embeddings. Only supported on CPU.
     """
-    # TODO: I think the slow loading of the encoder might have something to do with the device it
-    #   was saved on. Worth investigating.
-    global _model, _device
+    global _model, _device, _model_identity, _forward
+    start = timer()
     if device is None:
         _device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    elif isinstance(device, str):
+    else:
         _device = torch.device(device)
+    if quantize and _device.type != "cpu":
+        raise Exception("Quantized inference is only supported on the CPU, got device %s." % 
+                        _device)
+    
+    # Load the weights directly on the device, whatever the device they were saved from
     _model = SpeakerEncoder(_device, torch.device("cpu"))
-    checkpoint = torch.load(weights_fpath)
+    checkpoint = torch.load(weights_fpath, map_location=_device)
     _model.load_state_dict(checkpoint["model_state"])
     _model.eval()
-    print("Loaded encoder \"%s\" trained to step %d" % (weights_fpath.name, checkpoint["step"]))
+    
+    variant = []
+    if quantize:
+        _model = torch.quantization.quantize_dynamic(_model, {nn.LSTM, nn.Linear}, 
+                                                     dtype=torch.qint8)
+        variant.append("int8")
+    _forward = _model
+    if jit:
+        example = torch.zeros((2, partials_n_frames, mel_n_channels), device=_device)
+        with torch.no_grad():
+            _forward = torch.jit.trace(_model, example, check_trace=False)
+        variant.append("jit")
+    
+    # Quantization changes the embeddings, tracing doesn't
+    weights_stat = Path(weights_fpath).stat()
+    _model_identity = "%s:%d:%d:%d" % (Path(weights_fpath).name, weights_stat.st_size, 
+                                       weights_stat.st_mtime_ns, checkpoint["step"])
+    if quantize:
+        _model_identity += ":int8"
+    
+    print("Loaded encoder \"%s\" trained to step %d in %.2fs (%s, %s)" % 
+          (Path(weights_fpath).name, checkpoint["step"], timer() - start, _device, 
+           " ".join(variant) or "fp32"))
     
     
 def is_loaded():
     return _model is not None
 
 
+def get_model_identity():
+    """
+    Returns a string that identifies the loaded encoder checkpoint (its name, size, modification 
+    time and training step). Embeddings computed with different identities are not comparable.
+    """
+    if _model is None:
+        raise Exception("Model was not loaded. Call load_model() before inference.")
+    return _model_identity
+
+
 def embed_frames_batch(frames_batch):
     """
     Computes embeddings for a batch of mel spectrogram.
@@ -52,10 +98,32 @@ def embed_frames_batch(frames_batch):
         raise Exception("Model was not loaded. Call load_model() before inference.")
     
     frames = torch.from_numpy(frames_batch).to(_device)
-    embed = _model.forward(frames).detach().cpu().numpy()
+    with torch.no_grad():
+        embed = _forward(frames).cpu().numpy()
     return embed
 
 
+def embed_frames_batch_with_state(frames_batch, state=None):
+    """
+    Computes embeddings for a batch of mel spectrograms, starting from the LSTM state obtained 
+    after forwarding their previous frames. See SpeakerEncoder.forward_with_state().
+    
+    :param frames_batch: a batch of mel spectrograms as a numpy array of float32 of shape 
+    (batch_size, n_frames, n_channels)
+    :param state: the LSTM state returned by the previous call for the same utterances, or None 
+    to start new utterances. 
+    :return: the embeddings as a numpy array of float32 of shape (batch_size, 
+    model_embedding_size) and the new LSTM state as a tuple of two tensors on the model's device.
+    """
+    if _model is None:
+        raise Exception("Model was not loaded. Call load_model() before inference.")
+    
+    frames = torch.from_numpy(frames_batch).to(_device)
+    with torch.no_grad():
+        embed, state = _model.forward_with_state(frames, state)
+    return embed.cpu().numpy(), state
+
+
 def compute_partial_slices(n_samples, partial_utterance_n_frames=partials_n_frames,
                            min_pad_coverage=0.75, overlap=0.5):
     """
@@ -108,11 +176,86 @@ def compute_partial_slices(n_samples, partial_utterance_n_frames=partials_n_fram
     return wav_slices, mel_slices
 
 
+def _pad_for_partials(wav, **kwargs):
+    """
+    Pads a preprocessed waveform so that it covers all its partial utterances. See 
+    compute_partial_slices() for the arguments.
+    
+    :return: the padded waveform, the wav partials and the mel partials as lists of slices.
+    """
+    wave_slices, mel_slices = compute_partial_slices(len(wav), **kwargs)
+    max_wave_length = wave_slices[-1].stop
+    if max_wave_length >= len(wav):
+        wav = np.pad(wav, (0, max_wave_length - len(wav)), "constant")
+    return wav, wave_slices, mel_slices
+
+
+def _split_partials(wavs, **kwargs):
+    """
+    Splits preprocessed waveforms into the mel spectrogram frames of their partial utterances, 
+    padding the waveforms if needed. The spectrograms of all waveforms are computed at once. See 
+    compute_partial_slices() for the arguments.
+    
+    :return: for each waveform, the partial utterances frames as a numpy array of float32 of 
+    shape (n_partials, partial_utterance_n_frames, mel_n_channels) and the wav partials as a 
+    list of slices.
+    """
+    # Compute where to split the utterances into partials and pad if necessary
+    padded = [_pad_for_partials(wav, **kwargs) for wav in wavs]
+    
+    # Split the utterances into partials
+    all_frames = audio.wavs_to_mel_spectrograms([wav for wav, _, _ in padded])
+    return [(np.array([frames[s] for s in mel_slices]), wave_slices) 
+            for frames, (_, wave_slices, mel_slices) in zip(all_frames, padded)]
+
+
+def compute_partial_frames(wav, **kwargs):
+    """
+    Splits a preprocessed waveform into the mel spectrogram frames of its partial utterances, as 
+    embed_utterance() does. This doesn't need the model, so it can run in other processes than 
+    the one that embeds the partials with embed_partial_frames().
+    
+    :param wav: a preprocessed (see audio.py) utterance waveform as a numpy array of float32
+    :param kwargs: additional arguments to compute_partial_splits()
+    :return: the partial utterances frames as a numpy array of float32 of shape (n_partials, 
+    partial_utterance_n_frames, mel_n_channels)
+    """
+    return _split_partials([wav], **kwargs)[0][0]
+
+
+def embed_partial_frames(frames_batches, max_batch_size=inference_batch_size):
+    """
+    Computes the embeddings of several utterances from the frames of their partial utterances. 
+    The partials of all utterances are packed together and forwarded in batches of at most 
+    <max_batch_size> partials.
+    
+    :param frames_batches: a list of the partial utterances frames of each utterance, as 
+    returned by compute_partial_frames()
+    :param max_batch_size: the maximum number of partial utterances to forward at once
+    :return: the embeddings as a numpy array of float32 of shape (n_utterances, 
+    model_embedding_size) and a list of the partial embeddings of each utterance. Both are 
+    empty if there is no utterance.
+    """
+    assert max_batch_size > 0
+    if len(frames_batches) == 0:
+        return np.zeros((0, model_embedding_size), dtype=np.float32), []
+    frames = np.concatenate(frames_batches)
+    partial_embeds = np.concatenate([embed_frames_batch(frames[i:i + max_batch_size]) 
+                                     for i in range(0, len(frames), max_batch_size)])
+    
+    # Split the partial embeddings back per utterance and compute the utterance embeddings
+    boundaries = np.cumsum([len(frames_batch) for frames_batch in frames_batches])[:-1]
+    partial_embeds = np.split(partial_embeds, boundaries)
+    raw_embeds = np.array([np.mean(p, axis=0) for p in partial_embeds])
+    embeds = raw_embeds / np.linalg.norm(raw_embeds, 2, axis=1, keepdims=True)
+    return embeds, partial_embeds
+
+
 def embed_utterance(wav, using_partials=True, return_partials=False, **kwargs):
     """
-    Computes an embedding for a single utterance.
+    Computes an embedding for a single utterance. To embed many utterances at once, use 
+    embed_utterances() instead.
     
-    # TODO: handle multiple wavs to benefit from batching on GPU
     :param wav: a preprocessed (see audio.py) utterance waveform as a numpy array of float32
     :param using_partials: if True, then the utterance is split in partial utterances of 
     <partial_utterance_n_frames> frames and the utterance embedding is computed from their 
@@ -135,15 +278,8 @@ def embed_utterance(wav, using_partials=True, return_partials=False, **kwargs):
             return embed, None, None
         return embed
     
-    # Compute where to split the utterance into partials and pad if necessary
-    wave_slices, mel_slices = compute_partial_slices(len(wav), **kwargs)
-    max_wave_length = wave_slices[-1].stop
-    if max_wave_length >= len(wav):
-        wav = np.pad(wav, (0, max_wave_length - len(wav)), "constant")
-    
-    # Split the utterance into partials
-    frames = audio.wav_to_mel_spectrogram(wav)
-    frames_batch = np.array([frames[s] for s in mel_slices])
+    # Split the utterance into partials and embed them
+    frames_batch, wave_slices = _split_partials([wav], **kwargs)[0]
     partial_embeds = embed_frames_batch(frames_batch)
     
     # Compute the utterance embedding from the partial embeddings
@@ -155,8 +291,66 @@ def embed_utterance(wav, using_partials=True, return_partials=False, **kwargs):
     return embed
 
 
+def embed_utterances(wavs, using_partials=True, return_partials=False, 
+                     max_batch_size=inference_batch_size, **kwargs):
+    """
+    Computes the embeddings of several utterances. The partial utterances of all waveforms are 
+    packed together and forwarded in batches of at most <max_batch_size> partials, which is much 
+    faster than calling embed_utterance() on each waveform. The results are identical.
+    
+    :param wavs: a list of preprocessed (see audio.py) utterance waveforms as numpy arrays of 
+    float32
+    :param using_partials: see embed_utterance(). If False, the utterances are of different 
+    lengths and are forwarded one at a time.
+    :param return_partials: see embed_utterance()
+    :param max_batch_size: the maximum number of partial utterances to forward at once. Lower it 
+    if you run out of memory.
+    :param kwargs: additional arguments to compute_partial_splits()
+    :return: the embeddings as a numpy array of float32 of shape (n_utterances, 
+    model_embedding_size). If <return_partials> is True, a list of the partial embeddings of 
+    each utterance and a list of the wav partials of each utterance will also be returned. If 
+    <wavs> is empty, the embeddings are of shape (0, model_embedding_size) and the lists are 
+    empty.
+    """
+    assert max_batch_size > 0
+    if len(wavs) == 0:
+        embeds = np.zeros((0, model_embedding_size), dtype=np.float32)
+        if return_partials:
+            return embeds, [], []
+        return embeds
+    
+    if not using_partials:
+        embeds = np.array([embed_utterance(wav, using_partials=False) for wav in wavs])
+        if return_partials:
+            return embeds, [None] * len(wavs), [None] * len(wavs)
+        return embeds
+    
+    # Split all utterances into partials and embed them together
+    splits = _split_partials(wavs, **kwargs)
+    embeds, partial_embeds = embed_partial_frames([frames_batch for frames_batch, _ in splits], 
+                                                  max_batch_size)
+    
+    if return_partials:
+        return embeds, partial_embeds, [wave_slices for _, wave_slices in splits]
+    return embeds
+
+
 def embed_speaker(wavs, **kwargs):
-    raise NotImplemented()
+    """
+    Computes the embedding of a speaker from several of their utterances, as the normalized 
+    average of the utterance embeddings. 
+    
+    :param wavs: a non-empty list of preprocessed (see audio.py) utterance waveforms of the same 
+    speaker as numpy arrays of float32
+    :param kwargs: additional arguments to embed_utterances()
+    :return: the embedding as a numpy array of float32 of shape (model_embedding_size,)
+    """
+    if len(wavs) == 0:
+        raise Exception("Cannot compute the embedding of a speaker without any utterance.")
+    kwargs.pop("return_partials", None)
+    utterance_embeds = embed_utterances(wavs, **kwargs)
+    raw_embed = np.mean(utterance_embeds, axis=0)
+    return raw_embed / np.linalg.norm(raw_embed, 2)
 
 
 def plot_embedding_as_heatmap(embed, ax=None, title="", shape=None, color_range=(0, 0.30)):
@@ -1,11 +1,7 @@
 from encoder.params_model import *
 from encoder.params_data import *
-from scipy.interpolate import interp1d
-from sklearn.metrics import roc_curve
 from torch.nn.utils import clip_grad_norm_
-from scipy.optimize import brentq
 from torch import nn
-import numpy as np
 import torch
 
 
@@ -23,9 +19,11 @@ class SpeakerEncoder(nn.Module):
                                 out_features=model_embedding_size).to(device)
         self.relu = torch.nn.ReLU().to(device)
         
-        # Cosine similarity scaling (with fixed initial parameter values)
-        self.similarity_weight = nn.Parameter(torch.tensor([10.])).to(loss_device)
-        self.similarity_bias = nn.Parameter(torch.tensor([-5.])).to(loss_device)
+        # Cosine similarity scaling (with fixed initial parameter values). The parameters are 
+        # created on the loss device: moving them after wrapping them in nn.Parameter would 
+        # register a copy that never receives gradients.
+        self.similarity_weight = nn.Parameter(torch.tensor([10.], device=loss_device))
+        self.similarity_bias = nn.Parameter(torch.tensor([-5.], device=loss_device))
 
         # Loss
         self.loss_fn = nn.CrossEntropyLoss().to(loss_device)
@@ -48,6 +46,21 @@ class SpeakerEncoder(nn.Module):
         batch_size, hidden_size). Will default to a tensor of zeros if None.
         :return: the embeddings as a tensor of shape (batch_size, embedding_size)
         """
+        embeds, _ = self.forward_with_state(utterances, hidden_init)
+        return embeds
+    
+    def forward_with_state(self, utterances, hidden_init=None):
+        """
+        Same as forward(), but also returns the final state of the LSTM. Passing it back as 
+        <hidden_init> along with the next frames of the same utterances gives the same results as 
+        forwarding all frames at once, which allows to process utterances incrementally.
+        
+        :param utterances: see forward()
+        :param hidden_init: initial hidden and cell states of the LSTM as a tuple of two tensors of 
+        shape (num_layers, batch_size, hidden_size). Will default to tensors of zeros if None.
+        :return: the embeddings as a tensor of shape (batch_size, embedding_size) and the final 
+        hidden and cell states of the LSTM as a tuple of two tensors.
+        """
         # Pass the input through the LSTM layers and retrieve all outputs, the final hidden state
         # and the final cell state.
         out, (hidden, cell) = self.lstm(utterances, hidden_init)
@@ -58,7 +71,7 @@ class SpeakerEncoder(nn.Module):
         # L2-normalize it
         embeds = embeds_raw / torch.norm(embeds_raw, dim=1, keepdim=True)
         
-        return embeds
+        return embeds, (hidden, cell)
     
     def similarity_matrix(self, embeds):
         """
@@ -81,36 +94,30 @@ class SpeakerEncoder(nn.Module):
         centroids_excl = centroids_excl.clone() / torch.norm(centroids_excl, dim=2, keepdim=True)
 
         # Similarity matrix. The cosine similarity of already 2-normed vectors is simply the dot
-        # product of these vectors (which is just an element-wise multiplication reduced by a sum).
-        # We vectorize the computation for efficiency.
-        sim_matrix = torch.zeros(speakers_per_batch, utterances_per_speaker,
-                                 speakers_per_batch).to(self.loss_device)
-        mask_matrix = 1 - np.eye(speakers_per_batch, dtype=np.int)
-        for j in range(speakers_per_batch):
-            mask = np.where(mask_matrix[j])[0]
-            sim_matrix[mask, :, j] = (embeds[mask] * centroids_incl[j]).sum(dim=2)
-            sim_matrix[j, :, j] = (embeds[j] * centroids_excl[j]).sum(dim=1)
-        
-        ## Even more vectorized version (slower maybe because of transpose)
-        # sim_matrix2 = torch.zeros(speakers_per_batch, speakers_per_batch, utterances_per_speaker
-        #                           ).to(self.loss_device)
-        # eye = np.eye(speakers_per_batch, dtype=np.int)
-        # mask = np.where(1 - eye)
-        # sim_matrix2[mask] = (embeds[mask[0]] * centroids_incl[mask[1]]).sum(dim=2)
-        # mask = np.where(eye)
-        # sim_matrix2[mask] = (embeds * centroids_excl).sum(dim=2)
-        # sim_matrix2 = sim_matrix2.transpose(1, 2)
+        # product of these vectors. Each utterance is compared to the inclusive centroids of the 
+        # other speakers and to the exclusive centroid of its own speaker.
+        sim_incl = torch.einsum("sue,ce->suc", embeds, centroids_incl[:, 0])
+        sim_excl = (embeds * centroids_excl).sum(dim=2)
+        own_speaker = torch.eye(speakers_per_batch, dtype=torch.bool, device=embeds.device)
+        sim_matrix = torch.where(own_speaker[:, None, :], sim_excl[:, :, None], sim_incl)
         
         sim_matrix = sim_matrix * self.similarity_weight + self.similarity_bias
         return sim_matrix
     
-    def loss(self, embeds):
+    def loss(self, embeds, compute_eer=True, eer_buffer=None):
         """
         Computes the softmax loss according the section 2.1 of GE2E.
         
         :param embeds: the embeddings as a tensor of shape (speakers_per_batch, 
         utterances_per_speaker, embedding_size)
-        :return: the loss and the EER for this batch of embeddings.
+        :param compute_eer: whether to compute the EER. Skipping it on most steps saves time in 
+        the training loop.
+        :param eer_buffer: an optional list or deque to which the similarity matrix of this batch 
+        is appended (detached), whether the EER is computed or not. The EER is then computed over 
+        all the similarity matrices in the buffer, e.g. over a rolling window of batches with a 
+        deque of fixed maxlen.
+        :return: the loss and the EER for this batch of embeddings. The EER is None if 
+        <compute_eer> is False.
         """
         speakers_per_batch, utterances_per_speaker = embeds.shape[:2]
         
@@ -118,18 +125,60 @@ class SpeakerEncoder(nn.Module):
         sim_matrix = self.similarity_matrix(embeds)
         sim_matrix = sim_matrix.reshape((speakers_per_batch * utterances_per_speaker, 
                                          speakers_per_batch))
-        ground_truth = np.repeat(np.arange(speakers_per_batch), utterances_per_speaker)
-        target = torch.from_numpy(ground_truth).long().to(self.loss_device)
+        target = torch.arange(speakers_per_batch, device=sim_matrix.device)
+        target = target.repeat_interleave(utterances_per_speaker)
         loss = self.loss_fn(sim_matrix, target)
         
         # EER (not backpropagated)
+        if eer_buffer is not None:
+            eer_buffer.append(sim_matrix.detach())
+        if not compute_eer:
+            return loss, None
+        sim_matrices = [sim_matrix.detach()] if eer_buffer is None else list(eer_buffer)
         with torch.no_grad():
-            inv_argmax = lambda i: np.eye(1, speakers_per_batch, i, dtype=np.int)[0]
-            labels = np.array([inv_argmax(i) for i in ground_truth])
-            preds = sim_matrix.detach().cpu().numpy()
-
-            # Snippet from https://yangcha.github.io/EER-ROC/
-            fpr, tpr, thresholds = roc_curve(labels.flatten(), preds.flatten())           
-            eer = brentq(lambda x: 1. - x - interp1d(fpr, tpr)(x), 0., 1.)
+            scores, labels = [], []
+            for matrix in sim_matrices:
+                n_speakers = matrix.shape[1]
+                n_utterances = matrix.shape[0] // n_speakers
+                own_speaker = torch.eye(n_speakers, dtype=torch.bool, device=matrix.device)
+                labels.append(own_speaker.repeat_interleave(n_utterances, dim=0).flatten())
+                scores.append(matrix.flatten())
+            eer = equal_error_rate(torch.cat(scores), torch.cat(labels)).item()
             
-        return loss, eer
\ No newline at end of file
+        return loss, eer
+
+
+def equal_error_rate(scores: torch.Tensor, labels: torch.Tensor):
+    """
+    Computes the equal error rate of a binary classification, i.e. the point of the ROC curve 
+    where the false positive rate equals the false negative rate. The ROC curve is obtained by 
+    sorting the scores once, and the crossing is linearly interpolated between its two closest 
+    points. The result is the same as a root finding on the interpolated output of 
+    sklearn.metrics.roc_curve(), but it is computed on the device of the inputs.
+    
+    :param scores: the scores as a 1D tensor of floats, higher for the positive class
+    :param labels: the ground truth as a 1D tensor of bools of the same length, with both 
+    classes present
+    :return: the EER as a 0-dimensional tensor
+    """
+    order = torch.argsort(scores, descending=True)
+    scores = scores[order]
+    labels = labels[order].float()
+    
+    # True and false positives for each distinct threshold. With tied scores, only the last 
+    # example of the tie gives a point of the ROC curve.
+    true_positives = torch.cumsum(labels, dim=0)
+    false_positives = torch.cumsum(1 - labels, dim=0)
+    is_threshold = torch.ones_like(scores, dtype=torch.bool)
+    is_threshold[:-1] = scores[1:] != scores[:-1]
+    zero = scores.new_zeros(1)
+    tpr = torch.cat((zero, true_positives[is_threshold] / true_positives[-1]))
+    fpr = torch.cat((zero, false_positives[is_threshold] / false_positives[-1]))
+    
+    # The false negative rate minus the false positive rate goes from 1 to -1 along the curve. 
+    # Interpolate the first segment where it reaches 0.
+    gap = 1 - tpr - fpr
+    stop = torch.argmax((gap <= 0).int())
+    start = stop - 1
+    ratio = gap[start] / (gap[start] - gap[stop])
+    return fpr[start] + ratio * (fpr[stop] - fpr[start])
@@ -11,9 +11,15 @@ sampling_rate = 16000
 partials_n_frames = 160     # 1600 ms
 # Number of spectrogram frames at inference
 inference_n_frames = 80     #  800 ms
+# Maximum number of partial utterances forwarded at once when embedding several utterances
+inference_batch_size = 64
 
 
 ## Voice Activation Detection
+# Either "webrtc" (webrtcvad) or "energy" (vectorized spectral VAD, which doesn't require 
+# webrtcvad but is slower and agrees with webrtc on about 93% of the windows). See 
+# encoder.audio.detect_voice().
+vad_backend = "webrtc"
 # Window size of the VAD. Must be either 10, 20 or 30 milliseconds.
 # This sets the granularity of the VAD. Should not need to be changed.
 vad_window_length = 30  # In milliseconds
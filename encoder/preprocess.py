@@ -1,8 +1,11 @@
-from multiprocess.pool import ThreadPool
+from multiprocessing.pool import Pool
 from encoder.params_data import *
 from encoder.config import librispeech_datasets, anglophone_nationalites
+from encoder.data_objects.speaker import Speaker
 from datetime import datetime
+from functools import partial
 from encoder import audio
+from utils.mel_storage import save_mel
 from pathlib import Path
 from tqdm import tqdm
 import numpy as np
@@ -58,12 +61,40 @@ def _init_preprocess_dataset(dataset_name, datasets_root, out_dir) -> (Path, Dat
     return dataset_root, DatasetLog(out_dir, dataset_name)
 
 
+def _preprocess_utterance(fpaths, mel_storage="float32"):
+    """
+    Preprocesses one utterance and saves its mel spectrogram. This runs in the worker processes.
+    
+    :param fpaths: a tuple of the path to the source audio file and of the path to the output 
+    file
+    :param mel_storage: the type the mel spectrogram is stored in, see utils.mel_storage
+    :return: the duration of the preprocessed waveform in seconds, or None if the utterance was 
+    discarded
+    """
+    in_fpath, out_fpath = fpaths
+    
+    # Load and preprocess the waveform
+    wav = audio.preprocess_wav(in_fpath)
+    if len(wav) == 0:
+        return None
+    
+    # Create the mel spectrogram, discard those that are too short
+    frames = audio.wav_to_mel_spectrogram(wav)
+    if len(frames) < partials_n_frames:
+        return None
+    
+    save_mel(out_fpath, frames, mel_storage)
+    return len(wav) / sampling_rate
+
+
 def _preprocess_speaker_dirs(speaker_dirs, dataset_name, datasets_root, out_dir, extension,
-                             skip_existing, logger):
+                             skip_existing, logger, n_processes=None, mel_storage="float32", 
+                             chunksize=16):
     print("%s: Preprocessing data for %d speakers." % (dataset_name, len(speaker_dirs)))
     
-    # Function to preprocess utterances for one speaker
-    def preprocess_speaker(speaker_dir: Path):
+    # Gather the utterances to preprocess for each speaker
+    speakers = []
+    for speaker_dir in speaker_dirs:
         # Give a name to the speaker that includes its dataset
         speaker_name = "_".join(speaker_dir.relative_to(datasets_root).parts)
         
@@ -85,40 +116,39 @@ def _preprocess_speaker_dirs(speaker_dirs, dataset_name, datasets_root, out_dir,
             existing_fnames = {}
         
         # Gather all audio files for that speaker recursively
-        sources_file = sources_fpath.open("a" if skip_existing else "w")
+        fpaths = []
         for in_fpath in speaker_dir.glob("**/*.%s" % extension):
             # Check if the target output file already exists
             out_fname = "_".join(in_fpath.relative_to(speaker_dir).parts)
             out_fname = out_fname.replace(".%s" % extension, ".npy")
             if skip_existing and out_fname in existing_fnames:
                 continue
-                
-            # Load and preprocess the waveform
-            wav = audio.preprocess_wav(in_fpath)
-            if len(wav) == 0:
-                continue
-            
-            # Create the mel spectrogram, discard those that are too short
-            frames = audio.wav_to_mel_spectrogram(wav)
-            if len(frames) < partials_n_frames:
-                continue
-            
-            out_fpath = speaker_out_dir.joinpath(out_fname)
-            np.save(out_fpath, frames)
-            logger.add_sample(duration=len(wav) / sampling_rate)
-            sources_file.write("%s,%s\n" % (out_fname, in_fpath))
-        
-        sources_file.close()
+            fpaths.append((in_fpath, speaker_out_dir.joinpath(out_fname)))
+        speakers.append((sources_fpath, fpaths))
+    
+    # Process the utterances in parallel, file by file. The results come back in order, so that 
+    # the sources files and the log are written as if the utterances were processed one by one.
+    tasks = [fpaths for _, speaker_fpaths in speakers for fpaths in speaker_fpaths]
+    with Pool(n_processes) as pool, tqdm(total=len(tasks), desc=dataset_name, 
+                                         unit="utterances") as progress:
+        func = partial(_preprocess_utterance, mel_storage=mel_storage)
+        results = pool.imap(func, tasks, chunksize)
+        for sources_fpath, speaker_fpaths in speakers:
+            with sources_fpath.open("a" if skip_existing else "w") as sources_file:
+                for in_fpath, out_fpath in speaker_fpaths:
+                    duration = next(results)
+                    progress.update()
+                    if duration is None:
+                        continue
+                    logger.add_sample(duration=duration)
+                    sources_file.write("%s,%s\n" % (out_fpath.name, in_fpath))
     
-    # Process the utterances for each speaker
-    with ThreadPool(8) as pool:
-        list(tqdm(pool.imap(preprocess_speaker, speaker_dirs), dataset_name, len(speaker_dirs),
-                  unit="speakers"))
     logger.finalize()
     print("Done preprocessing %s.\n" % dataset_name)
 
 
-def preprocess_librispeech(datasets_root: Path, out_dir: Path, skip_existing=False):
+def preprocess_librispeech(datasets_root: Path, out_dir: Path, skip_existing=False, 
+                           n_processes=None, mel_storage="float32"):
     for dataset_name in librispeech_datasets["train"]["other"]:
         # Initialize the preprocessing
         dataset_root, logger = _init_preprocess_dataset(dataset_name, datasets_root, out_dir)
@@ -128,10 +158,11 @@ def preprocess_librispeech(datasets_root: Path, out_dir: Path, skip_existing=Fal
         # Preprocess all speakers
         speaker_dirs = list(dataset_root.glob("*"))
         _preprocess_speaker_dirs(speaker_dirs, dataset_name, datasets_root, out_dir, "flac",
-                                 skip_existing, logger)
+                                 skip_existing, logger, n_processes, mel_storage)
 
 
-def preprocess_voxceleb1(datasets_root: Path, out_dir: Path, skip_existing=False):
+def preprocess_voxceleb1(datasets_root: Path, out_dir: Path, skip_existing=False, 
+                         n_processes=None, mel_storage="float32"):
     # Initialize the preprocessing
     dataset_name = "VoxCeleb1"
     dataset_root, logger = _init_preprocess_dataset(dataset_name, datasets_root, out_dir)
@@ -158,10 +189,11 @@ def preprocess_voxceleb1(datasets_root: Path, out_dir: Path, skip_existing=False
 
     # Preprocess all speakers
     _preprocess_speaker_dirs(speaker_dirs, dataset_name, datasets_root, out_dir, "wav",
-                             skip_existing, logger)
+                             skip_existing, logger, n_processes, mel_storage)
 
 
-def preprocess_voxceleb2(datasets_root: Path, out_dir: Path, skip_existing=False):
+def preprocess_voxceleb2(datasets_root: Path, out_dir: Path, skip_existing=False, 
+                         n_processes=None, mel_storage="float32"):
     # Initialize the preprocessing
     dataset_name = "VoxCeleb2"
     dataset_root, logger = _init_preprocess_dataset(dataset_name, datasets_root, out_dir)
@@ -172,4 +204,42 @@ def preprocess_voxceleb2(datasets_root: Path, out_dir: Path, skip_existing=False
     # Preprocess all speakers
     speaker_dirs = list(dataset_root.joinpath("dev", "aac").glob("*"))
     _preprocess_speaker_dirs(speaker_dirs, dataset_name, datasets_root, out_dir, "m4a",
-                             skip_existing, logger)
+                             skip_existing, logger, n_processes, mel_storage)
+
+
+def _pack_speaker(speaker_dir: Path, remove_unpacked=False):
+    # Skip the speakers without any utterance, e.g. whose audio files all failed to preprocess
+    with speaker_dir.joinpath("_sources.txt").open("r") as sources_file:
+        if not any(line.strip() for line in sources_file):
+            return 0
+    
+    speaker = Speaker(speaker_dir)
+    n_frames = speaker.pack()
+    if remove_unpacked:
+        with speaker_dir.joinpath("_sources.txt").open("r") as sources_file:
+            for line in sources_file:
+                frames_fpath = speaker_dir.joinpath(line.split(",")[0])
+                if frames_fpath.exists():
+                    frames_fpath.unlink()
+    return n_frames
+
+
+def pack_dataset(clean_data_root: Path, remove_unpacked=False, n_processes=None):
+    """
+    Packs the mel spectrograms of each speaker of a preprocessed dataset in a single 
+    memory-mapped file, so that training reads partial utterances without opening one file per 
+    utterance. See encoder.data_objects.PackedFrames. Packing again after preprocessing more 
+    utterances includes them in the packed files.
+    
+    :param clean_data_root: the directory containing the preprocessed speaker directories
+    :param remove_unpacked: whether to delete the .npy files of the utterances once packed
+    :param n_processes: the number of speakers packed in parallel
+    """
+    speaker_dirs = [d for d in clean_data_root.glob("*") if 
+                    d.is_dir() and d.joinpath("_sources.txt").exists()]
+    print("Packing the utterances of %d speakers." % len(speaker_dirs))
+    func = partial(_pack_speaker, remove_unpacked=remove_unpacked)
+    with Pool(n_processes) as pool:
+        n_frames = sum(tqdm(pool.imap_unordered(func, speaker_dirs), "Packing", len(speaker_dirs), 
+                            unit="speakers"))
+    print("Packed %d frames.\n" % n_frames)
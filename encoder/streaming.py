@@ -0,0 +1,295 @@
+from encoder.params_data import *
+from encoder import inference as encoder
+from encoder import audio
+from scipy.signal import resample_poly
+from math import gcd
+import numpy as np
+import torch
+
+
+class StreamingEmbedder:
+    """
+    Computes the embedding of an utterance while it is being recorded. Audio chunks of any size
+    are fed as they arrive (e.g. from a microphone or a socket). Each step of the pipeline keeps
+    its state between chunks: the voice activation detection, the mel spectrogram framing and
+    the LSTM states of the partial utterances that are in progress. Every time a partial
+    utterance is complete, the running embedding (the normalized average of the partial
+    embeddings) is updated, so that a first embedding is available after about 1.6 seconds of
+    voiced audio.
+
+    Except for the volume normalization, which uses the volume of the audio seen so far, and for
+    the padding of the last partial utterance, the results are the same as the ones of
+    encoder.embed_utterance(encoder.preprocess_wav(wav)) on the complete recording.
+
+    Usage:
+        embedder = StreamingEmbedder(source_sr=44100)
+        for chunk in stream:
+            embed = embedder.feed(chunk)
+            if embed is not None:
+                ...     # Use the updated embedding
+        embed = embedder.flush()
+    """
+    def __init__(self, source_sr=sampling_rate, normalize=True, trim_silence=True,
+                 vad_backend=vad_backend, partial_utterance_n_frames=partials_n_frames,
+                 min_pad_coverage=0.75, overlap=0.5):
+        """
+        :param source_sr: the sampling rate of the chunks. Chunks are resampled independently of
+        each other, so prefer recording at the sampling rate of the encoder if possible.
+        :param normalize: whether to normalize the volume, see audio.preprocess_wav()
+        :param trim_silence: whether to trim long silences, see audio.trim_long_silences()
+        :param vad_backend: see audio.detect_voice(). With the "energy" backend, the noise is
+        profiled on each chunk, so chunks should be at least a second long.
+        :param partial_utterance_n_frames: see encoder.compute_partial_slices()
+        :param min_pad_coverage: see encoder.compute_partial_slices()
+        :param overlap: see encoder.compute_partial_slices()
+        """
+        assert 0 <= overlap < 1
+        assert 0 < min_pad_coverage <= 1
+        self.source_sr = source_sr
+        self.normalize = normalize
+        self.trim_silence = trim_silence
+        self.vad_backend = vad_backend
+        self.partial_utterance_n_frames = partial_utterance_n_frames
+        self.min_pad_coverage = min_pad_coverage
+        self.frame_step = max(int(np.round(partial_utterance_n_frames * (1 - overlap))), 1)
+
+        # Resampling ratio
+        ratio_gcd = gcd(sampling_rate, source_sr)
+        self._resample_up = sampling_rate // ratio_gcd
+        self._resample_down = source_sr // ratio_gcd
+
+        # The VAD decision of a window depends on the flags of the windows around it, through the
+        # moving average and the dilation of audio.trim_long_silences()
+        self._samples_per_window = (vad_window_length * sampling_rate) // 1000
+        dilation_width = vad_max_silence_length + 1
+        self._vad_lookbehind = (vad_moving_average_width - 1) // 2 + dilation_width // 2
+        self._vad_lookahead = vad_moving_average_width // 2 + (dilation_width - 1) // 2
+
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets all audio fed so far, to start a new utterance.
+        """
+        # Volume normalization
+        self._sum_squares = 0.
+        self._n_samples = 0
+
+        # Voice activation detection. <_vad_flags> starts at window <_vad_flags_offset> and
+        # <_vad_samples> holds the samples of the windows flagged but not yet decided.
+        self._vad_pending = np.zeros(0, dtype=np.float32)
+        self._vad_samples = np.zeros(0, dtype=np.float32)
+        self._vad_flags = np.zeros(0, dtype=bool)
+        self._vad_flags_offset = 0
+        self._n_decided = 0
+        self._webrtc_vad = None
+        if self.trim_silence and self.vad_backend == "webrtc" and audio.webrtcvad is not None:
+            self._webrtc_vad = audio.webrtcvad.Vad(mode=3)
+
+        # Mel spectrogram framing
+        self._mel_buffer = np.zeros(0, dtype=np.float32)
+        self._mel_started = False
+        self._n_frames = 0
+
+        # Partial utterances in progress, as a dictionary mapping their first frame to their
+        # LSTM state
+        self._partials = {}
+        self._partial_embeds = []
+        self.embed = None
+
+    @property
+    def partial_embeds(self):
+        """
+        The embeddings of the partial utterances completed so far, as a numpy array of float32 of
+        shape (n_partials, model_embedding_size).
+        """
+        return np.array(self._partial_embeds)
+
+    def feed(self, chunk: np.ndarray):
+        """
+        Processes the next chunk of audio.
+
+        :param chunk: the audio chunk as a numpy array of floats, at <source_sr>
+        :return: the updated embedding as a numpy array of float32 of shape
+        (model_embedding_size,) if at least one partial utterance was completed with this chunk,
+        None otherwise.
+        """
+        wav = self._preprocess(chunk)
+        frames = self._to_frames(wav, final=False)
+        n_partials = len(self._partial_embeds)
+        self._forward(frames)
+        return self.embed if len(self._partial_embeds) > n_partials else None
+
+    def flush(self):
+        """
+        Processes the audio held back by the VAD and the framing, and completes the last partial
+        utterances by padding them with silence as encoder.embed_utterance() does. Call reset()
+        before feeding a new utterance.
+
+        :return: the final embedding as a numpy array of float32 of shape
+        (model_embedding_size,), or None if there wasn't enough audio to compute one.
+        """
+        wav = self._trim_silences(np.zeros(0, dtype=np.float32), final=True)
+        self._forward(self._to_frames(wav, final=True))
+
+        for start in sorted(self._partials):
+            coverage = (self._n_frames - start) / self.partial_utterance_n_frames
+            if coverage >= self.min_pad_coverage or (start == 0 and not self._partial_embeds):
+                n_pad_frames = start + self.partial_utterance_n_frames - self._n_frames
+                padding = np.zeros((n_pad_frames, mel_n_channels), dtype=np.float32)
+                embeds = self._forward_partials([start], padding)
+                self._add_partial_embed(embeds[0])
+        self._partials.clear()
+
+        return self.embed
+
+    def _preprocess(self, chunk):
+        wav = np.asarray(chunk, dtype=np.float32)
+        if self._resample_up != self._resample_down:
+            wav = resample_poly(wav, self._resample_up, self._resample_down).astype(np.float32)
+
+        # Normalize the volume of the chunk based on the volume of all the audio so far
+        if self.normalize and len(wav):
+            self._sum_squares += np.sum(wav.astype(np.float64) ** 2)
+            self._n_samples += len(wav)
+            mean_square = self._sum_squares / self._n_samples
+            if mean_square > 0:
+                dBFS_change = audio_norm_target_dBFS - 10 * np.log10(mean_square)
+                if dBFS_change > 0:
+                    wav = wav * (10 ** (dBFS_change / 20))
+
+        return self._trim_silences(wav, final=False) if self.trim_silence else wav
+
+    def _trim_silences(self, wav, final):
+        """
+        Incremental version of audio.trim_long_silences(). Returns the samples of the windows
+        whose decision is known.
+        """
+        if not self.trim_silence:
+            return wav
+
+        # Flag the complete windows
+        samples_per_window = self._samples_per_window
+        pending = np.concatenate((self._vad_pending, wav))
+        n_samples = len(pending) - len(pending) % samples_per_window
+        if n_samples:
+            flags = audio.detect_voice(pending[:n_samples], samples_per_window, self.vad_backend,
+                                       self._webrtc_vad)
+            self._vad_flags = np.concatenate((self._vad_flags, flags))
+            self._vad_samples = np.concatenate((self._vad_samples, pending[:n_samples]))
+        self._vad_pending = pending[n_samples:]
+
+        # Decide on the windows that have enough flags after them. Incomplete windows are
+        # discarded at the end, like audio.trim_long_silences() does.
+        n_flagged = self._vad_flags_offset + len(self._vad_flags)
+        stop = n_flagged if final else n_flagged - self._vad_lookahead
+        start = self._n_decided
+        if stop <= start:
+            return np.zeros(0, dtype=np.float32)
+        audio_mask = np.repeat(self._voice_mask(start, stop), samples_per_window)
+        samples = self._vad_samples[:len(audio_mask)]
+        self._vad_samples = self._vad_samples[len(audio_mask):]
+        self._n_decided = stop
+
+        # Forget the flags that are no longer needed
+        n_drop = max(stop - self._vad_lookbehind - self._vad_flags_offset, 0)
+        self._vad_flags = self._vad_flags[n_drop:]
+        self._vad_flags_offset += n_drop
+
+        return samples[audio_mask]
+
+    def _voice_mask(self, start, stop):
+        """
+        Smooths and dilates the voice flags of the windows in [start, stop), considering that
+        there are no voiced windows before the first or after the last flagged window.
+        """
+        # Gather the flags around the windows, padded with zeros
+        first = start - self._vad_lookbehind
+        flags = np.zeros(stop - first + self._vad_lookahead)
+        src_start = max(first, self._vad_flags_offset)
+        src = self._vad_flags[src_start - self._vad_flags_offset:stop + self._vad_lookahead -
+                                                                 self._vad_flags_offset]
+        flags[src_start - first:src_start - first + len(src)] = src
+
+        # Moving average followed by binary dilation, with "valid" convolutions so that the
+        # output exactly covers [start, stop)
+        audio_mask = np.convolve(flags, np.ones(vad_moving_average_width), "valid")
+        audio_mask = np.round(audio_mask / vad_moving_average_width)
+        audio_mask = np.convolve(audio_mask, np.ones(vad_max_silence_length + 1), "valid") > 0
+        return audio_mask
+
+    def _to_frames(self, wav, final):
+        """
+        Incremental version of audio.wav_to_mel_spectrogram(). Returns the frames that are
+        complete.
+        """
+        engine = audio.mel_engine()
+        half_window = engine.n_fft // 2
+        buffer = np.concatenate((self._mel_buffer, wav))
+
+        # Pad the start and the end of the utterance by reflection, like a centered STFT
+        if not self._mel_started:
+            if len(buffer) <= half_window:
+                self._mel_buffer = buffer
+                return np.zeros((0, mel_n_channels), dtype=np.float32)
+            buffer = np.concatenate((buffer[1:half_window + 1][::-1], buffer))
+            self._mel_started = True
+        if final:
+            buffer = np.concatenate((buffer, buffer[-half_window - 1:-1][::-1]))
+
+        if len(buffer) < engine.n_fft:
+            self._mel_buffer = buffer
+            return np.zeros((0, mel_n_channels), dtype=np.float32)
+        n_frames = 1 + (len(buffer) - engine.n_fft) // engine.hop_length
+        frames = engine.mel(buffer[:(n_frames - 1) * engine.hop_length + engine.n_fft],
+                            center=False).T
+        self._mel_buffer = buffer[n_frames * engine.hop_length:]
+        return frames
+
+    def _forward(self, frames):
+        """
+        Forwards new frames through the partial utterances that contain them.
+        """
+        i = 0
+        while i < len(frames):
+            # Start a new partial utterance every <frame_step> frames
+            if self._n_frames % self.frame_step == 0:
+                self._partials[self._n_frames] = None
+
+            # Forward the frames up to the start of the next partial utterance or the end of one
+            n_frames = min(len(frames) - i, self.frame_step - self._n_frames % self.frame_step)
+            for start in self._partials:
+                n_frames = min(n_frames, start + self.partial_utterance_n_frames - self._n_frames)
+            starts = sorted(self._partials)
+            embeds = self._forward_partials(starts, frames[i:i + n_frames])
+            i += n_frames
+            self._n_frames += n_frames
+
+            for start, embed in zip(starts, embeds):
+                if self._n_frames - start == self.partial_utterance_n_frames:
+                    del self._partials[start]
+                    self._add_partial_embed(embed)
+
+    def _forward_partials(self, starts, frames):
+        """
+        Forwards the same frames through several partial utterances at once, and updates their
+        LSTM states.
+        """
+        states = [self._partials[start] for start in starts]
+        if all(state is None for state in states):
+            state = None
+        else:
+            zeros = next(torch.zeros_like(s[0]) for s in states if s is not None)
+            state = tuple(torch.cat([zeros if s is None else s[k] for s in states], dim=1)
+                          for k in range(2))
+
+        frames_batch = np.repeat(frames[None, ...], len(starts), axis=0)
+        embeds, (hidden, cell) = encoder.embed_frames_batch_with_state(frames_batch, state)
+        for j, start in enumerate(starts):
+            self._partials[start] = (hidden[:, j:j + 1], cell[:, j:j + 1])
+        return embeds
+
+    def _add_partial_embed(self, partial_embed):
+        self._partial_embeds.append(partial_embed)
+        raw_embed = np.mean(self._partial_embeds, axis=0)
+        self.embed = raw_embed / np.linalg.norm(raw_embed, 2)
@@ -1,36 +1,91 @@
 from encoder.visualizations import Visualizations
-from encoder.data_objects import SpeakerVerificationDataLoader, SpeakerVerificationDataset
+from encoder.data_objects import SpeakerVerificationDataLoader, SpeakerVerificationDataset, \
+    SpeakerPoolDataLoader
 from encoder.params_model import *
 from encoder.model import SpeakerEncoder
+from utils.checkpoint import AsyncCheckpointWriter
 from utils.profiler import Profiler
+from collections import deque
 from pathlib import Path
+import torch.distributed as dist
 import torch
+import os
 
-def sync(device: torch.device):
-    # FIXME
-    return 
-    # For correct profiling (cuda operations are async)
-    if device.type == "cuda":
-        torch.cuda.synchronize(device)
+def all_gather_embeds(embeds: torch.Tensor):
+    """
+    Concatenates the embeddings of all processes along the speaker dimension. Only the 
+    embeddings of this process are backpropagated through.
+    """
+    gathered = [torch.empty_like(embeds) for _ in range(dist.get_world_size())]
+    dist.all_gather(gathered, embeds.detach())
+    gathered[dist.get_rank()] = embeds
+    return torch.cat(gathered, dim=0)
+
+def all_reduce_gradients(model: SpeakerEncoder):
+    """
+    Sums the gradients of all processes in a single collective. Each process backpropagates the 
+    loss of the whole batch through its own embeddings only, so the gradients of the network 
+    are the sum of those of the processes. The similarity parameters however get the gradient 
+    of the whole batch in every process, so theirs are averaged.
+    """
+    params = [p for p in model.parameters() if p.grad is not None]
+    grads = torch.cat([p.grad.flatten() for p in params])
+    dist.all_reduce(grads)
+    offset = 0
+    for param in params:
+        param.grad.copy_(grads[offset:offset + param.numel()].view_as(param.grad))
+        offset += param.numel()
+    world_size = dist.get_world_size()
+    model.similarity_weight.grad /= world_size
+    model.similarity_bias.grad /= world_size
 
 def train(run_id: str, clean_data_root: Path, models_dir: Path, umap_every: int, save_every: int,
           backup_every: int, vis_every: int, force_restart: bool, visdom_server: str,
-          no_visdom: bool):
-    # Create a dataset and a dataloader
-    dataset = SpeakerVerificationDataset(clean_data_root)
-    loader = SpeakerVerificationDataLoader(
-        dataset,
-        speakers_per_batch,
-        utterances_per_speaker,
-        num_workers=8,
-    )
+          no_visdom: bool, eer_every: int, eer_window: int, pool_size: int, pool_memory: float,
+          utterances_per_load: int, batches_per_speaker: int, dataset_weights: dict,
+          distributed: bool, dist_backend: str, profile_fpath: Path):
+    # Join the other processes of a distributed training. Their rank and number, as well as the 
+    # address of the rank 0 process, are read from the environment variables set by torchrun.
+    if distributed:
+        dist.init_process_group(dist_backend, init_method="env://")
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+        if speakers_per_batch % world_size != 0:
+            raise Exception("The number of speakers per batch (%d) must be a multiple of the "
+                            "number of processes (%d)." % (speakers_per_batch, world_size))
+    else:
+        rank, world_size = 0, 1
+    is_main = rank == 0
+    local_speakers_per_batch = speakers_per_batch // world_size
+    
+    # Create a dataset and a dataloader. In a distributed training, each process draws its 
+    # share of the speakers of the batch from its own subset of the speakers.
+    dataset = SpeakerVerificationDataset(clean_data_root, dataset_weights, rank, world_size)
+    if pool_size != 0:
+        loader = SpeakerPoolDataLoader(
+            dataset,
+            local_speakers_per_batch,
+            utterances_per_speaker,
+            pool_size=pool_size,
+            max_pool_bytes=int(pool_memory * 1024 ** 3),
+            utterances_per_load=utterances_per_load,
+            batches_per_speaker=batches_per_speaker,
+            num_workers=8,
+        )
+    else:
+        loader = SpeakerVerificationDataLoader(
+            dataset,
+            local_speakers_per_batch,
+            utterances_per_speaker,
+            num_workers=8,
+        )
     
     # Setup the device on which to run the forward pass and the loss. These can be different, 
-    # because the forward pass is faster on the GPU whereas the loss is often (depending on your
-    # hyperparameters) faster on the CPU.
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    # FIXME: currently, the gradient is None if loss_device is cuda
-    loss_device = torch.device("cpu")
+    # but now that the loss is vectorized, it is faster on the same device as the forward pass.
+    if torch.cuda.is_available():
+        device = torch.device("cuda", int(os.environ.get("LOCAL_RANK", 0)) if distributed else 0)
+    else:
+        device = torch.device("cpu")
+    loss_device = device
     
     # Create the model and the optimizer
     model = SpeakerEncoder(device, loss_device)
@@ -41,85 +96,138 @@ def train(run_id: str, clean_data_root: Path, models_dir: Path, umap_every: int,
     state_fpath = models_dir.joinpath(run_id + ".pt")
     backup_dir = models_dir.joinpath(run_id + "_backups")
 
+    # Only the rank 0 process logs, saves the model and updates the visualizations
+    log = print if is_main else lambda *args, **kwargs: None
+    
     # Load any existing model
     if not force_restart:
         if state_fpath.exists():
-            print("Found existing model \"%s\", loading it and resuming training." % run_id)
-            checkpoint = torch.load(state_fpath)
+            log("Found existing model \"%s\", loading it and resuming training." % run_id)
+            checkpoint = torch.load(state_fpath, map_location=device)
             init_step = checkpoint["step"]
             model.load_state_dict(checkpoint["model_state"])
             optimizer.load_state_dict(checkpoint["optimizer_state"])
             optimizer.param_groups[0]["lr"] = learning_rate_init
+            if "dataset_state" in checkpoint:
+                # Distributed trainings save the states of the datasets of all processes
+                dataset_state = checkpoint["dataset_state"]
+                if isinstance(dataset_state, list):
+                    dataset_state = dataset_state[rank] if len(dataset_state) == world_size \
+                        else None
+                elif world_size != 1:
+                    dataset_state = None
+                if dataset_state is not None and dataset.load_state_dict(dataset_state):
+                    log("Resuming the cycle over the speakers.")
+                else:
+                    log("The speakers changed since the model was saved, starting a new cycle "
+                        "over the speakers.")
         else:
-            print("No model \"%s\" found, starting training from scratch." % run_id)
+            log("No model \"%s\" found, starting training from scratch." % run_id)
     else:
-        print("Starting the training from scratch.")
+        log("Starting the training from scratch.")
     model.train()
     
+    # Start all processes from the same weights
+    if distributed:
+        for tensor in model.state_dict().values():
+            dist.broadcast(tensor, src=0)
+    
     # Initialize the visualization environment
-    vis = Visualizations(run_id, vis_every, server=visdom_server, disabled=no_visdom)
+    vis = Visualizations(run_id, vis_every, server=visdom_server, 
+                         disabled=no_visdom or not is_main)
     vis.log_dataset(dataset)
     vis.log_params()
     device_name = str(torch.cuda.get_device_name(0) if torch.cuda.is_available() else "CPU")
+    if distributed:
+        device_name += " x %d processes (%s)" % (world_size, dist_backend)
     vis.log_implementation({"Device": device_name})
     
+    # The EER is computed every <eer_every> steps, over the similarity matrices of the last 
+    # <eer_window> batches
+    eer_buffer = deque(maxlen=eer_window)
+    
+    # Checkpoints are written in the background: the training only waits for the copy of the 
+    # state to the CPU memory
+    checkpoint_writer = AsyncCheckpointWriter()
+    
     # Training loop
-    profiler = Profiler(summarize_every=10, disabled=False)
+    # CUDA operations are asynchronous, so the profiler waits for them to complete before each 
+    # measure to attribute their time to the right part
+    sync_fn = (lambda: torch.cuda.synchronize(device)) if device.type == "cuda" else None
+    profiler = Profiler(summarize_every=10, disabled=not is_main, sync_fn=sync_fn)
     for step, speaker_batch in enumerate(loader, init_step):
         profiler.tick("Blocking, waiting for batch (threaded)")
         
         # Forward pass
         inputs = torch.from_numpy(speaker_batch.data).to(device)
-        sync(device)
         profiler.tick("Data to %s" % device)
         embeds = model(inputs)
-        sync(device)
         profiler.tick("Forward pass")
-        embeds_loss = embeds.view((speakers_per_batch, utterances_per_speaker, -1)).to(loss_device)
-        loss, eer = model.loss(embeds_loss)
-        sync(loss_device)
+        embeds = embeds.view((local_speakers_per_batch, utterances_per_speaker, -1))
+        if distributed:
+            embeds = all_gather_embeds(embeds)
+            profiler.tick("Gather embeddings")
+        embeds_loss = embeds.to(loss_device)
+        compute_eer = eer_every != 0 and step % eer_every == 0
+        loss, eer = model.loss(embeds_loss, compute_eer, eer_buffer if eer_window > 1 else None)
         profiler.tick("Loss")
 
         # Backward pass
         model.zero_grad()
         loss.backward()
         profiler.tick("Backward pass")
+        if distributed:
+            all_reduce_gradients(model)
+            profiler.tick("Reduce gradients")
         model.do_gradient_ops()
         optimizer.step()
         profiler.tick("Parameter update")
         
         # Update visualizations
         # learning_rate = optimizer.param_groups[0]["lr"]
-        vis.update(loss.item(), eer, step)
+        if is_main:
+            vis.update(loss.item(), eer, step)
+        if isinstance(loader, SpeakerPoolDataLoader) and step % vis_every == 0:
+            log(loader.log_string())
         
         # Draw projections and save them to the backup folder
-        if umap_every != 0 and step % umap_every == 0:
+        if is_main and umap_every != 0 and step % umap_every == 0:
             print("Drawing and saving projections (step %d)" % step)
             backup_dir.mkdir(exist_ok=True)
             projection_fpath = backup_dir.joinpath("%s_umap_%06d.png" % (run_id, step))
-            embeds = embeds.detach().cpu().numpy()
+            embeds = embeds.detach().cpu().numpy().reshape(-1, embeds.shape[-1])
             vis.draw_projections(embeds, utterances_per_speaker, step, projection_fpath)
             vis.save()
 
-        # Overwrite the latest version of the model
-        if save_every != 0 and step % save_every == 0:
-            print("Saving the model (step %d)" % step)
-            torch.save({
+        # Gather the training state. The states of the datasets of all processes are saved, so that 
+        # each process resumes its own cycle over its speakers.
+        save = save_every != 0 and step % save_every == 0
+        backup = backup_every != 0 and step % backup_every == 0
+        if save or backup:
+            if distributed:
+                dataset_state = [None] * world_size
+                dist.all_gather_object(dataset_state, dataset.state_dict())
+            else:
+                dataset_state = dataset.state_dict()
+            checkpoint = {
                 "step": step + 1,
                 "model_state": model.state_dict(),
                 "optimizer_state": optimizer.state_dict(),
-            }, state_fpath)
+                "dataset_state": dataset_state,
+            }
+        # Overwrite the latest version of the model
+        if is_main and save:
+            print("Saving the model (step %d)" % step)
+            checkpoint_writer.save(checkpoint, state_fpath, key=step)
+            if profile_fpath is not None:
+                profiler.export(profile_fpath)
             
         # Make a backup
-        if backup_every != 0 and step % backup_every == 0:
+        if is_main and backup:
             print("Making a backup (step %d)" % step)
             backup_dir.mkdir(exist_ok=True)
             backup_fpath = backup_dir.joinpath("%s_bak_%06d.pt" % (run_id, step))
-            torch.save({
-                "step": step + 1,
-                "model_state": model.state_dict(),
-                "optimizer_state": optimizer.state_dict(),
-            }, backup_fpath)
+            checkpoint_writer.save(checkpoint, backup_fpath, key=step)
             
         profiler.tick("Extras (visualizations, saving)")
         
\ No newline at end of file
@@ -105,7 +105,8 @@ class Visualizations:
         self.step_times.append(1000 * (now - self.last_update_timestamp))
         self.last_update_timestamp = now
         self.losses.append(loss)
-        self.eers.append(eer)
+        if eer is not None:
+            self.eers.append(eer)
         print(".", end="")
         
         # Update the plots every <update_every> steps
@@ -113,8 +114,9 @@ class Visualizations:
             return
         time_string = "Step time:  mean: %5dms  std: %5dms" % \
                       (int(np.mean(self.step_times)), int(np.std(self.step_times)))
-        print("\nStep %6d   Loss: %.4f   EER: %.4f   %s" %
-              (step, np.mean(self.losses), np.mean(self.eers), time_string))
+        eer_string = "%.4f" % np.mean(self.eers) if self.eers else "   n/a"
+        print("\nStep %6d   Loss: %.4f   EER: %s   %s" %
+              (step, np.mean(self.losses), eer_string, time_string))
         if not self.disabled:
             self.loss_win = self.vis.line(
                 [np.mean(self.losses)],
@@ -128,18 +130,19 @@ class Visualizations:
                     title="Loss",
                 )
             )
-            self.eer_win = self.vis.line(
-                [np.mean(self.eers)],
-                [step],
-                win=self.eer_win,
-                update="append" if self.eer_win else None,
-                opts=dict(
-                    legend=["Avg. EER"],
-                    xlabel="Step",
-                    ylabel="EER",
-                    title="Equal error rate"
+            if self.eers:
+                self.eer_win = self.vis.line(
+                    [np.mean(self.eers)],
+                    [step],
+                    win=self.eer_win,
+                    update="append" if self.eer_win else None,
+                    opts=dict(
+                        legend=["Avg. EER"],
+                        xlabel="Step",
+                        ylabel="EER",
+                        title="Equal error rate"
+                    )
                 )
-            )
             if self.implementation_win is not None:
                 self.vis.text(
                     self.implementation_string + ("<b>%s</b>" % time_string), 
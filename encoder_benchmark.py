@@ -0,0 +1,59 @@
+from encoder.benchmark import load_wavs, benchmark_vad, benchmark_inference, benchmark_loss, \
+    benchmark_eer
+from utils.argutils import print_args
+from pathlib import Path
+import argparse
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks parts of the encoder pipeline on audio files, or on synthetic "
+                    "audio if none are given.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("audio_paths", type=Path, nargs="*", help=\
+        "Paths to audio files or to directories containing audio files to benchmark on.")
+    parser.add_argument("-t", "--tests", type=str, default="vad", help=\
+        "Comma-separated list of the benchmarks to run. Possible names: vad, inference, loss, "
+        "eer.")
+    parser.add_argument("-n", "--n_repeats", type=int, default=5, help=\
+        "Number of times each benchmark is repeated.")
+    parser.add_argument("-e", "--enc_model_fpath", type=Path, 
+                        default="encoder/saved_models/pretrained.pt", help=\
+        "Path to the saved encoder for the inference benchmark.")
+    parser.add_argument("--device", type=str, default="cpu", help=\
+        "Device to run the inference, loss and EER benchmarks on. Quantized variants only run on "
+        "the CPU.")
+    parser.add_argument("--variants", type=str, default="fp32,jit,int8,int8+jit", help=\
+        "Comma-separated list of the encoder variants to compare in the inference benchmark. "
+        "Possible names: fp32, jit, int8, int8+jit.")
+    parser.add_argument("--loss_shapes", type=str, default="64x10,128x10,256x10", help=\
+        "Comma-separated list of the <speakers_per_batch>x<utterances_per_speaker> batch shapes "
+        "of the loss and EER benchmarks.")
+    parser.add_argument("--extensions", type=str, default="wav,flac,mp3", help=\
+        "Comma-separated list of the extensions of the audio files searched in directories.")
+    args = parser.parse_args()
+    print_args(args, parser)
+    
+    # Gather the audio files
+    fpaths = []
+    for path in args.audio_paths:
+        if path.is_dir():
+            for extension in args.extensions.split(","):
+                fpaths.extend(sorted(path.glob("**/*.%s" % extension)))
+        else:
+            fpaths.append(path)
+    wavs = load_wavs(fpaths)
+    loss_shapes = [tuple(map(int, shape.split("x"))) for shape in args.loss_shapes.split(",")]
+    
+    # Run the benchmarks
+    benchmarks = {
+        "vad": lambda: benchmark_vad(wavs, args.n_repeats),
+        "inference": lambda: benchmark_inference(args.enc_model_fpath, wavs, args.n_repeats, 
+                                                 args.device, args.variants.split(",")),
+        "loss": lambda: benchmark_loss(loss_shapes, args.n_repeats, args.device),
+        "eer": lambda: benchmark_eer(loss_shapes, args.n_repeats, args.device),
+    }
+    for test in args.tests.split(","):
+        print("Running the %s benchmark" % test)
+        benchmarks[test]()
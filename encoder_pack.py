@@ -0,0 +1,26 @@
+from encoder.preprocess import pack_dataset
+from utils.argutils import print_args
+from pathlib import Path
+import argparse
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Packs the mel spectrograms of each speaker of the preprocessed encoder "
+                    "datasets in a single memory-mapped file. The training reads partial "
+                    "utterances from these files instead of opening one file per utterance. "
+                    "Speakers that are not packed are still read from their utterance files.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("clean_data_root", type=Path, help= \
+        "Path to the output directory of encoder_preprocess.py. If you left the default "
+        "output directory when preprocessing, it should be <datasets_root>/SV2TTS/encoder/.")
+    parser.add_argument("-r", "--remove_unpacked", action="store_true", help=\
+        "Whether to delete the mel spectrogram file of each utterance once packed.")
+    parser.add_argument("-n", "--n_processes", type=int, default=None, help=\
+        "Number of speakers packed in parallel. If left out, defaults to the number of CPU "
+        "cores.")
+    args = parser.parse_args()
+    
+    print_args(args, parser)
+    pack_dataset(**vars(args))
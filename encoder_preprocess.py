@@ -1,4 +1,5 @@
-from encoder.preprocess import preprocess_librispeech, preprocess_voxceleb1, preprocess_voxceleb2
+from encoder.preprocess import preprocess_librispeech, preprocess_voxceleb1, preprocess_voxceleb2, \
+    pack_dataset
 from utils.argutils import print_args
 from pathlib import Path
 import argparse
@@ -37,6 +38,17 @@ if __name__ == "__main__":
     parser.add_argument("-s", "--skip_existing", action="store_true", help=\
         "Whether to skip existing output files with the same name. Useful if this script was "
         "interrupted.")
+    parser.add_argument("-n", "--n_processes", type=int, default=None, help=\
+        "Number of processes to preprocess the utterances in parallel. If left out, defaults to "
+        "the number of CPU cores.")
+    parser.add_argument("--mel_storage", type=str, default="float32", 
+                        choices=["float32", "float16"], help=\
+        "Type the mel spectrograms are stored in. float16 halves the size of the dataset on the "
+        "disk and the data read during training. Use mel_storage_report.py to measure the "
+        "error.")
+    parser.add_argument("--pack", action="store_true", help=\
+        "Whether to pack the mel spectrograms of each speaker in a single memory-mapped file "
+        "after preprocessing, which speeds up training. See encoder_pack.py.")
     args = parser.parse_args()
 
     # Process the arguments
@@ -54,6 +66,11 @@ if __name__ == "__main__":
         "voxceleb2": preprocess_voxceleb2,
     }
     args = vars(args)
+    pack = args.pop("pack")
     for dataset in args.pop("datasets"):
         print("Preprocessing %s" % dataset)
         preprocess_func[dataset](**args)
+    
+    # Pack the utterances of each speaker
+    if pack:
+        pack_dataset(args["out_dir"], n_processes=args["n_processes"])
@@ -31,8 +31,42 @@ if __name__ == "__main__":
     parser.add_argument("-b", "--backup_every", type=int, default=7500, help= \
         "Number of steps between backups of the model. Set to 0 to never make backups of the "
         "model.")
+    parser.add_argument("-e", "--eer_every", type=int, default=10, help= \
+        "Number of steps between computations of the equal error rate. Set to 0 to never "
+        "compute it.")
+    parser.add_argument("--eer_window", type=int, default=10, help= \
+        "Number of most recent batches over which the equal error rate is computed.")
+    parser.add_argument("-p", "--pool_size", type=int, default=0, help= \
+        "Number of speakers kept in memory to draw batches from, see SpeakerPoolDataLoader, e.g. "
+        "256. By default (0), every batch is read from the disk. The pool reads fewer "
+        "utterances per batch, but it changes the sampling: each speaker of the pool is used "
+        "in --batches_per_speaker batches, from --utterances_per_load utterances.")
+    parser.add_argument("--pool_memory", type=float, default=2, help= \
+        "Maximum size in GB of the frames kept in memory by the speaker pool, if enabled with "
+        "--pool_size.")
+    parser.add_argument("--utterances_per_load", type=int, default=20, help= \
+        "Number of utterances loaded in memory per speaker of the pool.")
+    parser.add_argument("--batches_per_speaker", type=int, default=8, help= \
+        "Number of batches a speaker of the pool is used in before being replaced.")
+    parser.add_argument("-w", "--dataset_weights", type=str, default=None, help= \
+        "Comma-separated list of <dataset>=<weight> pairs giving the relative frequency of the "
+        "speakers of each dataset in the batches, e.g. \"LibriSpeech=1,VoxCeleb1=0.5\". A "
+        "dataset is matched by the start of the names of the speaker directories. Unlisted "
+        "datasets have a weight of 1. By default, all speakers are equally frequent.")
     parser.add_argument("-f", "--force_restart", action="store_true", help= \
         "Do not load any saved model.")
+    parser.add_argument("--distributed", action="store_true", help= \
+        "Train with several processes, on one or several machines. Launch the script with "
+        "torchrun, e.g. \"torchrun --nproc_per_node=4 encoder_train.py <args> --distributed\". "
+        "Each process draws its share of the speakers of the batch from its own subset of the "
+        "speakers.")
+    parser.add_argument("--dist_backend", type=str, default="gloo", help= \
+        "Backend of torch.distributed for the distributed training. gloo runs on CPUs and GPUs, "
+        "nccl on GPUs only.")
+    parser.add_argument("--profile_fpath", type=Path, default=None, help= \
+        "Path to a .json file to which the timings of the training loop are exported in the "
+        "Chrome trace format every time the model is saved. Statistics of the timings are "
+        "written next to it with the _stats.json suffix.")
     parser.add_argument("--visdom_server", type=str, default="http://localhost")
     parser.add_argument("--no_visdom", action="store_true", help= \
         "Disable visdom.")
@@ -40,6 +74,9 @@ if __name__ == "__main__":
     
     # Process the arguments
     args.models_dir.mkdir(exist_ok=True)
+    if args.dataset_weights is not None:
+        dataset_weights = [pair.split("=") for pair in args.dataset_weights.split(",")]
+        args.dataset_weights = {name: float(weight) for name, weight in dataset_weights}
     
     # Run the training
     print_args(args, parser)
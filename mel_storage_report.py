@@ -0,0 +1,57 @@
+from utils.mel_storage import storage_types, storage_error
+from utils.argutils import print_args
+from pathlib import Path
+import numpy as np
+import argparse
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Reports the size and the error of the mel spectrograms of a dataset in each "
+                    "storage type (see utils/mel_storage.py), to choose the --mel_storage of "
+                    "encoder_preprocess.py or the mel_storage hparam of the synthesizer. The "
+                    "spectrograms must have been stored in float32.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("mel_dirs", type=Path, nargs="+", help=\
+        "Directories of mel spectrograms (.npy files), searched recursively: e.g. "
+        "<datasets_root>/SV2TTS/encoder/, <datasets_root>/SV2TTS/synthesizer/mels/ or "
+        "<datasets_root>/SV2TTS/vocoder/mels_gta/.")
+    parser.add_argument("-n", "--n_files", type=int, default=500, help=\
+        "Number of files sampled at random. Use 0 to measure all of them.")
+    parser.add_argument("--storage", type=str, default=",".join(storage_types[1:]), help=\
+        "Comma-separated list of the storage types to measure.")
+    parser.add_argument("--seed", type=int, default=0, help=\
+        "Seed of the sampling of the files.")
+    args = parser.parse_args()
+    print_args(args, parser)
+
+    # Gather the spectrograms, leaving out the packed files of the encoder
+    fpaths = sorted(fpath for mel_dir in args.mel_dirs for fpath in mel_dir.glob("**/*.npy")
+                    if not fpath.name.startswith("_"))
+    if args.n_files and len(fpaths) > args.n_files:
+        rng = np.random.RandomState(args.seed)
+        fpaths = [fpaths[i] for i in sorted(rng.choice(len(fpaths), args.n_files, False))]
+    mels = [np.load(fpath) for fpath in fpaths]
+    n_skipped = sum(mel.dtype != np.float32 or mel.ndim != 2 for mel in mels)
+    mels = [mel for mel in mels if mel.dtype == np.float32 and mel.ndim == 2]
+    if not mels:
+        raise Exception("No mel spectrograms stored in float32 found in %s" % args.mel_dirs)
+    if n_skipped:
+        print("Skipped %d files that are not mel spectrograms stored in float32." % n_skipped)
+    all_values = np.concatenate([mel.ravel() for mel in mels])
+    print("Measuring %d spectrograms (%d frames of %d channels), values in [%.3g, %.3g].\n" %
+          (len(mels), sum(map(len, mels)), mels[0].shape[1], all_values.min(),
+           all_values.max()))
+
+    # The errors are the mean of the utterances, except the maximum error
+    print("%-8s  %6s  %14s  %14s  %17s  %8s" % ("storage", "size", "max abs error",
+                                             "mean abs error", "p99 max abs error", "SNR (dB)"))
+    for storage in args.storage.split(","):
+        errors = [storage_error(mel, storage) for mel in mels]
+        max_errors = [e["max_abs_error"] for e in errors]
+        snrs = np.array([e["snr_db"] for e in errors])
+        print("%-8s  %5.1f%%  %14.3g  %14.3g  %17.3g  %8.1f" % (
+            storage, 100 * np.mean([e["bytes_ratio"] for e in errors]), np.max(max_errors),
+            np.mean([e["mean_abs_error"] for e in errors]), np.percentile(max_errors, 99),
+            np.mean(snrs[np.isfinite(snrs)]) if np.isfinite(snrs).any() else np.inf))
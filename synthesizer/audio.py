@@ -4,6 +4,7 @@ import numpy as np
 import tensorflow as tf
 from scipy import signal
 from scipy.io import wavfile
+from utils import spectrogram
 
 
 def load_wav(path, sr):
@@ -49,19 +50,33 @@ def get_hop_size(hparams):
     return hop_size
 
 def linearspectrogram(wav, hparams):
-    D = _stft(preemphasis(wav, hparams.preemphasis, hparams.preemphasize), hparams)
-    S = _amp_to_db(np.abs(D), hparams) - hparams.ref_level_db
+    wav = preemphasis(wav, hparams.preemphasis, hparams.preemphasize)
+    if hparams.use_lws:
+        magnitudes = np.abs(_stft(wav, hparams))
+    else:
+        magnitudes = _mel_engine(hparams).magnitudes([wav])[0]
+    S = _amp_to_db(magnitudes, hparams) - hparams.ref_level_db
     
     if hparams.signal_normalization:
         return _normalize(S, hparams)
     return S
 
 def melspectrogram(wav, hparams):
-    D = _stft(preemphasis(wav, hparams.preemphasis, hparams.preemphasize), hparams)
-    S = _amp_to_db(_linear_to_mel(np.abs(D), hparams), hparams) - hparams.ref_level_db
+    return melspectrograms([wav], hparams)[0]
+
+def melspectrograms(wavs, hparams):
+    """Computes the mel spectrograms of several waveforms at once. Without lws, the STFTs of all 
+    waveforms are batched together, which is faster than calling melspectrogram() on each one.
+    """
+    wavs = [preemphasis(wav, hparams.preemphasis, hparams.preemphasize) for wav in wavs]
+    if hparams.use_lws:
+        mels = [_linear_to_mel(np.abs(_stft(wav, hparams)), hparams) for wav in wavs]
+    else:
+        mels = _mel_engine(hparams).mels(wavs)
     
+    S = [_amp_to_db(mel, hparams) - hparams.ref_level_db for mel in mels]
     if hparams.signal_normalization:
-        return _normalize(S, hparams)
+        return [_normalize(s, hparams) for s in S]
     return S
 
 def inv_linear_spectrogram(linear_spectrogram, hparams):
@@ -150,14 +165,15 @@ def librosa_pad_lr(x, fsize, fshift):
     return 0, (x.shape[0] // fshift + 1) * fshift - x.shape[0]
 
 # Conversions
-_mel_basis = None
 _inv_mel_basis = None
 
+def _mel_engine(hparams):
+    assert hparams.fmax <= hparams.sample_rate // 2
+    return spectrogram.get_engine(hparams.sample_rate, hparams.n_fft, get_hop_size(hparams), 
+                                  hparams.win_size, hparams.num_mels, hparams.fmin, hparams.fmax)
+
 def _linear_to_mel(spectogram, hparams):
-    global _mel_basis
-    if _mel_basis is None:
-        _mel_basis = _build_mel_basis(hparams)
-    return np.dot(_mel_basis, spectogram)
+    return np.dot(_mel_engine(hparams).mel_basis, spectogram)
 
 def _mel_to_linear(mel_spectrogram, hparams):
     global _inv_mel_basis
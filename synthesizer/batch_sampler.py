@@ -0,0 +1,103 @@
+from collections import deque
+import numpy as np
+
+
+def round_up(x, multiple):
+    return (x + multiple - 1) // multiple * multiple
+
+
+def frame_budget_batch_size(length, max_frames, outputs_per_step, num_gpus=1,
+                            max_batch_size=None):
+    """
+    Returns the largest number of examples of at most <length> mel frames that fit in a budget
+    of <max_frames> frames per GPU, once the examples of each GPU are padded to the same length,
+    rounded up to a multiple of <outputs_per_step>. The result is a multiple of <num_gpus>, and
+    at least <num_gpus> even if a single example exceeds the budget.
+
+    :param max_batch_size: an optional upper bound on the number of examples
+    """
+    per_device = max(1, max_frames // round_up(length, outputs_per_step))
+    if max_batch_size is not None:
+        per_device = min(per_device, max(1, max_batch_size // num_gpus))
+    return per_device * num_gpus
+
+
+class FrameBudgetSampler:
+    """
+    Groups the training examples in batches of similar lengths holding at most a given number of
+    padded mel frames per GPU, rather than a fixed number of examples: batches of short utterances
+    hold more of them and batches of long ones less, for the same memory use.
+
+    The lengths come from the metadata, so no file is read to form the batches. As in the Feeder,
+    the examples are visited in a random order that changes at each epoch, in groups that are
+    sorted by length and cut into batches, which are then shuffled. Examples left over at the end
+    of a group, too few to give one to each GPU, are batched with the next group.
+    """
+    def __init__(self, lengths, max_frames, outputs_per_step, num_gpus=1, max_batch_size=None,
+                 group_size=2048):
+        """
+        :param lengths: the number of mel frames of each example, i.e. m[4] of the metadata
+        :param max_frames: the budget of padded frames per GPU
+        :param outputs_per_step: the reduction factor, to which the lengths are rounded up
+        :param num_gpus: the number of GPUs the batches are split between. Each batch holds a
+        multiple of this number of examples.
+        :param max_batch_size: an optional upper bound on the number of examples of a batch
+        :param group_size: the number of examples sorted together
+        """
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_frames = max_frames
+        self.outputs_per_step = outputs_per_step
+        self.num_gpus = num_gpus
+        self.max_batch_size = max_batch_size
+        self.group_size = group_size
+        self._order = np.random.permutation(len(self.lengths))
+        self._offset = 0
+        self._leftover = []
+
+    def batch_size(self, length):
+        return frame_budget_batch_size(length, self.max_frames, self.outputs_per_step,
+                                       self.num_gpus, self.max_batch_size)
+
+    def padded_frames(self, batch):
+        """
+        Returns the number of frames per GPU of a batch once padded.
+        """
+        max_length = round_up(int(np.max(self.lengths[batch])), self.outputs_per_step)
+        return -(-len(batch) // self.num_gpus) * max_length
+
+    def _next_indices(self, count):
+        indices = []
+        while len(indices) < count:
+            if self._offset >= len(self._order):
+                self._order = np.random.permutation(len(self.lengths))
+                self._offset = 0
+            chunk = self._order[self._offset:self._offset + count - len(indices)]
+            self._offset += len(chunk)
+            indices.extend(chunk)
+        return indices
+
+    def next_group(self):
+        """
+        Returns the batches of the next group of examples, as lists of indices in <lengths>, in
+        random order.
+        """
+        indices = self._leftover + self._next_indices(self.group_size)
+        pending = deque(sorted(indices, key=lambda i: self.lengths[i]))
+
+        # The examples come by increasing length: a batch is full when the next example, the
+        # longest so far, would exceed the budget
+        batches = []
+        while True:
+            batch = []
+            while pending and (len(batch) < self.num_gpus or
+                               len(batch) < self.batch_size(self.lengths[pending[0]])):
+                batch.append(pending.popleft())
+            n_kept = len(batch) // self.num_gpus * self.num_gpus
+            if n_kept == 0:
+                break
+            pending.extendleft(reversed(batch[n_kept:]))
+            batches.append(batch[:n_kept])
+        self._leftover = batch
+
+        np.random.shuffle(batches)
+        return batches
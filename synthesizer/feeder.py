@@ -1,8 +1,13 @@
 from sklearn.model_selection import train_test_split
 from synthesizer.utils.text import text_to_sequence
+from synthesizer.batch_sampler import FrameBudgetSampler, frame_budget_batch_size
+from synthesizer.packed_dataset import PackedDataset
 from synthesizer.infolog import log
+from utils.mel_storage import load_mel
+from utils.memory_cache import MemoryCache
 import tensorflow as tf
 import numpy as np
+import itertools
 import threading
 import time
 import os
@@ -22,14 +27,23 @@ class Feeder:
 		self._train_offset = 0
 		self._test_offset = 0
 
-		# Load metadata
+		# Load metadata, from the packed dataset if there is one (see synthesizer_pack.py)
 		self._mel_dir = os.path.join(os.path.dirname(metadata_filename), "mels")
 		self._embed_dir = os.path.join(os.path.dirname(metadata_filename), "embeds")
-		with open(metadata_filename, encoding="utf-8") as f:
-			self._metadata = [line.strip().split("|") for line in f]
-			frame_shift_ms = hparams.hop_size / hparams.sample_rate
-			hours = sum([int(x[4]) for x in self._metadata]) * frame_shift_ms / (3600)
-			log("Loaded metadata for {} examples ({:.2f} hours)".format(len(self._metadata), hours))
+		pack_dir = os.path.join(os.path.dirname(metadata_filename), "packed")
+		self._packed = None
+		if PackedDataset.exists(pack_dir):
+			log("Using the packed dataset at {}".format(pack_dir))
+			self._packed = PackedDataset(pack_dir)
+			self._metadata = [self._packed.metadata(i) for i in range(len(self._packed))]
+			self._packed_rows = {meta[1]: i for i, meta in enumerate(self._metadata)}
+			self._packed_tokens = self._packed.cleaners == hparams.cleaners
+		else:
+			with open(metadata_filename, encoding="utf-8") as f:
+				self._metadata = [line.strip().split("|") for line in f]
+		frame_shift_ms = hparams.hop_size / hparams.sample_rate
+		hours = sum([int(x[4]) for x in self._metadata]) * frame_shift_ms / (3600)
+		log("Loaded metadata for {} examples ({:.2f} hours)".format(len(self._metadata), hours))
 
 		#Train test split
 		if hparams.tacotron_test_size is None:
@@ -66,6 +80,27 @@ class Feeder:
 		#Mark finished sequences with 1s
 		self._token_pad = 1.
 
+		#Token ids of the texts, computed once
+		if self._packed is None or not self._packed_tokens:
+			self._compute_tokens()
+
+		#Cache of the loaded training examples, whose hit rate is logged about once per epoch
+		self._cache = None
+		if hparams.tacotron_cache_mb:
+			self._cache = MemoryCache(hparams.tacotron_cache_mb * 2 ** 20)
+			self._n_loaded = itertools.count(1)
+
+		#Batches of a budget of frames rather than of a fixed size, formed from the lengths of the metadata
+		self._sampler = None
+		if hparams.tacotron_batch_frames is not None:
+			self._sampler = FrameBudgetSampler([int(m[4]) for m in self._train_meta],
+				hparams.tacotron_batch_frames, hparams.outputs_per_step, hparams.tacotron_num_gpus,
+				hparams.tacotron_max_batch_size, hparams.tacotron_batch_size * _batches_per_group)
+
+		self._create_inputs()
+
+	def _create_inputs(self):
+		hparams = self._hparams
 		with tf.device("/cpu:0"):
 			# Create placeholders for inputs and targets. Don"t specify batch size because we want
 			# to be able to feed different batch sizes at eval time.
@@ -130,14 +165,7 @@ class Feeder:
 		meta = self._test_meta[self._test_offset]
 		self._test_offset += 1
 
-		text = meta[5]
-
-		input_data = np.asarray(text_to_sequence(text, self._cleaner_names), dtype=np.int32)
-		mel_target = np.load(os.path.join(self._mel_dir, meta[1]))
-		#Create parallel sequences containing zeros to represent a non finished sequence
-		token_target = np.asarray([0.] * (len(mel_target) - 1))
-		embed_target = np.load(os.path.join(self._embed_dir, meta[2]))
-		return input_data, mel_target, token_target, embed_target, len(mel_target)
+		return self._load_example(meta, cache=False)
 	
 	def make_test_batches(self):
 		start = time.time()
@@ -164,14 +192,19 @@ class Feeder:
 			# Read a group of examples
 			n = self._hparams.tacotron_batch_size
 			r = self._hparams.outputs_per_step
-			examples = [self._get_next_example() for i in range(n * _batches_per_group)]
-
-			# Bucket examples based on similar output sequence length for efficiency
-			examples.sort(key=lambda x: x[-1])
-			batches = [examples[i: i+n] for i in range(0, len(examples), n)]
-			np.random.shuffle(batches)
-
-			log("\nGenerated {} train batches of size {} in {:.3f} sec".format(len(batches), n, time.time() - start))
+			if self._sampler is not None:
+				batches = [[self._load_example(self._train_meta[i]) for i in batch]
+						   for batch in self._sampler.next_group()]
+				n = np.mean([len(batch) for batch in batches])
+			else:
+				examples = [self._get_next_example() for i in range(n * _batches_per_group)]
+
+				# Bucket examples based on similar output sequence length for efficiency
+				examples.sort(key=lambda x: x[-1])
+				batches = [examples[i: i+n] for i in range(0, len(examples), n)]
+				np.random.shuffle(batches)
+
+			log("\nGenerated {} train batches of size {:.1f} in {:.3f} sec".format(len(batches), n, time.time() - start))
 			for batch in batches:
 				feed_dict = dict(zip(self._placeholders, self._prepare_batch(batch, r)))
 				self._session.run(self._enqueue_op, feed_dict=feed_dict)
@@ -194,13 +227,51 @@ class Feeder:
 		meta = self._train_meta[self._train_offset]
 		self._train_offset += 1
 
-		text = meta[5]
+		return self._load_example(meta)
 
-		input_data = np.asarray(text_to_sequence(text, self._cleaner_names), dtype=np.int32)
-		mel_target = np.load(os.path.join(self._mel_dir, meta[1]))
+	def _compute_tokens(self):
+		"""Computes the token ids of all texts, concatenated in a single array of the smallest integer type
+		"""
+		start = time.time()
+		sequences = [text_to_sequence(meta[5], self._cleaner_names) for meta in self._metadata]
+		lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+		max_id = max([max(sequence) for sequence in sequences if sequence] + [0])
+		self._token_ids = np.fromiter(itertools.chain.from_iterable(sequences),
+			dtype=np.min_scalar_type(max_id), count=int(np.sum(lengths)))
+		self._token_offsets = np.concatenate(([0], np.cumsum(lengths)))
+		self._token_rows = {meta[1]: i for i, meta in enumerate(self._metadata)}
+		log("Computed the token ids of {} texts ({:.1f} MB) in {:.3f} sec".format(
+			len(sequences), self._token_ids.nbytes / 2 ** 20, time.time() - start))
+
+	def _input_data(self, meta):
+		if self._packed is not None and self._packed_tokens:
+			return self._packed.tokens(self._packed_rows[meta[1]])
+		row = self._token_rows[meta[1]]
+		return self._token_ids[self._token_offsets[row]:self._token_offsets[row + 1]].astype(np.int32)
+
+	def _load_targets(self, meta):
+		if self._packed is not None:
+			row = self._packed_rows[meta[1]]
+			return self._packed.mel(row), self._packed.embed(row)
+		return load_mel(os.path.join(self._mel_dir, meta[1])), \
+			np.load(os.path.join(self._embed_dir, meta[2]))
+
+	def _load_example(self, meta, cache=True):
+		"""Loads an example, from the cache of training examples if there is one and <cache>
+		"""
+		input_data = self._input_data(meta)
+		if not cache or self._cache is None:
+			mel_target, embed_target = self._load_targets(meta)
+		else:
+			targets = self._cache.get(meta[1])
+			if targets is None:
+				targets = self._load_targets(meta)
+				self._cache.put(meta[1], targets)
+			mel_target, embed_target = targets
+			if next(self._n_loaded) % len(self._train_meta) == 0:
+				log("\nExample cache: {}".format(self._cache.summary(reset=True)))
 		#Create parallel sequences containing zeros to represent a non finished sequence
 		token_target = np.asarray([0.] * (len(mel_target) - 1))
-		embed_target = np.load(os.path.join(self._embed_dir, meta[2]))
 		return input_data, mel_target, token_target, embed_target, len(mel_target)
 
 	def _prepare_batch(self, batches, outputs_per_step):
@@ -270,3 +341,140 @@ class Feeder:
 	def _round_down(self, x, multiple):
 		remainder = x % multiple
 		return x if remainder == 0 else x - remainder
+
+
+class DatasetFeeder(Feeder):
+	"""
+		Feeds the same batches as Feeder with a tf.data pipeline instead of a Python thread: the
+		examples are loaded by parallel calls, grouped in buckets of similar mel spectrogram length,
+		padded, split between the GPUs and prefetched. The knobs are the tacotron_num_parallel_calls,
+		tacotron_num_buckets and tacotron_prefetch_batches hparams. With tacotron_batch_frames, the
+		batches of each bucket hold as many examples as fit in the budget at the longest length of
+		the bucket.
+	"""
+
+	def _create_inputs(self):
+		hparams = self._hparams
+		assert hparams.tacotron_batch_size % hparams.tacotron_num_gpus == 0
+		with tf.device("/cpu:0"):
+			train_dataset = self._example_dataset(self._train_meta, shuffle=True)
+			lengths = [int(m[4]) for m in self._train_meta]
+			quantiles = np.linspace(0, 100, hparams.tacotron_num_buckets + 1)[1:-1]
+			boundaries = sorted(set(int(b) for b in np.percentile(lengths, quantiles)) - {0})
+			if hparams.tacotron_batch_frames is not None:
+				batch_sizes = [frame_budget_batch_size(length, hparams.tacotron_batch_frames,
+					hparams.outputs_per_step, hparams.tacotron_num_gpus, hparams.tacotron_max_batch_size)
+					for length in [b - 1 for b in boundaries] + [max(lengths)]]
+			else:
+				batch_sizes = [hparams.tacotron_batch_size] * (len(boundaries) + 1)
+			train_dataset = train_dataset.apply(_bucket_by_sequence_length()(
+				element_length_func=lambda *example: example[4],
+				bucket_boundaries=boundaries,
+				bucket_batch_sizes=batch_sizes,
+				padded_shapes=self._padded_shapes(),
+				padding_values=self._padding_values()))
+			train_dataset = train_dataset.map(self._split_batch,
+				num_parallel_calls=hparams.tacotron_num_parallel_calls)
+			train_dataset = train_dataset.prefetch(hparams.tacotron_prefetch_batches)
+
+			# The test batches are the same as those of Feeder.make_test_batches(), created once
+			n = hparams.tacotron_batch_size
+			order = sorted(range(len(self._test_meta)), key=lambda i: int(self._test_meta[i][4]))
+			batches = [order[i: i+n] for i in range(0, len(order), n)]
+			np.random.shuffle(batches)
+			test_meta = [self._test_meta[i] for batch in batches for i in batch]
+			test_dataset = self._example_dataset(test_meta, shuffle=False)
+			test_dataset = test_dataset.padded_batch(n, self._padded_shapes(), self._padding_values())
+			test_dataset = test_dataset.map(self._split_batch).cache().repeat().prefetch(1)
+
+			self._train_iterator = train_dataset.make_initializable_iterator()
+			self._test_iterator = test_dataset.make_initializable_iterator()
+			self.inputs, self.input_lengths, self.mel_targets, self.token_targets, \
+				self.targets_lengths, self.split_infos, self.speaker_embeddings = \
+				self._train_iterator.get_next()
+			self.eval_inputs, self.eval_input_lengths, self.eval_mel_targets, \
+				self.eval_token_targets, self.eval_targets_lengths, \
+				self.eval_split_infos, self.eval_speaker_embeddings = self._test_iterator.get_next()
+
+	def start_threads(self, session):
+		self._session = session
+		session.run([self._train_iterator.initializer, self._test_iterator.initializer])
+
+	def _example_dataset(self, metadata, shuffle):
+		"""
+			Creates a dataset of the examples of <metadata> (input, input_length, mel_target,
+			token_target, mel_length, embed_target), loaded in parallel. If <shuffle>, the examples
+			are repeated indefinitely in a new random order at each epoch.
+		"""
+		hparams = self._hparams
+
+		def load(i):
+			input_data, mel_target, _, embed_target, _ = self._load_example(metadata[i], cache=shuffle)
+			return input_data, mel_target.astype(np.float32), embed_target.astype(np.float32)
+
+		def load_example(i):
+			input_data, mel_target, embed_target = tf.py_func(load, [i],
+				[tf.int32, tf.float32, tf.float32], stateful=False)
+			input_data.set_shape([None])
+			mel_target.set_shape([None, hparams.num_mels])
+			embed_target.set_shape([hparams.speaker_embedding_size])
+			mel_length = tf.shape(mel_target)[0]
+			#Zeros represent a non finished sequence
+			token_target = tf.zeros([mel_length - 1], dtype=tf.float32)
+			return input_data, tf.shape(input_data)[0], mel_target, token_target, mel_length, \
+				embed_target
+
+		dataset = tf.data.Dataset.range(len(metadata))
+		if shuffle:
+			dataset = dataset.shuffle(len(metadata), reshuffle_each_iteration=True).repeat()
+		return dataset.map(load_example, num_parallel_calls=hparams.tacotron_num_parallel_calls)
+
+	def _padded_shapes(self):
+		return ([None], [], [None, self._hparams.num_mels], [None], [],
+				[self._hparams.speaker_embedding_size])
+
+	def _padding_values(self):
+		return (tf.constant(self._pad, tf.int32), tf.constant(0, tf.int32),
+				tf.constant(self._target_pad, tf.float32), tf.constant(self._token_pad, tf.float32),
+				tf.constant(0, tf.int32), tf.constant(0., tf.float32))
+
+	def _split_batch(self, inputs, input_lengths, mel_targets, token_targets, targets_lengths,
+					 embed_targets):
+		"""
+			Lays out a padded batch as Feeder._prepare_batch() does: the examples of each GPU are
+			padded to their own maximum lengths, rounded up to a multiple of outputs_per_step for
+			the targets, and concatenated on the time axis. Their lengths are given in split_infos.
+		"""
+		r = self._hparams.outputs_per_step
+		n_gpus = self._hparams.tacotron_num_gpus
+		round_up = lambda x: (x + r - 1) // r * r
+
+		#Pad the targets of the batch so that those of each GPU can be cut to a multiple of r
+		data_len = round_up(tf.shape(mel_targets)[1])
+		mel_targets = tf.pad(mel_targets, [[0, 0], [0, data_len - tf.shape(mel_targets)[1]], [0, 0]],
+							 constant_values=self._target_pad)
+		token_targets = tf.pad(token_targets, [[0, 0], [0, data_len - tf.shape(token_targets)[1]]],
+							   constant_values=self._token_pad)
+
+		size_per_device = tf.shape(inputs)[0] // n_gpus
+		device_inputs, device_mel_targets, device_token_targets, split_infos = [], [], [], []
+		for i in range(n_gpus):
+			start, end = size_per_device * i, size_per_device * (i + 1)
+			input_max_len = tf.reduce_max(input_lengths[start:end])
+			target_max_len = round_up(tf.reduce_max(targets_lengths[start:end]))
+			device_inputs.append(inputs[start:end, :input_max_len])
+			device_mel_targets.append(mel_targets[start:end, :target_max_len])
+			device_token_targets.append(token_targets[start:end, :target_max_len])
+			split_infos.append(tf.stack([input_max_len, target_max_len, target_max_len]))
+
+		return tf.concat(device_inputs, axis=1), input_lengths, \
+			tf.concat(device_mel_targets, axis=1), tf.concat(device_token_targets, axis=1), \
+			targets_lengths, tf.stack(split_infos), embed_targets
+
+
+def _bucket_by_sequence_length():
+	try:
+		return tf.data.experimental.bucket_by_sequence_length
+	except AttributeError:
+		#Tensorflow < 1.13
+		return tf.contrib.data.bucket_by_sequence_length
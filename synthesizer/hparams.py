@@ -139,6 +139,13 @@ hparams = HParams(
     # whether to rescale to [0, 1] for wavenet. (better audio quality)
     clip_for_wavenet=True,
     # whether to clip [-max, max] before training/synthesizing with wavenet (better audio quality)
+    mel_storage="float32",
+    # Type the mel spectrograms of the dataset and the GTA spectrograms are stored in: "float32", 
+    # "float16" (half the size) or "uint8" (8-bit quantized, a quarter of the size). The error is 
+    # reported by mel_storage_report.py, see utils/mel_storage.py
+    audio_storage="float32",
+    # Type the waveforms of the dataset are stored in: "float32" or "int16" (16-bit PCM, half the 
+    # size), see utils/audio_storage.py
     
     # Contribution by @begeekmyfriend
     # Spectrogram Pre-Emphasis (Lfilter: Reduce spectrogram noise and helps model certitude 
@@ -251,6 +258,22 @@ hparams = HParams(
     # % of data to keep as test data, if None, tacotron_test_batches must be not None. (5% is 
 	# enough to have a good idea about overfit)
     tacotron_test_batches=None,  # number of test batches.
+    tacotron_batch_frames=None,
+    # If not None, the training batches hold as many examples as fit in this number of padded mel 
+    # frames per GPU instead of tacotron_batch_size examples (see synthesizer/batch_sampler.py). 
+    # The test batches keep tacotron_batch_size examples.
+    tacotron_max_batch_size=256,  # upper bound on the size of batches with tacotron_batch_frames
+    tacotron_cache_mb=0,
+    # Memory budget in MB of the cache of the loaded training examples (mel spectrograms and 
+    # embeddings). The examples that fit are read from the disk only once. 0 disables the cache.
+    
+    # Input pipeline
+    tacotron_input_pipeline="queue",
+    # "queue" to fill the input queue from a Python thread (synthesizer.feeder.Feeder), "tf.data" 
+    # to load, bucket and pad the batches with a parallel tf.data pipeline (DatasetFeeder)
+    tacotron_num_parallel_calls=8,  # number of examples loaded in parallel (tf.data only)
+    tacotron_num_buckets=16,  # number of buckets of similar mel lengths (tf.data only)
+    tacotron_prefetch_batches=4,  # number of batches prepared in advance (tf.data only)
     
     # Learning rate schedule
     tacotron_decay_learning_rate=True,
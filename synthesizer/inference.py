@@ -1,5 +1,6 @@
 from synthesizer.tacotron2 import Tacotron2
 from synthesizer.hparams import hparams
+from synthesizer.utils import chinese
 from multiprocess.pool import Pool  # You're free to use either one
 #from multiprocessing import Pool   # 
 from synthesizer import audio
@@ -63,7 +64,8 @@ class Synthesizer:
         """
         Synthesizes mel spectrograms from texts and speaker embeddings.
 
-        :param texts: a list of N text prompts to be synthesized
+        :param texts: a list of N text prompts to be synthesized, in hanzi or in pinyin with tone 
+        numbers. They are converted to pinyin tokens with synthesizer.utils.chinese.
         :param embeddings: a numpy array or list of speaker embeddings of shape (N, 256) 
         :param return_alignments: if True, a matrix representing the alignments between the 
         characters
@@ -71,6 +73,8 @@ class Synthesizer:
         :return: a list of N melspectrograms as numpy arrays of shape (80, Mi), where Mi is the 
         sequence length of spectrogram i, and possibly the alignments.
         """
+        texts = [" ".join(tokens) for tokens in chinese.batch_text_to_pinyin(texts)]
+        
         if not self._low_mem:
             # Usual inference mode: load the model on the first request and keep it loaded.
             if not self.is_loaded():
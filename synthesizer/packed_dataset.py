@@ -0,0 +1,348 @@
+from synthesizer.utils.text import text_to_sequence
+from utils.audio_storage import decode_audio, encode_audio
+from utils.mel_storage import decode_mel, encode_mel, storage_layout
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+from tqdm import tqdm
+import numpy as np
+import json
+import uuid
+import os
+
+
+# The arrays of a packed dataset, with the type of their elements. The mel spectrograms and the 
+# audio are packed in the type they are stored in instead, see utils.mel_storage and 
+# utils.audio_storage
+_fields = {
+    "mels": np.float32,
+    "audio": np.float32,
+    "embeds": np.float32,
+    "tokens": np.int32,
+    "texts": np.uint8,
+}
+
+
+def _index_dtype(fname_size):
+    columns = [(name, "S%d" % fname_size) for name in ("wav_fname", "mel_fname", "embed_fname")]
+    for field in _fields:
+        columns += [(field + "_offset", np.int64), (field + "_length", np.int64)]
+    return np.dtype(columns)
+
+
+class PackedDataset:
+    """
+    A synthesizer dataset packed in one memory-mapped array per field, instead of three .npy
+    files per utterance and the train.txt metadata. The directory of a packed dataset holds:
+        - mels.<version>.npy: the mel spectrograms of all utterances concatenated, of shape
+        (n_frames, num_mels), in any of the types of utils.mel_storage
+        - audio.<version>.npy: the waveforms concatenated, of shape (n_samples,), in float32 or
+        int16
+        - embeds.<version>.npy: the speaker embeddings, of shape (n_utterances,
+        speaker_embedding_size)
+        - tokens.<version>.npy: the token ids of the texts concatenated, as given by
+        text_to_sequence()
+        - texts.<version>.npy: the texts concatenated, encoded in utf-8
+        - info.<version>.json: the cleaners the tokens were computed with
+        - index.npz: the version of the files above, unique to each packing, and the metadata
+        table, a structured array with one row per utterance. It holds the file names of the
+        utterance in the unpacked dataset and the offset and length of the utterance in each of
+        the arrays above.
+
+    Reading an utterance only reads its own data from the disk. A packed dataset can also be an
+    overlay of another one, holding some of the arrays only and reading the others from its
+    source: the ground truth aligned mel spectrograms are packed this way, with the audio,
+    embeddings and texts of the synthesizer dataset. An overlay must be packed again when its
+    source is.
+    """
+    index_fname = "index.npz"
+
+    def __init__(self, pack_dir: Path):
+        self.pack_dir = Path(pack_dir)
+        with np.load(self.pack_dir.joinpath(self.index_fname)) as index_file:
+            self.version = str(index_file["version"])
+            self.index = index_file["rows"]
+        with self.fpath("info", ".json").open("r") as info_file:
+            self.info = json.load(info_file)
+        self.source = None
+        if self.info.get("source") is not None:
+            self.source = PackedDataset(self.pack_dir.joinpath(self.info["source"]))
+            if self.source.version != self.info["source_version"]:
+                raise Exception("%s is an overlay of an older packing of %s, pack it again." %
+                                (self.pack_dir, self.source.pack_dir))
+        self._arrays = {}
+
+    @classmethod
+    def exists(cls, pack_dir: Path):
+        return Path(pack_dir).joinpath(cls.index_fname).exists()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        # Memory maps are opened again by each process rather than copied
+        state = self.__dict__.copy()
+        state["_arrays"] = {}
+        return state
+
+    @property
+    def cleaners(self):
+        return self.info["cleaners"]
+
+    def fpath(self, name, extension=".npy"):
+        """
+        Returns the path of one of the files of the dataset, e.g. fpath("mels").
+        """
+        return self.pack_dir.joinpath(name + "." + self.version + extension)
+
+    def _array(self, field):
+        array = self._arrays.get(field)
+        if array is None:
+            fpath = self.fpath(field)
+            if not fpath.exists() and self.source is not None:
+                array = self.source._array(field)
+            else:
+                array = np.load(fpath, mmap_mode="r")
+            self._arrays[field] = array
+        return array
+
+    def read(self, field, i, start=0, end=None):
+        """
+        Reads the data of utterance <i> in one of the arrays of the dataset, or only elements
+        [start, end) of it.
+        """
+        row = self.index[i]
+        offset = row[field + "_offset"]
+        end = row[field + "_length"] if end is None else min(end, row[field + "_length"])
+        return np.array(self._array(field)[offset + start:offset + end])
+
+    def mel(self, i):
+        """
+        Returns the mel spectrogram of utterance <i>, of shape (n_frames, num_mels) as saved by
+        the preprocessing, decoded to float32.
+        """
+        return decode_mel(self.read("mels", i))
+
+    def audio(self, i):
+        return decode_audio(self.read("audio", i))
+
+    def embed(self, i):
+        return self.read("embeds", i)[0]
+
+    def tokens(self, i):
+        return self.read("tokens", i)
+
+    def text(self, i):
+        return self.read("texts", i).tobytes().decode("utf-8")
+
+    def metadata(self, i):
+        """
+        Returns the metadata of utterance <i> as in train.txt: the file names of its audio, mel
+        spectrogram and embedding, its number of samples and of frames, and its text.
+        """
+        row = self.index[i]
+        return [row["wav_fname"].decode("utf-8"), row["mel_fname"].decode("utf-8"),
+                row["embed_fname"].decode("utf-8"), str(row["audio_length"]),
+                str(row["mels_length"]), self.text(i)]
+
+
+class PackWriter:
+    """
+    Writes the arrays of a packed dataset one utterance at a time. The files are written under
+    the names of a new version, which the index switches to when the writer is closed. Replacing
+    the index is the only change made to the files in use, so that an interrupted packing leaves
+    the previous dataset in use. The files of the previous versions are deleted afterwards.
+    """
+    def __init__(self, pack_dir: Path, index: np.ndarray, shapes: dict, info: dict,
+                 dtypes: dict=None):
+        """
+        :param pack_dir: the directory of the packed dataset
+        :param index: the metadata table, with the length of each utterance in each of the
+        arrays written. Their offsets are computed here.
+        :param shapes: the shape of the elements of each array written, e.g. {"mels": (80,)}
+        :param info: the content of info.json
+        :param dtypes: the type of the elements of the arrays whose type differs from _fields,
+        e.g. {"mels": np.float16}
+        """
+        self.pack_dir = Path(pack_dir)
+        self.pack_dir.mkdir(parents=True, exist_ok=True)
+        self.index = index
+        self.info = info
+        self.version = uuid.uuid4().hex[:8]
+        self._arrays = {}
+        dtypes = dict(_fields, **(dtypes or {}))
+        for field, shape in shapes.items():
+            lengths = index[field + "_length"]
+            index[field + "_offset"] = np.cumsum(lengths) - lengths
+            self._arrays[field] = np.lib.format.open_memmap(
+                self._fpath(field), mode="w+", dtype=dtypes[field],
+                shape=(int(np.sum(lengths)),) + tuple(shape))
+
+    def _fpath(self, name, extension=".npy"):
+        return self.pack_dir.joinpath(name + "." + self.version + extension)
+
+    def write(self, i, **arrays):
+        """
+        Writes the data of utterance <i>, e.g. writer.write(i, mels=mel, audio=wav).
+        """
+        for field, array in arrays.items():
+            offset, length = self.index[i][field + "_offset"], self.index[i][field + "_length"]
+            if len(array) != length:
+                raise Exception("Expected %d elements in the %s of utterance %d, got %d. The "
+                                "metadata may be out of date." % (length, field, i, len(array)))
+            self._arrays[field][offset:offset + length] = array
+
+    def close(self):
+        for field, array in self._arrays.items():
+            array.flush()
+        self._arrays.clear()
+        with self._fpath("info", ".json").open("w") as info_file:
+            json.dump(self.info, info_file)
+
+        # Switch to the new version by replacing the index
+        tmp_index_fpath = self.pack_dir.joinpath("index.tmp.npz")
+        np.savez(tmp_index_fpath, version=np.array(self.version), rows=self.index)
+        tmp_index_fpath.replace(self.pack_dir.joinpath(PackedDataset.index_fname))
+
+        # Delete the files of the previous versions and of the interrupted packings
+        for fpath in self.pack_dir.iterdir():
+            name = fpath.name.split(".")
+            if name[0] in list(_fields) + ["info"] and name[1] != self.version:
+                try:
+                    fpath.unlink()
+                except OSError:
+                    # Still open in another process on Windows, deleted at the next packing
+                    pass
+
+
+def _new_index(metadata):
+    fname_size = max(len(m[i].encode("utf-8")) for m in metadata for i in range(3))
+    index = np.zeros(len(metadata), dtype=_index_dtype(fname_size))
+    for column, i in (("wav_fname", 0), ("mel_fname", 1), ("embed_fname", 2)):
+        index[column] = [m[i].encode("utf-8") for m in metadata]
+    return index
+
+
+def _same_storage(mel, dtype):
+    # Stores a mel spectrogram in the same type as the others of a packed array
+    if mel.dtype == dtype:
+        return mel
+    return encode_mel(decode_mel(mel), dtype.name)
+
+
+def pack_dataset(synthesizer_root: Path, cleaners: str, n_threads=8):
+    """
+    Packs the synthesizer dataset listed in <synthesizer_root>/train.txt in
+    <synthesizer_root>/packed. The unpacked files are left untouched. The mel spectrograms and
+    the audio are packed in the type the first utterance is stored in.
+
+    :param cleaners: the cleaners the tokens are computed with (hparams.cleaners)
+    :param n_threads: the number of threads reading the files
+    """
+    with synthesizer_root.joinpath("train.txt").open("r", encoding="utf-8") as metadata_file:
+        metadata = [line.rstrip("\n").split("|") for line in metadata_file]
+    if not metadata:
+        raise Exception("No utterances to pack in %s" % synthesizer_root)
+    cleaner_names = [x.strip() for x in cleaners.split(",")]
+    texts = [m[5].encode("utf-8") for m in metadata]
+    tokens = [np.asarray(text_to_sequence(m[5], cleaner_names), dtype=np.int32)
+              for m in metadata]
+
+    index = _new_index(metadata)
+    index["mels_length"] = [int(m[4]) for m in metadata]
+    index["audio_length"] = [int(m[3]) for m in metadata]
+    index["embeds_length"] = 1
+    index["tokens_length"] = [len(t) for t in tokens]
+    index["texts_length"] = [len(t) for t in texts]
+
+    def load(i):
+        return (np.load(synthesizer_root.joinpath("mels", metadata[i][1])),
+                np.load(synthesizer_root.joinpath("audio", metadata[i][0])),
+                np.load(synthesizer_root.joinpath("embeds", metadata[i][2])))
+
+    mel, wav, embed = load(0)
+    mel_dtype = mel.dtype
+    audio_storage = "int16" if wav.dtype == np.int16 else "float32"
+    shapes = {"mels": mel.shape[1:], "audio": (), "embeds": embed.shape, "tokens": (),
+              "texts": ()}
+    writer = PackWriter(synthesizer_root.joinpath("packed"), index, shapes,
+                        {"cleaners": cleaners, "source": None},
+                        {"mels": mel_dtype, "audio": np.dtype(audio_storage)})
+    with ThreadPool(n_threads) as pool:
+        job = pool.imap(load, range(len(metadata)), chunksize=16)
+        for i, (mel, wav, embed) in enumerate(tqdm(job, "Packing", len(metadata),
+                                                   unit="utterances")):
+            mel = _same_storage(mel, mel_dtype)
+            wav = encode_audio(decode_audio(wav), audio_storage)
+            writer.write(i, mels=mel, audio=wav, embeds=embed[None], tokens=tokens[i],
+                         texts=np.frombuffer(texts[i], dtype=np.uint8))
+    writer.close()
+
+
+def gta_pack_writer(source: PackedDataset, rows, pack_dir: Path, num_mels,
+                    mel_storage="float32"):
+    """
+    Creates the writer of a packed dataset of ground truth aligned mel spectrograms, which are
+    of the same length as the mel spectrograms of <source>. The other arrays are read from
+    <source>.
+
+    :param rows: the rows of <source> whose spectrograms are written, in order
+    :param mel_storage: the type of the spectrograms written, encoded with
+    utils.mel_storage.encode_mel()
+    """
+    index = source.index[np.asarray(rows)].copy()
+    info = {"cleaners": source.cleaners, "source": os.path.relpath(source.pack_dir, pack_dir),
+            "source_version": source.version}
+    dtype, shape = storage_layout(num_mels, mel_storage)
+    return PackWriter(pack_dir, index, {"mels": shape}, info, {"mels": dtype})
+
+
+def pack_gta(synthesizer_root: Path, voc_dir: Path, n_threads=8):
+    """
+    Packs the ground truth aligned mel spectrograms listed in <voc_dir>/synthesized.txt in
+    <voc_dir>/packed_gta, as an overlay of the packed synthesizer dataset.
+    """
+    source = PackedDataset(synthesizer_root.joinpath("packed"))
+    source_rows = {row["mel_fname"].decode("utf-8"): i for i, row in enumerate(source.index)}
+    with voc_dir.joinpath("synthesized.txt").open("r", encoding="utf-8") as metadata_file:
+        mel_fnames = [line.split("|")[1] for line in metadata_file]
+    if any(fname not in source_rows for fname in mel_fnames):
+        raise Exception("The packed synthesizer dataset doesn't match synthesized.txt, pack the "
+                        "synthesizer dataset again.")
+    if not mel_fnames:
+        raise Exception("No GTA spectrograms to pack in %s" % voc_dir)
+
+    load = lambda fname: np.load(voc_dir.joinpath("mels_gta", fname))
+    mel_dtype = load(mel_fnames[0]).dtype
+    writer = gta_pack_writer(source, [source_rows[fname] for fname in mel_fnames],
+                             voc_dir.joinpath("packed_gta"), source.mel(0).shape[1],
+                             mel_dtype.name)
+    with ThreadPool(n_threads) as pool:
+        job = pool.imap(load, mel_fnames, chunksize=16)
+        for i, mel in enumerate(tqdm(job, "Packing GTA", len(mel_fnames), unit="utterances")):
+            writer.write(i, mels=_same_storage(mel, mel_dtype))
+    writer.close()
+
+
+def unpack_dataset(pack_dir: Path, out_dir: Path, metadata_fname="train.txt",
+                   mel_dirname="mels"):
+    """
+    Writes a packed dataset back to the layout of the preprocessing: one .npy file per
+    utterance for each of the mel spectrograms, audio and embeddings of the dataset, and the
+    metadata file. The arrays of the source of an overlay are not written.
+    """
+    dataset = PackedDataset(pack_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    has_field = lambda field: dataset.fpath(field).exists()
+    outputs = [(field, out_dir.joinpath(dirname), column) for field, dirname, column in
+               (("mels", mel_dirname, 1), ("audio", "audio", 0), ("embeds", "embeds", 2))
+               if has_field(field)]
+    for _, field_dir, _ in outputs:
+        field_dir.mkdir(exist_ok=True)
+
+    with out_dir.joinpath(metadata_fname).open("w", encoding="utf-8") as metadata_file:
+        for i in tqdm(range(len(dataset)), "Unpacking", unit="utterances"):
+            metadata = dataset.metadata(i)
+            for field, field_dir, column in outputs:
+                data = dataset.embed(i) if field == "embeds" else dataset.read(field, i)
+                np.save(field_dir.joinpath(metadata[column]), data, allow_pickle=False)
+            metadata_file.write("|".join(metadata) + "\n")
@@ -1,27 +1,20 @@
-from multiprocessing.pool import Pool 
+from multiprocessing.pool import Pool, ThreadPool
 from synthesizer import audio
+from synthesizer.utils import chinese
+from collections import deque
 from functools import partial
 from itertools import chain
 from encoder import inference as encoder
+from encoder.embedding_cache import EmbeddingCache
 from pathlib import Path
 from utils import logmmse
+from utils.audio_storage import load_audio, save_audio
+from utils.mel_storage import save_mel
 from tqdm import tqdm
 import numpy as np
+import threading
 import librosa
 import os
-import platform
-
-from pypinyin import lazy_pinyin, Style
-from pypinyin.contrib.neutral_tone import NeutralToneWith5Mixin
-from pypinyin.converter import DefaultConverter
-from pypinyin.core import Pinyin
-
-class MyConverter(NeutralToneWith5Mixin, DefaultConverter):
-    pass
-
-my_pinyin = Pinyin(MyConverter())
-pinyin = my_pinyin.pinyin
-
 
 
 def preprocess_librispeech(datasets_root: Path, out_dir: Path, n_processes: int, 
@@ -51,20 +44,8 @@ def preprocess_librispeech(datasets_root: Path, out_dir: Path, n_processes: int,
         for metadatum in speaker_metadata:
             metadata_file.write("|".join(str(x) for x in metadatum) + "\n")
     metadata_file.close()
-
-    # Verify the contents of the metadata file
-    with metadata_fpath.open("r", encoding="utf-8") as metadata_file:
-        metadata = [line.split("|") for line in metadata_file]
-    mel_frames = sum([int(m[4]) for m in metadata])
-    timesteps = sum([int(m[3]) for m in metadata])
-    sample_rate = hparams.sample_rate
-    hours = (timesteps / sample_rate) / 3600
-    print("The dataset consists of %d utterances, %d mel frames, %d audio timesteps (%.2f hours)." %
-          (len(metadata), mel_frames, timesteps, hours))
-    print("Max input length (text chars): %d" % max(len(m[5]) for m in metadata))
-    print("Max mel frames length: %d" % max(int(m[4]) for m in metadata))
-    print("Max audio timesteps length: %d" % max(int(m[3]) for m in metadata))
-
+    
+    print_dataset_stats(metadata_fpath, hparams)
 
 
 def preprocess_speaker(speaker_dir, out_dir: Path, skip_existing: bool, hparams):
@@ -200,26 +181,39 @@ def process_utterance(wav: np.ndarray, text: str, out_dir: Path, basename: str,
         return None
     
     # Write the spectrogram, embed and audio to disk
-    np.save(mel_fpath, mel_spectrogram.T, allow_pickle=False)
-    np.save(wav_fpath, wav, allow_pickle=False)
+    save_mel(mel_fpath, mel_spectrogram.T, hparams.mel_storage)
+    save_audio(wav_fpath, wav, hparams.audio_storage)
     
     # Return a tuple describing this training example
     return wav_fpath.name, mel_fpath.name, "embed-%s.npy" % basename, len(wav), mel_frames, text
  
  
-def embed_utterance(fpaths, encoder_model_fpath):
-    if not encoder.is_loaded():
-        encoder.load_model(encoder_model_fpath)
-
-    # Compute the speaker embedding of the utterance
+def _load_wav(fpaths):
     wav_fpath, embed_fpath = fpaths
-    wav = np.load(wav_fpath)
-    wav = encoder.preprocess_wav(wav)
-    embed = encoder.embed_utterance(wav)
-    np.save(embed_fpath, embed, allow_pickle=False)
-    
- 
-def create_embeddings(synthesizer_root: Path, encoder_model_fpath: Path, n_processes: int):
+    return load_audio(wav_fpath), embed_fpath
+
+
+def _compute_partial_frames(wav):
+    return encoder.compute_partial_frames(encoder.preprocess_wav(wav))
+
+
+def create_embeddings(synthesizer_root: Path, encoder_model_fpath: Path, n_processes: int,
+                      cache_dir: Path=None, skip_existing: bool=False, n_io_threads: int=8, 
+                      batch_size: int=256, max_pending: int=1024):
+    """
+    Computes the speaker embedding of each utterance of the synthesizer dataset. The embedding 
+    is done by a pipeline: a pool of threads reads the audio, a pool of <n_processes> processes 
+    preprocesses it and computes the frames of its partial utterances, and a single encoder in 
+    the main process embeds the partials of several utterances at once, in batches of 
+    <batch_size> partials. Each embedding is written as soon as it is computed.
+    
+    :param cache_dir: see EmbeddingCache
+    :param skip_existing: if True, the utterances that already have an embedding are skipped
+    :param n_io_threads: the number of threads reading the audio
+    :param batch_size: the number of partial utterances forwarded at once by the encoder
+    :param max_pending: the maximum number of utterances read or being preprocessed at once, 
+    which bounds the memory used by the pipeline
+    """
     wav_dir = synthesizer_root.joinpath("audio")
     metadata_fpath = synthesizer_root.joinpath("train.txt")
     assert wav_dir.exists() and metadata_fpath.exists()
@@ -230,23 +224,109 @@ def create_embeddings(synthesizer_root: Path, encoder_model_fpath: Path, n_proce
     with metadata_fpath.open("r") as metadata_file:
         metadata = [line.split("|") for line in metadata_file]
         fpaths = [(wav_dir.joinpath(m[0]), embed_dir.joinpath(m[2])) for m in metadata]
+    if skip_existing:
+        n_utterances = len(fpaths)
+        fpaths = [(wav_fpath, embed_fpath) for wav_fpath, embed_fpath in fpaths 
+                  if not embed_fpath.exists()]
+        print("Skipping %d utterances that already have an embedding." % 
+              (n_utterances - len(fpaths)))
+    if not fpaths:
+        return
+    
+    # The processes are started before the model is loaded, so that they don't inherit it (and 
+    # its CUDA context)
+    cpu_pool = Pool(n_processes)
+    io_pool = ThreadPool(n_io_threads)
+    encoder.load_model(encoder_model_fpath)
+    embedding_cache = EmbeddingCache(cache_dir=cache_dir)
+    
+    # The threads stop reading audio when <max_pending> utterances are read but not yet passed 
+    # on to the processes
+    read_window = threading.BoundedSemaphore(max_pending)
+    def gated_fpaths():
+        for item in fpaths:
+            read_window.acquire()
+            yield item
+    
+    pending = deque()   # (key, embed_fpath, async result of the partial frames)
+    ready = []          # (key, embed_fpath, partial frames)
+    n_ready_partials = 0
+    
+    def save(embed_fpath, embed):
+        np.save(embed_fpath, embed, allow_pickle=False)
+        progress.update(1)
+    
+    def collect(block):
+        # Takes the partial frames computed by the processes, in order
+        nonlocal n_ready_partials
+        while pending and (block or pending[0][2].ready()):
+            key, embed_fpath, result = pending.popleft()
+            frames = result.get()
+            ready.append((key, embed_fpath, frames))
+            n_ready_partials += len(frames)
+            block = False
+    
+    def embed_ready():
+        nonlocal n_ready_partials
+        embeds, partial_embeds = encoder.embed_partial_frames([f for _, _, f in ready], 
+                                                              batch_size)
+        for (key, embed_fpath, _), embed, partials in zip(ready, embeds, partial_embeds):
+            embedding_cache.put(key, embed, partials)
+            save(embed_fpath, embed)
+        ready.clear()
+        n_ready_partials = 0
+    
+    progress = tqdm(total=len(fpaths), desc="Embedding", unit="utterances")
+    try:
+        for wav, embed_fpath in io_pool.imap_unordered(_load_wav, gated_fpaths()):
+            read_window.release()
+            
+            # Audio embedded before (e.g. duplicates) is taken from the cache
+            key = embedding_cache.key(wav)
+            cached = embedding_cache.get(key)
+            if cached is not None:
+                save(embed_fpath, cached[0])
+            else:
+                pending.append((key, embed_fpath, 
+                                cpu_pool.apply_async(_compute_partial_frames, (wav,))))
+            
+            collect(block=len(pending) >= max_pending)
+            if n_ready_partials >= batch_size:
+                embed_ready()
         
-    # TODO: improve on the multiprocessing, it's terrible. Disk I/O is the bottleneck here.
-    # Embed the utterances in separate threads
-    func = partial(embed_utterance, encoder_model_fpath=encoder_model_fpath)
-    job = Pool(n_processes).imap(func, fpaths)
-    list(tqdm(job, "Embedding", len(fpaths), unit="utterances"))
-
-
-# thchs30
-def preprocess_thchs30(datasets_root: Path, out_dir: Path, n_processes: int, 
-                           skip_existing: bool, hparams,dataset=None):
-    # Gather the input directories
-    dataset_root = datasets_root.joinpath("data_thchs30")
-    input_dirs = [dataset_root.joinpath("train")]
-    print("\n    ".join(map(str, ["Using data from:"] + input_dirs)))
-    assert all(input_dir.exists() for input_dir in input_dirs)
-    
+        while pending:
+            collect(block=True)
+            if n_ready_partials >= batch_size:
+                embed_ready()
+        if ready:
+            embed_ready()
+    finally:
+        progress.close()
+        io_pool.terminate()
+        cpu_pool.terminate()
+
+
+def _preprocess_task(indexed_task, func):
+    index, task = indexed_task
+    return index, func(task)
+
+
+def preprocess_files(name: str, tasks, func, out_dir: Path, n_processes: int, 
+                     skip_existing: bool, hparams, chunksize=None):
+    """
+    Runs <func> on each task (e.g. an audio file to preprocess) on a pool of processes and 
+    writes the metadata of the utterances it returns to train.txt. Tasks are distributed in small 
+    chunks so that the load stays balanced between the processes until the end, and their 
+    results are written in the order of <tasks> as they come in: results that complete early 
+    wait in a reorder buffer.
+    
+    :param name: the name of the dataset, for the progress bar
+    :param tasks: the list of tasks
+    :param func: a picklable function that takes a task and returns a list of metadata of 
+    utterances (see process_utterance())
+    :param chunksize: the number of tasks sent to a process at once. By default, each process 
+    receives about 32 chunks.
+    """
     # Create the output directories for each output file type
     out_dir.joinpath("mels").mkdir(exist_ok=True)
     out_dir.joinpath("audio").mkdir(exist_ok=True)
@@ -254,20 +334,40 @@ def preprocess_thchs30(datasets_root: Path, out_dir: Path, n_processes: int,
     # Create a metadata file
     metadata_fpath = out_dir.joinpath("train.txt")
     metadata_file = metadata_fpath.open("a" if skip_existing else "w", encoding="utf-8")
-
+    
     # Preprocess the dataset
-    speaker_dirs = list(chain.from_iterable(input_dir.glob("*.trn") for input_dir in input_dirs))
-    func = partial(preprocess_speaker_thchs30, out_dir=out_dir, skip_existing=skip_existing, 
-                   hparams=hparams)
-    job = Pool(n_processes).imap(func, speaker_dirs)
-    for speaker_metadata in tqdm(job, "thchs30", len(speaker_dirs), unit="speakers"):
-        for metadatum in speaker_metadata:
-            metadata_file.write("|".join(str(x) for x in metadatum) + "\n")
+    n_processes = n_processes or os.cpu_count()
+    if chunksize is None:
+        chunksize = int(np.clip(len(tasks) // (n_processes * 32), 1, 64))
+    pool = Pool(n_processes)
+    job = pool.imap_unordered(partial(_preprocess_task, func=func), enumerate(tasks), chunksize)
+    reorder_buffer = {}
+    next_index = 0
+    n_utterances = 0
+    with tqdm(job, name, len(tasks), unit="files") as progress:
+        for index, metadata in progress:
+            reorder_buffer[index] = metadata
+            while next_index in reorder_buffer:
+                for metadatum in reorder_buffer.pop(next_index):
+                    metadata_file.write("|".join(str(x) for x in metadatum) + "\n")
+                    n_utterances += 1
+                next_index += 1
+            progress.set_postfix(utterances=n_utterances, buffered=len(reorder_buffer), 
+                                 refresh=False)
+    pool.close()
+    pool.join()
     metadata_file.close()
+    
+    print_dataset_stats(metadata_fpath, hparams)
 
+
+def print_dataset_stats(metadata_fpath: Path, hparams):
     # Verify the contents of the metadata file
     with metadata_fpath.open("r", encoding="utf-8") as metadata_file:
         metadata = [line.split("|") for line in metadata_file]
+    if not metadata:
+        print("The dataset is empty.")
+        return
     mel_frames = sum([int(m[4]) for m in metadata])
     timesteps = sum([int(m[3]) for m in metadata])
     sample_rate = hparams.sample_rate
@@ -278,31 +378,72 @@ def preprocess_thchs30(datasets_root: Path, out_dir: Path, n_processes: int,
     print("Max mel frames length: %d" % max(int(m[4]) for m in metadata))
     print("Max audio timesteps length: %d" % max(int(m[3]) for m in metadata))
 
-def preprocess_speaker_thchs30(speaker_dir, out_dir: Path, skip_existing: bool, hparams):
-    metadata = []
 
-    # Gather the utterance audios and texts
-    alignments_fpath = str(speaker_dir)
+def _read_transcripts(transcript_fpath: Path):
+    """
+    Reads a transcript file with one "<utterance id> <text>" line per utterance.
+    """
+    transcripts = {}
+    with open(transcript_fpath, "rb") as transcript_file:
+        for line in transcript_file:
+            line = line.decode().strip().split(" ")
+            if line[0]:
+                transcripts[line[0]] = " ".join(line[1:])
+    return transcripts
+
+
+def _transcribed_files(input_dirs, transcripts):
+    """
+    Lists the (wav_fpath, transcript) pairs of the wav files in the speaker directories of 
+    <input_dirs> that have a transcript, sorted by path.
+    """
+    wav_fpaths = chain.from_iterable(input_dir.glob("*/*.wav") for input_dir in input_dirs)
+    tasks = [(wav_fpath, transcripts.get(wav_fpath.stem)) for wav_fpath in sorted(wav_fpaths)]
+    return [(wav_fpath, words) for wav_fpath, words in tasks if words]
+
+
+def preprocess_transcribed_file(task, split_func, out_dir: Path, skip_existing: bool, hparams):
+    # D:\dataset\data_aishell\wav\train\S0002\BAC009S0002W0122.wav
+    wav_fpath, words = task
+    sub_basename = "%s_%02d" % (wav_fpath.name, 0)
+    wav, text = split_func(wav_fpath, words, hparams)
+    metadata = process_utterance(wav, text, out_dir, sub_basename, skip_existing, hparams)
+    return [] if metadata is None else [metadata]
+
+
+# thchs30
+def preprocess_thchs30(datasets_root: Path, out_dir: Path, n_processes: int, 
+                           skip_existing: bool, hparams,dataset=None):
+    # Gather the input directories
+    dataset_root = datasets_root.joinpath("data_thchs30")
+    input_dirs = [dataset_root.joinpath("train")]
+    print("\n    ".join(map(str, ["Using data from:"] + input_dirs)))
+    assert all(input_dir.exists() for input_dir in input_dirs)
+    
+    # Preprocess the dataset, one transcript file per task
+    trn_fpaths = sorted(chain.from_iterable(input_dir.glob("*.trn") for input_dir in input_dirs))
+    func = partial(preprocess_file_thchs30, out_dir=out_dir, skip_existing=skip_existing, 
+                   hparams=hparams)
+    preprocess_files("thchs30", trn_fpaths, func, out_dir, n_processes, skip_existing, hparams)
+
+
+def preprocess_file_thchs30(trn_fpath, out_dir: Path, skip_existing: bool, hparams):
+    # Gather the utterance audio and text
+    alignments_fpath = str(trn_fpath)
     alignments_fpath = alignments_fpath.replace("train", "data")
     with open(alignments_fpath,"rb") as alignments_file:
         alignments = [line for line in alignments_file.readlines()]
     
-    # Iterate over each entry in the alignments file
     wav_fpath = alignments_fpath[:-4]
     words = alignments[1].decode().strip("\n")
-    if platform.system() == "Windows":
-        split = "\\"
-    else:
-        split = "/" 
-    wav_fname = wav_fpath.split(split)[-1]
+    wav_fname = os.path.basename(wav_fpath)
     assert os.path.exists(wav_fpath)
-    # Process each sub-utterance
+    
+    # Process the utterance
     wav, text = split_on_silences_thchs30(wav_fpath, words, hparams)
     sub_basename = "%s_%02d" % (wav_fname, 0)
-    metadata.append(process_utterance(wav, text, out_dir, sub_basename, 
-                                      skip_existing, hparams))
-    
-    return [m for m in metadata if m is not None]
+    metadata = process_utterance(wav, text, out_dir, sub_basename, skip_existing, hparams)
+    return [] if metadata is None else [metadata]
     
 def split_on_silences_thchs30(wav_fpath, words, hparams):
     # Load the audio waveform
@@ -318,82 +459,17 @@ def preprocess_data_aishell(datasets_root: Path, out_dir: Path, n_processes: int
                            skip_existing: bool, hparams,dataset=None):
     # Gather the input directories
     dataset_root = datasets_root.joinpath("data_aishell")
-    # input_dirs = [dataset_root.joinpath("train-clean-100"), 
-    #               dataset_root.joinpath("train-clean-360")]
-
-    dict_info = {}
-    transcript_dirs = dataset_root.joinpath("transcript/aishell_transcript_v0.8.txt")
-    with open(transcript_dirs,"rb") as fp:
-        dict_transcript = [v.decode() for v in fp]
-
-    for v in dict_transcript:
-        if not v:
-            continue
-        v = v.strip().replace("\n","").split(" ")
-        dict_info[v[0]] = " ".join(v[1:])
-
+    transcripts = _read_transcripts(
+        dataset_root.joinpath("transcript/aishell_transcript_v0.8.txt"))
     input_dirs = [dataset_root.joinpath("wav/train")]
     print("\n    ".join(map(str, ["Using data from:"] + input_dirs)))
     assert all(input_dir.exists() for input_dir in input_dirs)
     
-    # Create the output directories for each output file type
-    out_dir.joinpath("mels").mkdir(exist_ok=True)
-    out_dir.joinpath("audio").mkdir(exist_ok=True)
-    
-    # Create a metadata file
-    metadata_fpath = out_dir.joinpath("train.txt")
-    metadata_file = metadata_fpath.open("a" if skip_existing else "w", encoding="utf-8")
-
-    # Preprocess the dataset
-    speaker_dirs = list(chain.from_iterable(input_dir.glob("*") for input_dir in input_dirs))
-    func = partial(preprocess_speaker_data_aishell, out_dir=out_dir, skip_existing=skip_existing, 
-                   hparams=hparams, dict_info=dict_info)
-    job = Pool(n_processes).imap(func, speaker_dirs)
-    for speaker_metadata in tqdm(job, "data_aishell", len(speaker_dirs), unit="speakers"):
-        for metadatum in speaker_metadata:
-            metadata_file.write("|".join(str(x) for x in metadatum) + "\n")
-    metadata_file.close()
-
-    # Verify the contents of the metadata file
-    with metadata_fpath.open("r", encoding="utf-8") as metadata_file:
-        metadata = [line.split("|") for line in metadata_file]
-    mel_frames = sum([int(m[4]) for m in metadata])
-    timesteps = sum([int(m[3]) for m in metadata])
-    sample_rate = hparams.sample_rate
-    hours = (timesteps / sample_rate) / 3600
-    print("The dataset consists of %d utterances, %d mel frames, %d audio timesteps (%.2f hours)." %
-          (len(metadata), mel_frames, timesteps, hours))
-    print("Max input length (text chars): %d" % max(len(m[5]) for m in metadata))
-    print("Max mel frames length: %d" % max(int(m[4]) for m in metadata))
-    print("Max audio timesteps length: %d" % max(int(m[3]) for m in metadata))
-
-
-
-def preprocess_speaker_data_aishell(speaker_dir, out_dir: Path, skip_existing: bool, hparams, dict_info):
-    metadata = []
-    if platform.system() == "Windows":
-        split = "\\"
-    else:
-        split = "/" 
-    # for book_dir in speaker_dir.glob("*"):
-        # Gather the utterance audios and texts
-
-    for wav_fpath in speaker_dir.glob("*.wav"):
-        # D:\dataset\data_aishell\wav\train\S0002\BAC009S0002W0122.wav
-            
-        # Process each sub-utterance
-        
-        name = str(wav_fpath).split(split)[-1]
-        key = name.split(".")[0]
-        words = dict_info.get(key)
-        if not words:
-            continue
-        sub_basename = "%s_%02d" % (name, 0)
-        wav, text = split_on_silences_data_aishell(wav_fpath, words, hparams)
-        metadata.append(process_utterance(wav, text, out_dir, sub_basename, 
-                                              skip_existing, hparams))
-    
-    return [m for m in metadata if m is not None]
+    # Preprocess the dataset, one audio file per task
+    func = partial(preprocess_transcribed_file, split_func=split_on_silences_data_aishell, 
+                   out_dir=out_dir, skip_existing=skip_existing, hparams=hparams)
+    preprocess_files("data_aishell", _transcribed_files(input_dirs, transcripts), func, out_dir, 
+                     n_processes, skip_existing, hparams)
 
   
 def split_on_silences_data_aishell(wav_fpath, words, hparams):
@@ -403,92 +479,24 @@ def split_on_silences_data_aishell(wav_fpath, words, hparams):
     if hparams.rescale:
         wav = wav / np.abs(wav).max() * hparams.rescaling_max
     
-    resp = pinyin(words, style=Style.TONE3)
-    res = [v[0] for v in resp if v[0].strip()]
-    res = " ".join(res)
-    return wav, res
+    return wav, " ".join(chinese.text_to_pinyin(words))
 
 # aidatatang_200zh
 def preprocess_aidatatang_200zh(datasets_root: Path, out_dir: Path, n_processes: int, 
                            skip_existing: bool, hparams,dataset=None):
     # Gather the input directories
     dataset_root = datasets_root.joinpath("aidatatang_200zh")
-    # input_dirs = [dataset_root.joinpath("train-clean-100"), 
-    #               dataset_root.joinpath("train-clean-360")]
-
-    dict_info = {}
-    transcript_dirs = dataset_root.joinpath("transcript/aidatatang_200_zh_transcript.txt")
-    with open(transcript_dirs,"rb") as fp:
-        dict_transcript = [v.decode() for v in fp]
-
-    for v in dict_transcript:
-        if not v:
-            continue
-        v = v.strip().replace("\n","").split(" ")
-        dict_info[v[0]] = " ".join(v[1:])
-
+    transcripts = _read_transcripts(
+        dataset_root.joinpath("transcript/aidatatang_200_zh_transcript.txt"))
     input_dirs = [dataset_root.joinpath("corpus/train")]
     print("\n    ".join(map(str, ["Using data from:"] + input_dirs)))
     assert all(input_dir.exists() for input_dir in input_dirs)
     
-    # Create the output directories for each output file type
-    out_dir.joinpath("mels").mkdir(exist_ok=True)
-    out_dir.joinpath("audio").mkdir(exist_ok=True)
-    
-    # Create a metadata file
-    metadata_fpath = out_dir.joinpath("train.txt")
-    metadata_file = metadata_fpath.open("a" if skip_existing else "w", encoding="utf-8")
-
-    # Preprocess the dataset
-    speaker_dirs = list(chain.from_iterable(input_dir.glob("*") for input_dir in input_dirs))
-    func = partial(preprocess_speaker_aidatatang_200zh, out_dir=out_dir, skip_existing=skip_existing, 
-                   hparams=hparams, dict_info=dict_info)
-    job = Pool(n_processes).imap(func, speaker_dirs)
-    for speaker_metadata in tqdm(job, "aidatatang_200zh", len(speaker_dirs), unit="speakers"):
-        for metadatum in speaker_metadata:
-            metadata_file.write("|".join(str(x) for x in metadatum) + "\n")
-    metadata_file.close()
-
-    # Verify the contents of the metadata file
-    with metadata_fpath.open("r", encoding="utf-8") as metadata_file:
-        metadata = [line.split("|") for line in metadata_file]
-    mel_frames = sum([int(m[4]) for m in metadata])
-    timesteps = sum([int(m[3]) for m in metadata])
-    sample_rate = hparams.sample_rate
-    hours = (timesteps / sample_rate) / 3600
-    print("The dataset consists of %d utterances, %d mel frames, %d audio timesteps (%.2f hours)." %
-          (len(metadata), mel_frames, timesteps, hours))
-    print("Max input length (text chars): %d" % max(len(m[5]) for m in metadata))
-    print("Max mel frames length: %d" % max(int(m[4]) for m in metadata))
-    print("Max audio timesteps length: %d" % max(int(m[3]) for m in metadata))
-
-
-
-def preprocess_speaker_aidatatang_200zh(speaker_dir, out_dir: Path, skip_existing: bool, hparams, dict_info):
-    metadata = []
-    if platform.system() == "Windows":
-        split = "\\"
-    else:
-        split = "/" 
-    # for book_dir in speaker_dir.glob("*"):
-        # Gather the utterance audios and texts
-
-    for wav_fpath in speaker_dir.glob("*.wav"):
-        # D:\dataset\data_aishell\wav\train\S0002\BAC009S0002W0122.wav
-            
-        # Process each sub-utterance
-        
-        name = str(wav_fpath).split(split)[-1]
-        key = name.split(".")[0]
-        words = dict_info.get(key)
-        if not words:
-            continue
-        sub_basename = "%s_%02d" % (name, 0)
-        wav, text = split_on_silences_aidatatang_200zh(wav_fpath, words, hparams)
-        metadata.append(process_utterance(wav, text, out_dir, sub_basename, 
-                                              skip_existing, hparams))
-    
-    return [m for m in metadata if m is not None]
+    # Preprocess the dataset, one audio file per task
+    func = partial(preprocess_transcribed_file, split_func=split_on_silences_aidatatang_200zh, 
+                   out_dir=out_dir, skip_existing=skip_existing, hparams=hparams)
+    preprocess_files("aidatatang_200zh", _transcribed_files(input_dirs, transcripts), func, 
+                     out_dir, n_processes, skip_existing, hparams)
 
   
 def split_on_silences_aidatatang_200zh(wav_fpath, words, hparams):
@@ -498,7 +506,4 @@ def split_on_silences_aidatatang_200zh(wav_fpath, words, hparams):
     if hparams.rescale:
         wav = wav / np.abs(wav).max() * hparams.rescaling_max
     
-    resp = pinyin(words, style=Style.TONE3)
-    res = [v[0] for v in resp if v[0].strip()]
-    res = " ".join(res)
-    return wav, res
\ No newline at end of file
+    return wav, " ".join(chinese.text_to_pinyin(words))
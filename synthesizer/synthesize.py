@@ -1,6 +1,9 @@
 from synthesizer.tacotron2 import Tacotron2
 from synthesizer.hparams import hparams_debug_string
 from synthesizer.infolog import log
+from synthesizer.packed_dataset import PackedDataset, gta_pack_writer
+from utils.mel_storage import encode_mel
+from pathlib import Path
 import tensorflow as tf
 from tqdm import tqdm
 import time
@@ -47,12 +50,19 @@ def run_synthesis(in_dir, out_dir, model_dir, hparams):
     checkpoint_fpath = tf.train.get_checkpoint_state(weights_dir).model_checkpoint_path
     synth = Tacotron2(checkpoint_fpath, hparams, gta=True)
     
-    # Load the metadata
-    with open(metadata_filename, encoding="utf-8") as f:
-        metadata = [line.strip().split("|") for line in f]
-        frame_shift_ms = hparams.hop_size / hparams.sample_rate
-        hours = sum([int(x[4]) for x in metadata]) * frame_shift_ms / 3600
-        print("Loaded metadata for {} examples ({:.2f} hours)".format(len(metadata), hours))
+    # Load the metadata, from the packed dataset if there is one (see synthesizer_pack.py). The 
+    # spectrograms are then packed as well, in <out_dir>/packed_gta
+    pack_dir = os.path.join(in_dir, "packed")
+    packed = PackedDataset(pack_dir) if PackedDataset.exists(pack_dir) else None
+    if packed is not None:
+        print("Using the packed dataset at {}".format(pack_dir))
+        metadata = [packed.metadata(i) + [i] for i in range(len(packed))]
+    else:
+        with open(metadata_filename, encoding="utf-8") as f:
+            metadata = [line.strip().split("|") for line in f]
+    frame_shift_ms = hparams.hop_size / hparams.sample_rate
+    hours = sum([int(x[4]) for x in metadata]) * frame_shift_ms / 3600
+    print("Loaded metadata for {} examples ({:.2f} hours)".format(len(metadata), hours))
         
     #Set inputs batch wise
     metadata = [metadata[i: i + hparams.tacotron_synthesis_batch_size] for i in
@@ -65,18 +75,35 @@ def run_synthesis(in_dir, out_dir, model_dir, hparams):
     mel_dir = os.path.join(in_dir, "mels")
     embed_dir = os.path.join(in_dir, "embeds")
     meta_out_fpath = os.path.join(out_dir, "synthesized.txt")
+    if packed is not None:
+        rows = [m[6] for meta in metadata for m in meta]
+        writer = gta_pack_writer(packed, rows, Path(out_dir, "packed_gta"), hparams.num_mels, 
+                                 hparams.mel_storage)
+        n_written = 0
     with open(meta_out_fpath, "w") as file:
         for i, meta in enumerate(tqdm(metadata)):
             texts = [m[5] for m in meta]
-            mel_filenames = [os.path.join(mel_dir, m[1]) for m in meta]
-            embed_filenames = [os.path.join(embed_dir, m[2]) for m in meta]
-            basenames = [os.path.basename(m).replace(".npy", "").replace("mel-", "") 
-                         for m in mel_filenames]
-            synth.synthesize(texts, basenames, synth_dir, None, mel_filenames, embed_filenames)
+            if packed is not None:
+                mel_targets = [packed.mel(m[6]) for m in meta]
+                embeds = [packed.embed(m[6]) for m in meta]
+                mels = synth.synthesize(texts, None, None, None, None, None, mel_targets, embeds)
+                for mel in mels:
+                    writer.write(n_written, mels=encode_mel(mel, hparams.mel_storage))
+                    n_written += 1
+                meta = [m[:6] for m in meta]
+            else:
+                mel_filenames = [os.path.join(mel_dir, m[1]) for m in meta]
+                embed_filenames = [os.path.join(embed_dir, m[2]) for m in meta]
+                basenames = [os.path.basename(m).replace(".npy", "").replace("mel-", "") 
+                             for m in mel_filenames]
+                synth.synthesize(texts, basenames, synth_dir, None, mel_filenames, 
+                                 embed_filenames)
             
             for elems in meta:
                 file.write("|".join([str(x) for x in elems]) + "\n")
+    if packed is not None:
+        writer.close()
                 
-    print("Synthesized mel spectrograms at {}".format(synth_dir))
+    print("Synthesized mel spectrograms at {}".format(writer.pack_dir if packed is not None 
+                                                       else synth_dir))
     return meta_out_fpath
-
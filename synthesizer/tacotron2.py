@@ -3,6 +3,7 @@ from synthesizer.infolog import log
 from synthesizer.models import create_model
 from synthesizer.utils import plot
 from synthesizer import audio
+from utils.mel_storage import load_mel, save_mel
 import tensorflow as tf
 import numpy as np
 import os
@@ -97,7 +98,15 @@ class Tacotron2:
         
         return [mel.T for mel in mels], alignments
     
-    def synthesize(self, texts, basenames, out_dir, log_dir, mel_filenames, embed_filenames):
+    def synthesize(self, texts, basenames, out_dir, log_dir, mel_filenames, embed_filenames,
+                   mel_targets=None, embeds=None):
+        """
+        Synthesizes the mel spectrograms of a batch and saves them in <out_dir>. If <out_dir> is 
+        None, they are returned instead. The target spectrograms (in GTA mode) and the embeddings 
+        are loaded from <mel_filenames> and <embed_filenames>, unless they are given directly in 
+        <mel_targets> and <embeds>. Spectrograms synthesized in GTA mode are saved in 
+        hparams.mel_storage.
+        """
         hparams = self._hparams
         cleaner_names = [x.strip() for x in hparams.cleaners.split(",")]
               
@@ -122,7 +131,8 @@ class Tacotron2:
         }
         
         if self.gta:
-            np_targets = [np.load(mel_filename) for mel_filename in mel_filenames]
+            np_targets = mel_targets if mel_targets is not None else \
+                [load_mel(mel_filename) for mel_filename in mel_filenames]
             target_lengths = [len(np_target) for np_target in np_targets]
             
             #pad targets according to each GPU max length
@@ -137,7 +147,8 @@ class Tacotron2:
             assert len(np_targets) == len(texts)
         
         feed_dict[self.split_infos] = np.asarray(split_infos, dtype=np.int32)
-        feed_dict[self.speaker_embeddings] = [np.load(f) for f in embed_filenames]
+        feed_dict[self.speaker_embeddings] = embeds if embeds is not None else \
+            [np.load(f) for f in embed_filenames]
         
         if self.gta or not hparams.predict_linear:
             mels, alignments, stop_tokens = self.session.run(
@@ -178,15 +189,18 @@ class Tacotron2:
             linears = [linear[:target_length, :] for linear, target_length in zip(linears, target_lengths)]
             assert len(mels) == len(linears) == len(texts)
         
+        if out_dir is None:
+            return mels
         if basenames is None:
             raise NotImplemented()
         
+        mel_storage = hparams.mel_storage if self.gta else "float32"
         saved_mels_paths = []
         for i, mel in enumerate(mels):
             # Write the spectrogram to disk
             # Note: outputs mel-spectrogram files and target ones have same names, just different folders
             mel_filename = os.path.join(out_dir, "mel-{}.npy".format(basenames[i]))
-            np.save(mel_filename, mel, allow_pickle=False)
+            save_mel(mel_filename, mel, mel_storage)
             saved_mels_paths.append(mel_filename)
             
             if log_dir is not None:
@@ -1,10 +1,12 @@
 from synthesizer.utils.symbols import symbols
 from synthesizer.utils.text import sequence_to_text
 from synthesizer.hparams import hparams_debug_string
-from synthesizer.feeder import Feeder
+from synthesizer.feeder import DatasetFeeder, Feeder
 from synthesizer.models import create_model
 from synthesizer.utils import ValueWindow, plot
 from synthesizer import infolog, audio
+from utils.checkpoint import AsyncCheckpointWriter
+from utils.profiler import Profiler
 from datetime import datetime
 from tqdm import tqdm
 import tensorflow as tf
@@ -78,6 +80,37 @@ def add_eval_stats(summary_writer, step, linear_loss, before_loss, after_loss, s
     summary_writer.add_summary(test_summary, step)
 
 
+class ShadowSaver:
+    """
+    Saves the variables of the graph in the background. The variables are first copied to 
+    shadow variables in the CPU memory, which takes a single session run, and a saver then writes 
+    the shadow variables on a thread of an AsyncCheckpointWriter while the training goes on. The 
+    checkpoints hold the names of the original variables, so they are restored as usual with 
+    tf.train.Saver.
+    """
+    def __init__(self, max_to_keep=5):
+        variables = tf.global_variables()
+        with tf.device("/cpu:0"), tf.variable_scope("checkpoint_shadow"):
+            # The shadow variables are kept out of the collections so that they are neither 
+            # trained nor saved by the other savers
+            shadows = [tf.Variable(tf.zeros(v.shape, v.dtype.base_dtype), trainable=False,
+                                   collections=[], name=v.op.name) for v in variables]
+        self.init_op = tf.variables_initializer(shadows)
+        self.copy_op = tf.group(*[s.assign(v) for s, v in zip(shadows, variables)])
+        self.saver = tf.train.Saver({v.op.name: s for v, s in zip(variables, shadows)},
+                                    max_to_keep=max_to_keep)
+        self.writer = AsyncCheckpointWriter(max_pending=1)
+    
+    def save(self, sess, fpath, step):
+        # The shadow variables can only be overwritten once the previous checkpoint is written
+        self.writer.wait()
+        sess.run(self.copy_op)
+        self.writer.submit(lambda: self.saver.save(sess, fpath, global_step=step), fpath)
+    
+    def wait(self):
+        self.writer.wait()
+
+
 def time_string():
     return datetime.now().strftime("%Y-%m-%d %H:%M")
 
@@ -141,7 +174,10 @@ def train(log_dir, args, hparams):
     # Set up data feeder
     coord = tf.train.Coordinator()
     with tf.variable_scope("datafeeder") as scope:
-        feeder = Feeder(coord, metadat_fpath, hparams)
+        if hparams.tacotron_input_pipeline == "tf.data":
+            feeder = DatasetFeeder(coord, metadat_fpath, hparams)
+        else:
+            feeder = Feeder(coord, metadat_fpath, hparams)
     
     # Set up model:
     global_step = tf.Variable(0, name="global_step", trainable=False)
@@ -165,6 +201,8 @@ def train(log_dir, args, hparams):
     time_window = ValueWindow(100)
     loss_window = ValueWindow(100)
     saver = tf.train.Saver(max_to_keep=5)
+    shadow_saver = ShadowSaver(max_to_keep=5)
+    profiler = Profiler(summarize_every=args.profile_every, disabled=args.profile_every == 0)
     
     log("Tacotron training set to a maximum of {} steps".format(args.tacotron_train_steps))
     
@@ -179,6 +217,7 @@ def train(log_dir, args, hparams):
             summary_writer = tf.summary.FileWriter(tensorboard_dir, sess.graph)
             
             sess.run(tf.global_variables_initializer())
+            sess.run(shadow_saver.init_op)
             
             # saved model restoring
             if args.restore:
@@ -205,10 +244,12 @@ def train(log_dir, args, hparams):
             feeder.start_threads(sess)
             
             # Training loop
+            profiler.reset_timer()
             while not coord.should_stop() and step < args.tacotron_train_steps:
                 start_time = time.time()
                 step, loss, opt = sess.run([global_step, model.loss, model.optimize])
                 time_window.append(time.time() - start_time)
+                profiler.tick("Training step (including the wait for the feeder)")
                 loss_window.append(loss)
                 message = "Step {:7d} [{:.3f} sec/step, loss={:.5f}, avg_loss={:.5f}]".format(
                     step, time_window.average, loss, loss_window.average)
@@ -219,9 +260,12 @@ def train(log_dir, args, hparams):
                     log("Loss exploded to {:.5f} at step {}".format(loss, step))
                     raise Exception("Loss exploded")
                 
+                profiler.tick("Logging")
+                
                 if step % args.summary_interval == 0:
                     log("\nWriting summary at step {}".format(step))
                     summary_writer.add_summary(sess.run(stats), step)
+                    profiler.tick("Summary")
                 
                 if step % args.eval_interval == 0:
                     # Run eval and save eval stats
@@ -323,11 +367,12 @@ def train(log_dir, args, hparams):
                     log("Writing eval summary!")
                     add_eval_stats(summary_writer, step, linear_loss, before_loss, after_loss,
                                    stop_token_loss, eval_loss)
+                    profiler.tick("Evaluation")
                 
                 if step % args.checkpoint_interval == 0 or step == args.tacotron_train_steps or \
                         step == 300:
-                    # Save model and current global step
-                    saver.save(sess, checkpoint_fpath, global_step=global_step)
+                    # Save model and current global step, in the background
+                    shadow_saver.save(sess, checkpoint_fpath, step)
                     
                     log("\nSaving alignment, Mel-Spectrograms and griffin-lim inverted waveform..")
                     input_seq, mel_prediction, alignment, target, target_length = sess.run([
@@ -366,9 +411,14 @@ def train(log_dir, args, hparams):
                                           target_spectrogram=target,
                                           max_len=target_length)
                     log("Input at step {}: {}".format(step, sequence_to_text(input_seq)))
+                    profiler.tick("Checkpoint")
+                    if args.profile_fpath is not None:
+                        profiler.export(args.profile_fpath)
+                        profiler.reset_timer()
                 
                 if step % args.embedding_interval == 0 or step == args.tacotron_train_steps or step == 1:
-                    # Get current checkpoint state
+                    # Get current checkpoint state, once the checkpoint being written is complete
+                    shadow_saver.wait()
                     checkpoint_state = tf.train.get_checkpoint_state(save_dir)
                     
                     # Update Projector
@@ -377,7 +427,9 @@ def train(log_dir, args, hparams):
                                         [char_embedding_meta],
                                         checkpoint_state.model_checkpoint_path)
                     log("Tacotron Character embeddings have been updated on tensorboard!")
+                    profiler.tick("Embeddings projector")
             
+            shadow_saver.wait()
             log("Tacotron training complete after {} global steps!".format(
                 args.tacotron_train_steps), slack=True)
             return save_dir
@@ -0,0 +1,160 @@
+"""
+Text front end for Chinese: converts text in hanzi to the sequence of tone-numbered pinyin tokens
+that the synthesizer is trained on (e.g. "你好，世界" -> ["ni3", "hao3", ",", "shi4", "jie4"]).
+
+Numbers are spelled out in hanzi before the conversion and full-width punctuation is mapped to
+the ASCII punctuation of the symbols (see symbols.py). Text that is already in pinyin, or in
+latin letters, is kept as is, as are all the punctuation marks of the symbols, which become
+tokens of their own (e.g. "ni3 hao3 (world)" -> ["ni3", "hao3", "(", "world", ")"]).
+
+The conversion of each run of hanzi is cached, so that the phrases that come up again and again
+in a dataset or in the requests to a server are only converted once per process.
+"""
+
+from synthesizer.utils.symbols import symbols
+from pypinyin import Style
+from pypinyin.contrib.neutral_tone import NeutralToneWith5Mixin
+from pypinyin.converter import DefaultConverter
+from pypinyin.core import Pinyin
+from functools import lru_cache
+from typing import List
+import unicodedata
+import re
+
+
+class _Converter(NeutralToneWith5Mixin, DefaultConverter):
+    # Writes the neutral tone as 5 (e.g. "men5"), so that every syllable ends with its tone
+    pass
+
+
+_pinyin = Pinyin(_Converter()).pinyin
+
+_hans = "\u3007\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\U00020000-\U0002ffff"
+# The punctuation marks of the symbols, all kept in the tokens ("~" is the end of sequence and
+# "_" the padding)
+_marks = "".join(s for s in symbols if not s.isalnum() and not s.isspace() and s not in "~_")
+_segment_re = re.compile(r"([%s]+)|([A-Za-z0-9']+)|([%s])" % (_hans, re.escape(_marks)))
+
+# Full-width punctuation that unicode normalization (NFKC) doesn't map to ASCII, and the symbols
+# of the model that must not appear in the text
+_punctuation_map = str.maketrans({
+    "。": ".", "｡": ".", "、": ",", "､": ",", "—": "-", "–": "-", "·": " ", "~": " ", "_": " ",
+    "“": "\"", "”": "\"", "‘": "'", "’": "'", "「": "\"", "」": "\"", "『": "\"", "』": "\"",
+})
+_repeated_punctuation_re = re.compile(r"([,.!?:;\-])(?:\s*[,.!?:;\-])+")
+
+_digits = "零一二三四五六七八九"
+_units = ("千", "百", "十", "")
+_section_units = ("", "万", "亿", "万亿")
+_year_re = re.compile(r"(?<![A-Za-z\d])(\d{4})(?=年)")
+# Integers with thousands separators (e.g. "1,000") are read as one number
+_number_re = re.compile(r"(?<![A-Za-z\d.])(-?)(\d{1,3}(?:,\d{3})+(?!\d)|\d+)(?:\.(\d+))?(%?)")
+
+
+def _digits_to_chinese(digits: str):
+    return "".join(_digits[int(d)] for d in digits)
+
+
+def _integer_to_chinese(number: str):
+    """
+    Spells out an integer in hanzi, e.g. "10305" -> "一万零三百零五". Integers with leading zeros
+    (e.g. "007") or of more than 16 digits are read digit by digit.
+    """
+    if len(number) > 1 and number[0] == "0" or len(number) > 16:
+        return _digits_to_chinese(number)
+    if int(number) == 0:
+        return _digits[0]
+
+    # Split the number in sections of 4 digits, read with their unit (万, 亿, ...)
+    sections = [number[max(0, i - 4):i] for i in range(len(number), 0, -4)][::-1]
+    out = ""
+    zero = False
+    for i, section in enumerate(sections):
+        if int(section) == 0:
+            zero = bool(out)
+            continue
+        for digit, unit in zip(section.zfill(4), _units):
+            if digit == "0":
+                zero = bool(out)
+            else:
+                if zero:
+                    out += _digits[0]
+                    zero = False
+                out += _digits[int(digit)] + unit
+        out += _section_units[len(sections) - 1 - i]
+
+    # 10 to 19 are read "十..." rather than "一十..."
+    if out.startswith("一十"):
+        out = out[1:]
+    return out
+
+
+def _expand_number(match):
+    sign, integer, decimals, percent = match.groups()
+    out = "负" if sign else ""
+    if percent:
+        out += "百分之"
+    out += _integer_to_chinese(integer.replace(",", ""))
+    if decimals:
+        out += "点" + _digits_to_chinese(decimals)
+    return out
+
+
+def normalize_numbers(text: str):
+    """
+    Spells out the numbers of a text in hanzi: integers, with or without thousands separators
+    (e.g. "1,000" -> "一千"), decimals, negative numbers, percentages and years (e.g. "2021年" ->
+    "二零二一年"). Digits that follow a letter, such as the tones of pinyin syllables, are left
+    untouched.
+    """
+    text = _year_re.sub(lambda m: _digits_to_chinese(m.group(1)), text)
+    return _number_re.sub(_expand_number, text)
+
+
+def normalize_punctuation(text: str):
+    """
+    Maps full-width characters (punctuation, digits and letters) to their ASCII equivalent and
+    collapses runs of punctuation to their first mark.
+    """
+    text = unicodedata.normalize("NFKC", text).translate(_punctuation_map)
+    return _repeated_punctuation_re.sub(r"\1", text)
+
+
+@lru_cache(maxsize=2 ** 16)
+def _hans_to_pinyin(hans: str):
+    return tuple(syllable[0] for syllable in _pinyin(hans, style=Style.TONE3))
+
+
+def text_to_pinyin(text: str) -> List[str]:
+    """
+    Converts a text to the sequence of its pinyin syllables with tone numbers (1 to 4, and 5 for
+    the neutral tone), words in latin letters and the punctuation marks of the symbols (see
+    symbols.py). Other characters are dropped.
+
+    :param text: the text, in hanzi and/or pinyin
+    :return: the list of tokens. Join them with spaces to get the input text of the synthesizer.
+    """
+    text = normalize_numbers(normalize_punctuation(text))
+    tokens = []
+    for hans, word, punctuation in _segment_re.findall(text):
+        if hans:
+            tokens.extend(_hans_to_pinyin(hans))
+        else:
+            tokens.append(word or punctuation)
+    return tokens
+
+
+def batch_text_to_pinyin(texts: List[str]) -> List[List[str]]:
+    """
+    Converts several texts with text_to_pinyin(). The phrases they have in common are converted
+    only once.
+    """
+    return [text_to_pinyin(text) for text in texts]
+
+
+def cache_info():
+    """
+    Returns the statistics of the cache of the phrases converted to pinyin (see
+    functools.lru_cache).
+    """
+    return _hans_to_pinyin.cache_info()
@@ -0,0 +1,42 @@
+from synthesizer.packed_dataset import pack_dataset, pack_gta, unpack_dataset
+from synthesizer.hparams import hparams
+from utils.argutils import print_args
+from pathlib import Path
+import argparse
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Packs the synthesizer dataset (the mel spectrograms, audio and embeddings "
+                    "of train.txt) in a few memory-mapped files, in <synthesizer_root>/packed. "
+                    "The synthesizer training, the creation of the GTA spectrograms and the "
+                    "vocoder training use the packed dataset when there is one, instead of "
+                    "opening three files per utterance. The GTA spectrograms created from a "
+                    "packed dataset are packed too.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("synthesizer_root", type=Path, help=\
+        "Path to the synthesizer training data that contains the audios and the train.txt file. "
+        "If you let everything as default, it should be <datasets_root>/SV2TTS/synthesizer/.")
+    parser.add_argument("--voc_dir", type=Path, default=None, help=\
+        "Path to the vocoder directory with GTA spectrograms (mels_gta/ and synthesized.txt) "
+        "created from the unpacked dataset. If given, they are packed in <voc_dir>/packed_gta "
+        "after the synthesizer dataset.")
+    parser.add_argument("-u", "--unpack", type=Path, default=None, help=\
+        "Instead of packing, write the packed dataset of <synthesizer_root> back to one file "
+        "per utterance in this directory.")
+    parser.add_argument("-n", "--n_threads", type=int, default=8, help=\
+        "Number of threads reading the files.")
+    parser.add_argument("--hparams", type=str, default="", help=\
+        "Hyperparameter overrides as a comma-separated list of name-value pairs. The cleaners "
+        "are used to compute the tokens of the texts.")
+    args = parser.parse_args()
+    print_args(args, parser)
+
+    if args.unpack is not None:
+        unpack_dataset(args.synthesizer_root.joinpath("packed"), args.unpack)
+    else:
+        cleaners = hparams.parse(args.hparams).cleaners
+        pack_dataset(args.synthesizer_root, cleaners, args.n_threads)
+        if args.voc_dir is not None:
+            pack_gta(args.synthesizer_root, args.voc_dir, args.n_threads)
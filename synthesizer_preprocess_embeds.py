@@ -16,8 +16,19 @@ if __name__ == "__main__":
                         default="encoder/saved_models/pretrained.pt", help=\
         "Path your trained encoder model.")
     parser.add_argument("-n", "--n_processes", type=int, default=4, help= \
-        "Number of parallel processes. An encoder is created for each, so you may need to lower "
-        "this value on GPUs with low memory. Set it to 1 if CUDA is unhappy.")
+        "Number of processes preprocessing the audio. A single encoder embeds the utterances of "
+        "all processes.")
+    parser.add_argument("-s", "--skip_existing", action="store_true", help=\
+        "Whether to skip the utterances that already have an embedding. Useful to resume an "
+        "interrupted run.")
+    parser.add_argument("--n_io_threads", type=int, default=8, help=\
+        "Number of threads reading the audio from the disk.")
+    parser.add_argument("-b", "--batch_size", type=int, default=256, help=\
+        "Number of partial utterances embedded at once by the encoder. Lower it on GPUs with low "
+        "memory.")
+    parser.add_argument("--cache_dir", type=Path, default=None, help=\
+        "Directory in which to cache the embeddings by audio content, so that rerunning the "
+        "embedding or embedding duplicate audio does not recompute them.")
     args = parser.parse_args()
     
     # Preprocess the dataset
@@ -41,6 +41,13 @@ if __name__ == "__main__":
                         help="Steps between eval on test data")
     parser.add_argument("--tacotron_train_steps", type=int, default=2000000, # Was 100000
                         help="total number of tacotron training steps")
+    parser.add_argument("--profile_every", type=int, default=0,
+                        help="Steps between summaries of the time spent in each part of the "
+                             "training loop. Set to 0 to disable the profiling.")
+    parser.add_argument("--profile_fpath", type=str, default=None,
+                        help="Path to a .json file to which the timings of the training loop are "
+                             "exported in the Chrome trace format at every checkpoint. Requires "
+                             "--profile_every.")
     parser.add_argument("--tf_log_level", type=int, default=1, help="Tensorflow C++ log level.")
     parser.add_argument("--slack_url", default=None,
                         help="slack webhook notification destination link")
@@ -1,5 +1,6 @@
 from toolbox.ui import UI
 from encoder import inference as encoder
+from encoder.embedding_cache import EmbeddingCache
 from synthesizer.inference import Synthesizer
 from vocoder import inference as vocoder
 from pathlib import Path
@@ -43,6 +44,7 @@ class Toolbox:
         self.current_generated = (None, None, None, None) # speaker_name, spec, breaks, wav
         
         self.synthesizer = None # type: Synthesizer
+        self.embedding_cache = EmbeddingCache()
         
         # Initialize the events and the interface
         self.ui = UI()
@@ -139,8 +141,7 @@ class Toolbox:
         # Compute the embedding
         if not encoder.is_loaded():
             self.init_encoder()
-        encoder_wav = encoder.preprocess_wav(wav)
-        embed, partial_embeds, _ = encoder.embed_utterance(encoder_wav, return_partials=True)
+        embed, partial_embeds = self.embedding_cache.embed_utterance(wav, return_partials=True)
 
         # Add the utterance
         utterance = Utterance(name, speaker_name, wav, spec, embed, partial_embeds, False)
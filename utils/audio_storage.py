@@ -0,0 +1,53 @@
+"""
+Storage of the training waveforms of the synthesizer and the vocoder. A waveform is saved as a
+.npy file either in float32 as it is computed, or as 16-bit PCM in int16, which halves its size
+on the disk. Loaders tell the types apart from the type of the array.
+
+Use save_audio() and load_audio() rather than np.save() and np.load() for the waveforms, so
+that both types are read transparently as float waveforms in [-1, 1].
+"""
+
+from pathlib import Path
+from typing import Union
+import numpy as np
+
+
+storage_types = ("float32", "int16")
+
+_int16_scale = 32767
+
+
+def encode_audio(wav: np.ndarray, storage="float32"):
+    """
+    Encodes a waveform for storage. Values beyond [-1, 1] are clipped in int16.
+
+    :param wav: the waveform, in float
+    :param storage: the storage type, one of storage_types
+    :return: the array to save
+    """
+    if storage == "float32":
+        return wav.astype(np.float32, copy=False)
+    if storage == "int16":
+        return np.rint(np.clip(wav, -1, 1) * _int16_scale).astype(np.int16)
+    raise Exception("Unknown audio storage type \"%s\", use one of %s" % (storage, storage_types))
+
+
+def decode_audio(data: np.ndarray):
+    """
+    Decodes a waveform encoded with encode_audio() of any storage type, or a segment of it.
+
+    :return: the waveform in float32, or in its own type if it was stored in float
+    """
+    if data.dtype == np.int16:
+        return data.astype(np.float32) / _int16_scale
+    if data.dtype.kind == "f":
+        return data
+    raise Exception("Not a waveform in a known storage type: %s" % data.dtype)
+
+
+def save_audio(fpath: Union[str, Path], wav: np.ndarray, storage="float32"):
+    np.save(fpath, encode_audio(wav, storage), allow_pickle=False)
+
+
+def load_audio(fpath: Union[str, Path]):
+    return decode_audio(np.load(fpath))
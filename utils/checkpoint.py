@@ -0,0 +1,139 @@
+from collections import OrderedDict
+from functools import partial
+from pathlib import Path
+import numpy as np
+import threading
+import atexit
+import torch
+import os
+
+
+def snapshot(state):
+    """
+    Returns a copy of a (possibly nested) state dict in CPU memory, which later changes to the
+    model or optimizer don't affect. Tensors are detached and copied to the CPU, numpy arrays are
+    copied and the containers are rebuilt. Other values are kept as they are.
+    """
+    if isinstance(state, torch.Tensor):
+        state = state.detach()
+        return state.clone() if state.device.type == "cpu" else state.cpu()
+    if isinstance(state, np.ndarray):
+        return state.copy()
+    if isinstance(state, OrderedDict):
+        return OrderedDict((key, snapshot(value)) for key, value in state.items())
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def save_atomic(state, fpath):
+    """
+    Saves with torch.save() to a temporary file that then replaces <fpath>, so that <fpath>
+    always holds a complete checkpoint even if the writing is interrupted.
+    """
+    fpath = Path(fpath)
+    tmp_fpath = fpath.with_name(fpath.name + ".tmp")
+    torch.save(state, tmp_fpath)
+    os.replace(tmp_fpath, fpath)
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints on a background thread, so that the training loop only waits for the
+    copy of the state to the CPU memory and not for the disk or network storage.
+
+    At most <max_pending> writes are queued or in progress at once: beyond that, save() blocks
+    until a write completes, which bounds the memory used by the snapshots. A write that is
+    still queued when a newer checkpoint is saved to the same path is replaced by the newer one.
+    Saving the same state to several paths (e.g. the latest model and a backup) with the same
+    <key> copies it only once.
+
+    Errors raised by a write are raised again by the next call to save(), submit() or wait().
+    Pending writes are completed when the program exits.
+    """
+    def __init__(self, max_pending=2):
+        assert max_pending >= 1
+        self.max_pending = max_pending
+        self._pending = OrderedDict()
+        self._n_running = 0
+        self._condition = threading.Condition()
+        self._error = None
+        self._thread = None
+        self._last_snapshot = None
+        self._last_key = None
+        atexit.register(self.wait)
+
+    def save(self, state, fpath, key=None):
+        """
+        Saves a state (e.g. a dictionary of state dicts) to <fpath> with torch.save() in the
+        background.
+
+        :param state: the state to save. It is copied before this function returns.
+        :param fpath: the path of the checkpoint
+        :param key: an optional identifier of the state, such as the training step. If the last
+        state saved had the same key, its copy is reused instead of copying <state> again.
+        """
+        if key is None or key != self._last_key:
+            # Release the previous copy first, the writes that use it still hold a reference
+            self._last_snapshot = None
+            self._last_snapshot = snapshot(state)
+            self._last_key = key
+        self.submit(partial(save_atomic, self._last_snapshot, fpath), fpath)
+
+    def submit(self, write_fn, fpath):
+        """
+        Runs a function writing a checkpoint to <fpath> in the background. The function must not
+        depend on state that the training loop modifies.
+        """
+        with self._condition:
+            self._raise_error()
+            key = str(fpath)
+            if key in self._pending:
+                self._pending[key] = write_fn
+                return
+            while len(self._pending) + self._n_running >= self.max_pending:
+                self._condition.wait()
+                self._raise_error()
+            self._pending[key] = write_fn
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="checkpoint_writer",
+                                                daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    def wait(self):
+        """
+        Blocks until all pending writes are completed.
+        """
+        with self._condition:
+            while self._pending or self._n_running:
+                self._condition.wait()
+            self._raise_error()
+
+    @property
+    def n_pending(self):
+        return len(self._pending) + self._n_running
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise Exception("Failed to write a checkpoint: %s" % error) from error
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                _, write_fn = self._pending.popitem(last=False)
+                self._n_running += 1
+            try:
+                write_fn()
+            except Exception as e:
+                with self._condition:
+                    self._error = e
+            finally:
+                with self._condition:
+                    self._n_running -= 1
+                    self._condition.notify_all()
@@ -0,0 +1,128 @@
+"""
+Compressed storage of mel spectrograms. A spectrogram of shape (n_frames, n_channels) is saved
+as a .npy file in one of the following types, which loaders tell apart from the type of the
+array:
+    - float32: the spectrogram as it is computed (4 bytes per value)
+    - float16: the spectrogram in half precision (2 bytes per value). The relative error is
+    below 2^-11 and values beyond +-65504 are clipped.
+    - uint8: 8-bit linear quantization with a scale per frame (1 byte per value and 4 bytes per
+    frame). Each frame is stored as its minimum and quantization step in float16, followed by
+    its n_channels quantized values. The error is at most half a step, or (max - min) / 510 for
+    the frame: below max_abs_value / 255 for the spectrograms of the synthesizer, which are
+    bounded to [-max_abs_value, max_abs_value]. Only use it for such bounded spectrograms, not
+    for the power spectrograms of the encoder.
+
+Use save_mel() and load_mel() rather than np.save() and np.load() for the spectrograms, so
+that all types are read transparently as float32.
+"""
+
+from pathlib import Path
+from typing import Union
+import numpy as np
+
+
+storage_types = ("float32", "float16", "uint8")
+
+# Bytes of the header of the frames in uint8: the minimum and the step, in float16
+_header_size = 4
+_float16_max = float(np.finfo(np.float16).max)
+
+
+def storage_layout(n_channels: int, storage="float32"):
+    """
+    Returns the type and the shape of a frame of <n_channels> values once encoded in <storage>.
+    """
+    if storage == "float32":
+        return np.dtype(np.float32), (n_channels,)
+    if storage == "float16":
+        return np.dtype(np.float16), (n_channels,)
+    if storage == "uint8":
+        return np.dtype(np.uint8), (n_channels + _header_size,)
+    raise Exception("Unknown mel storage type \"%s\", use one of %s" % (storage, storage_types))
+
+
+def _round_up_float16(x: np.ndarray):
+    # The smallest float16 values greater than or equal to <x>
+    y = x.astype(np.float16)
+    below = y.astype(np.float32) < x
+    y[below] = np.nextafter(y[below], np.float16(np.inf))
+    return y
+
+
+def _quantize(mel: np.ndarray):
+    mel = np.asarray(mel, dtype=np.float32)
+    mel_min, mel_max = mel.min(axis=1), mel.max(axis=1)
+
+    # The minimum is rounded down and the step up, so that all values fit in [0, 255] steps
+    low = -_round_up_float16(-mel_min)
+    step = _round_up_float16((mel_max - low.astype(np.float32)) / 255)
+    step[step == 0] = 1
+    low_f32, step_f32 = low.astype(np.float32)[:, None], step.astype(np.float32)[:, None]
+    values = np.clip(np.rint((mel - low_f32) / step_f32), 0, 255).astype(np.uint8)
+
+    header = np.stack((low, step), axis=1).view(np.uint8)
+    return np.concatenate((header, values), axis=1)
+
+
+def _dequantize(data: np.ndarray):
+    header = np.ascontiguousarray(data[:, :_header_size]).view(np.float16).astype(np.float32)
+    return header[:, :1] + data[:, _header_size:].astype(np.float32) * header[:, 1:]
+
+
+def encode_mel(mel: np.ndarray, storage="float32"):
+    """
+    Encodes a mel spectrogram for storage.
+
+    :param mel: the mel spectrogram, of shape (n_frames, n_channels)
+    :param storage: the storage type, one of storage_types
+    :return: the array to save
+    """
+    storage_layout(mel.shape[1], storage)
+    if storage == "float16":
+        return np.clip(mel, -_float16_max, _float16_max).astype(np.float16)
+    if storage == "uint8":
+        return _quantize(mel)
+    return mel.astype(np.float32, copy=False)
+
+
+def decode_mel(data: np.ndarray):
+    """
+    Decodes a mel spectrogram encoded with encode_mel() of any storage type, or rows of it.
+
+    :return: the mel spectrogram in float32, of shape (n_frames, n_channels)
+    """
+    if data.dtype == np.float32:
+        return data
+    if data.dtype == np.float16:
+        return data.astype(np.float32)
+    if data.dtype == np.uint8:
+        return _dequantize(data)
+    raise Exception("Not a mel spectrogram in a known storage type: %s" % data.dtype)
+
+
+def save_mel(fpath: Union[str, Path], mel: np.ndarray, storage="float32"):
+    np.save(fpath, encode_mel(mel, storage), allow_pickle=False)
+
+
+def load_mel(fpath: Union[str, Path]):
+    return decode_mel(np.load(fpath))
+
+
+def storage_error(mel: np.ndarray, storage="float32"):
+    """
+    Measures the error of storing a mel spectrogram in <storage>.
+
+    :return: a dictionary with the ratio of the bytes stored to those of float32, the maximum
+    and mean absolute errors, and the signal to noise ratio in dB
+    """
+    mel = np.asarray(mel, dtype=np.float32)
+    encoded = encode_mel(mel, storage)
+    error = decode_mel(encoded).astype(np.float64) - mel
+    noise = np.sum(error ** 2)
+    signal = np.sum(mel.astype(np.float64) ** 2)
+    return {
+        "bytes_ratio": encoded.nbytes / max(mel.nbytes, 1),
+        "max_abs_error": float(np.max(np.abs(error))) if error.size else 0.,
+        "mean_abs_error": float(np.mean(np.abs(error))) if error.size else 0.,
+        "snr_db": float(10 * np.log10(signal / noise)) if noise > 0 else float("inf"),
+    }
@@ -0,0 +1,70 @@
+import threading
+
+
+class MemoryCache:
+    """
+    A thread-safe in-memory cache of numpy arrays, or of tuples of arrays, within a budget of
+    bytes. Entries are added until the budget is reached and are never evicted: training visits
+    the examples in a new random order at each epoch, so evicting the least recently used entries
+    would evict most of them before their next use. Keeping the first entries instead guarantees
+    that each example that fits is read from the disk only once.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Returns the entry of <key>, or None if it is not in the cache.
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Adds an entry if it fits in the budget. Its arrays are made read-only, as they are
+        shared by all the users of the entry.
+
+        :return: whether the entry was added
+        """
+        arrays = value if isinstance(value, tuple) else (value,)
+        nbytes = sum(array.nbytes for array in arrays)
+        with self._lock:
+            if key in self._entries or self.nbytes + nbytes > self.max_bytes:
+                return False
+            for array in arrays:
+                array.setflags(write=False)
+            self._entries[key] = value
+            self.nbytes += nbytes
+        return True
+
+    @property
+    def hit_rate(self):
+        n_requests = self.hits + self.misses
+        return self.hits / n_requests if n_requests else 0.
+
+    def summary(self, reset=False):
+        """
+        Describes the use of the cache and its hit rate since the last reset.
+
+        :param reset: whether to reset the hit rate
+        """
+        with self._lock:
+            summary = "%d entries, %.1f/%.1f MB, %.1f%% hits over %d requests" % (
+                len(self._entries), self.nbytes / 2 ** 20, self.max_bytes / 2 ** 20,
+                100 * self.hit_rate, self.hits + self.misses)
+            if reset:
+                self.hits = self.misses = 0
+        return summary
@@ -1,45 +1,227 @@
 from time import perf_counter as timer
+from contextlib import contextmanager
 from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Optional
 import numpy as np
+import json
+import os
 
 
 class Profiler:
-    def __init__(self, summarize_every=5, disabled=False):
-        self.last_tick = timer()
-        self.logs = OrderedDict()
+    """
+    Measures the time spent in the parts of a loop. Each call to tick(name) attributes the time
+    elapsed since the previous tick to <name>, and section(name) times a block of code that can
+    itself contain ticks and other sections. Summaries of the mean, standard deviation and
+    percentiles of each part are printed every <summarize_every> iterations.
+
+    Events are stored in preallocated ring buffers, so that the overhead of a tick is constant
+    and the memory is bounded. The last <buffer_size> events can be exported to JSON or to the
+    Chrome trace format (open chrome://tracing or https://ui.perfetto.dev and load the file).
+    """
+    def __init__(self, summarize_every=5, disabled=False, sync_fn: Optional[Callable]=None,
+                 buffer_size=100000):
+        """
+        :param summarize_every: the number of ticks of a part after which a summary is printed
+        :param disabled: if True, nothing is measured
+        :param sync_fn: a function called before each measure, to wait for asynchronous work to
+        complete. Pass e.g. lambda: torch.cuda.synchronize(device) to attribute the time of CUDA
+        operations to the right part.
+        :param buffer_size: the number of most recent events kept for the summaries and exports
+        """
         self.summarize_every = summarize_every
         self.disabled = disabled
-    
+        self.sync_fn = sync_fn
+        self.buffer_size = buffer_size
+        self.origin = timer()
+
+        # Ring buffers of the events: their start time, duration and name (as an index in
+        # <self.names>)
+        self._starts = np.zeros(buffer_size, dtype=np.float64)
+        self._durations = np.zeros(buffer_size, dtype=np.float64)
+        self._name_ids = np.zeros(buffer_size, dtype=np.int32)
+        self._n_events = 0
+        self._summary_start = 0
+        self.names = OrderedDict()
+        self._counts = []
+
+        self._sections = []
+        self.last_tick = timer()
+
+    def _now(self):
+        if self.sync_fn is not None:
+            self.sync_fn()
+        return timer()
+
+    def _name_id(self, name):
+        name = "/".join(self._sections + [name])
+        name_id = self.names.get(name)
+        if name_id is None:
+            name_id = len(self.names)
+            self.names[name] = name_id
+            self._counts.append(0)
+        return name_id
+
+    def _record(self, name_id, start, end):
+        if self._counts[name_id] >= self.summarize_every:
+            self.summarize()
+            self.purge_logs()
+        self._counts[name_id] += 1
+
+        i = self._n_events % self.buffer_size
+        self._starts[i] = start
+        self._durations[i] = end - start
+        self._name_ids[i] = name_id
+        self._n_events += 1
+
     def tick(self, name):
         if self.disabled:
             return
-        
+
         # Log the time needed to execute that function
-        if not name in self.logs:
-            self.logs[name] = []
-        if len(self.logs[name]) >= self.summarize_every:
-            self.summarize()
-            self.purge_logs()
-        self.logs[name].append(timer() - self.last_tick)
-        
-        self.reset_timer()
-        
+        now = self._now()
+        self._record(self._name_id(name), self.last_tick, now)
+        self.last_tick = timer()
+
+    @contextmanager
+    def section(self, name):
+        """
+        Times a block of code. The ticks inside the block are attributed to
+        "<section name>/<tick name>", and the time of the whole block to the section.
+        """
+        if self.disabled:
+            yield
+            return
+
+        name_id = self._name_id(name)
+        start = self._now()
+        self._sections.append(name)
+        self.last_tick = timer()
+        try:
+            yield
+        finally:
+            self._sections.pop()
+            self._record(name_id, start, self._now())
+            self.last_tick = timer()
+
     def purge_logs(self):
-        for name in self.logs:
-            self.logs[name].clear()
-    
+        self._summary_start = self._n_events
+        self._counts = [0] * len(self._counts)
+
     def reset_timer(self):
         self.last_tick = timer()
-    
+
+    def _events(self, start=0):
+        """
+        Returns the indices of the events recorded since event number <start> that are still in
+        the buffers, in chronological order.
+        """
+        start = max(start, self._n_events - self.buffer_size)
+        return np.arange(start, self._n_events) % self.buffer_size
+
+    def stats(self, since_summary=False):
+        """
+        Returns a dictionary mapping the name of each part to its number of events, and to the
+        mean, standard deviation and percentiles of its durations in milliseconds.
+
+        :param since_summary: if True, only the events since the last summary are considered.
+        Otherwise, all the events in the buffers are.
+        """
+        events = self._events(self._summary_start if since_summary else 0)
+        name_ids = self._name_ids[events]
+        durations = self._durations[events] * 1000
+        stats = OrderedDict()
+        for name, name_id in self.names.items():
+            deltas = durations[name_ids == name_id]
+            if len(deltas) == 0:
+                continue
+            p50, p95, p99 = np.percentile(deltas, [50, 95, 99])
+            stats[name] = {
+                "count": len(deltas),
+                "mean_ms": float(np.mean(deltas)),
+                "std_ms": float(np.std(deltas)),
+                "p50_ms": float(p50),
+                "p95_ms": float(p95),
+                "p99_ms": float(p99),
+                "total_ms": float(np.sum(deltas)),
+            }
+        return stats
+
     def summarize(self):
-        n = max(map(len, self.logs.values()))
-        assert n == self.summarize_every
+        n = self.summarize_every
+        stats = self.stats(since_summary=True)
+        if not stats:
+            return
         print("\nAverage execution time over %d steps:" % n)
 
-        name_msgs = ["%s (%d/%d):" % (name, len(deltas), n) for name, deltas in self.logs.items()]
+        # Parts are indented according to their depth in the sections
+        name_msgs = ["%s%s (%d/%d):" % ("  " * name.count("/"), name.split("/")[-1],
+                                        part["count"], n) for name, part in stats.items()]
         pad = max(map(len, name_msgs))
-        for name_msg, deltas in zip(name_msgs, self.logs.values()):
-            print("  %s  mean: %4.0fms   std: %4.0fms" % 
-                  (name_msg.ljust(pad), np.mean(deltas) * 1000, np.std(deltas) * 1000))
-        print("", flush=True)    
-        
\ No newline at end of file
+        for name_msg, part in zip(name_msgs, stats.values()):
+            print("  %s  mean: %4.0fms   std: %4.0fms   p50: %4.0fms   p95: %4.0fms   "
+                  "p99: %4.0fms" % (name_msg.ljust(pad), part["mean_ms"], part["std_ms"],
+                                    part["p50_ms"], part["p95_ms"], part["p99_ms"]))
+        print("", flush=True)
+
+    def export_json(self, fpath):
+        """
+        Writes the statistics of each part and the list of events in the buffers to a JSON
+        file. Event times are in milliseconds since the creation of the profiler.
+        """
+        events = self._events()
+        names = list(self.names)
+        data = {
+            "stats": self.stats(),
+            "events": [
+                {"name": names[name_id], "start_ms": (start - self.origin) * 1000,
+                 "duration_ms": duration * 1000}
+                for name_id, start, duration in zip(self._name_ids[events], self._starts[events],
+                                                    self._durations[events])
+            ],
+        }
+        self._write_json(fpath, data)
+
+    def export_chrome_trace(self, fpath):
+        """
+        Writes the events in the buffers to a file in the Chrome trace event format. Sections
+        are displayed with the parts they contain below them.
+        """
+        events = self._events()
+        names = list(self.names)
+        pid = os.getpid()
+        trace_events = []
+        for name_id, start, duration in zip(self._name_ids[events], self._starts[events],
+                                            self._durations[events]):
+            name = names[name_id]
+            trace_events.append({
+                "name": name.split("/")[-1],
+                "cat": name.split("/")[0],
+                "ph": "X",
+                "ts": (start - self.origin) * 1e6,
+                "dur": duration * 1e6,
+                "pid": pid,
+                "tid": 0,
+                "args": {"path": name},
+            })
+        self._write_json(fpath, {"traceEvents": trace_events, "displayTimeUnit": "ms"})
+
+    def export(self, fpath):
+        """
+        Exports the Chrome trace to <fpath> and the JSON statistics and events next to it, with
+        the "_stats.json" suffix. Does nothing if the profiler is disabled.
+        """
+        if self.disabled:
+            return
+        fpath = Path(fpath)
+        self.export_chrome_trace(fpath)
+        self.export_json(fpath.with_name(fpath.stem + "_stats.json"))
+
+    @staticmethod
+    def _write_json(fpath, data):
+        # Write to a temporary file first so that an interrupted export doesn't corrupt the file
+        fpath = Path(fpath)
+        tmp_fpath = fpath.with_name(fpath.name + ".tmp")
+        with tmp_fpath.open("w") as json_file:
+            json.dump(data, json_file)
+        tmp_fpath.replace(fpath)
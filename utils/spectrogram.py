@@ -0,0 +1,149 @@
+from functools import lru_cache
+from numpy.lib.stride_tricks import as_strided
+from scipy.signal import get_window
+from typing import List, Optional
+import numpy as np
+import librosa
+try:
+    # Unlike numpy's, scipy's FFT computes in single precision for float32 inputs
+    from scipy.fft import rfft
+except ImportError:
+    from numpy.fft import rfft
+
+
+class MelEngine:
+    """
+    Computes STFT magnitudes and mel spectrograms with precomputed windows and mel filterbanks.
+    The results match librosa.stft() with center=True and reflect padding, which all components
+    of the project use.
+
+    Several signals can be processed at once: their frames are gathered in a single matrix that
+    is transformed with one FFT call and one matrix product with the filterbank. Use
+    get_engine() rather than this constructor so that engines are shared between calls.
+    """
+    def __init__(self, sample_rate: int, n_fft: int, hop_length: int,
+                 win_length: Optional[int]=None, n_mels: int=80, fmin: float=0.,
+                 fmax: Optional[float]=None, power: float=1., max_batch_frames: int=8192):
+        """
+        :param sample_rate: the sampling rate of the signals
+        :param n_fft: the size of the FFT
+        :param hop_length: the number of samples between two frames
+        :param win_length: the size of the hann window, centered and zero-padded to <n_fft>.
+        Defaults to <n_fft>.
+        :param n_mels: the number of mel channels
+        :param fmin: the lowest frequency of the mel filterbank
+        :param fmax: the highest frequency of the mel filterbank. Defaults to half the sampling
+        rate.
+        :param power: the exponent applied to the STFT magnitudes before the mel projection,
+        1 for the amplitude and 2 for the power.
+        :param max_batch_frames: the maximum number of frames transformed at once. This bounds
+        the memory used when processing many or long signals.
+        """
+        win_length = n_fft if win_length is None else win_length
+        assert win_length <= n_fft
+        self.sample_rate = sample_rate
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.power = power
+        self.max_batch_frames = max_batch_frames
+
+        # Periodic hann window, zero-padded on both sides to the size of the FFT as librosa does
+        window = get_window("hann", win_length, fftbins=True)
+        left_pad = (n_fft - win_length) // 2
+        window = np.pad(window, (left_pad, n_fft - win_length - left_pad), "constant")
+        self.window = window.astype(np.float32)
+
+        self.mel_basis = librosa.filters.mel(sr=sample_rate, n_fft=n_fft, n_mels=n_mels,
+                                             fmin=fmin, fmax=fmax).astype(np.float32)
+        self.mel_basis.setflags(write=False)
+
+    def num_frames(self, length: int):
+        """
+        Returns the number of frames of the STFT of a signal of <length> samples.
+        """
+        return 1 + length // self.hop_length
+
+    def _frames(self, wav: np.ndarray, center: bool):
+        """
+        Returns a view of the frames of a signal, as an array of shape (n_frames, n_fft).
+        """
+        wav = np.asarray(wav, dtype=np.float32)
+        if center:
+            wav = np.pad(wav, self.n_fft // 2, mode="reflect")
+        n_frames = 1 + (len(wav) - self.n_fft) // self.hop_length
+        stride = wav.strides[0]
+        return as_strided(wav, (n_frames, self.n_fft), (self.hop_length * stride, stride),
+                          writeable=False)
+
+    def _batches(self, wavs: List[np.ndarray], power: float, center: bool):
+        """
+        Transforms the frames of the signals in batches of at most <max_batch_frames> frames
+        (unless a single signal is longer) and yields the magnitudes of each batch as an array of
+        shape (n_frames, 1 + n_fft // 2) along with the number of frames of each signal.
+        """
+        def transform(frames):
+            spec = rfft(np.concatenate(frames) * self.window, axis=1)
+            if power == 2:
+                magnitudes = spec.real ** 2 + spec.imag ** 2
+            else:
+                magnitudes = np.abs(spec)
+                if power != 1:
+                    magnitudes **= power
+            return magnitudes.astype(np.float32), [len(f) for f in frames]
+
+        batch, batch_frames = [], 0
+        for wav in wavs:
+            frames = self._frames(wav, center)
+            if batch and batch_frames + len(frames) > self.max_batch_frames:
+                yield transform(batch)
+                batch, batch_frames = [], 0
+            batch.append(frames)
+            batch_frames += len(frames)
+        if batch:
+            yield transform(batch)
+
+    def magnitudes(self, wavs: List[np.ndarray], power: float=1., center: bool=True):
+        """
+        Computes the STFT magnitudes of several signals.
+
+        :param wavs: a list of waveforms as numpy arrays of floats, of any lengths
+        :param power: the exponent applied to the magnitudes
+        :param center: if True, the signals are padded on both sides by reflection so that the
+        frames are centered on multiples of <hop_length>. If False, the first frame starts at the
+        first sample and the signals must be at least <n_fft> samples long.
+        :return: a list of numpy arrays of float32 of shape (1 + n_fft // 2, n_frames)
+        """
+        outputs = []
+        for magnitudes, lengths in self._batches(wavs, power, center):
+            outputs.extend(m.T for m in np.split(magnitudes, np.cumsum(lengths)[:-1]))
+        return outputs
+
+    def mels(self, wavs: List[np.ndarray], center: bool=True):
+        """
+        Computes the mel spectrograms of several signals.
+
+        :param wavs: a list of waveforms as numpy arrays of floats, of any lengths
+        :param center: see magnitudes()
+        :return: a list of numpy arrays of float32 of shape (n_mels, n_frames)
+        """
+        outputs = []
+        for magnitudes, lengths in self._batches(wavs, self.power, center):
+            mels = np.dot(magnitudes, self.mel_basis.T)
+            outputs.extend(m.T for m in np.split(mels, np.cumsum(lengths)[:-1]))
+        return outputs
+
+    def mel(self, wav: np.ndarray, center: bool=True):
+        """
+        Computes the mel spectrogram of a single signal, see mels().
+        """
+        return self.mels([wav], center)[0]
+
+
+@lru_cache(maxsize=16)
+def get_engine(sample_rate: int, n_fft: int, hop_length: int, win_length: Optional[int]=None,
+               n_mels: int=80, fmin: float=0., fmax: Optional[float]=None, power: float=1.):
+    """
+    Returns the MelEngine for these parameters, creating it on the first call only. See
+    MelEngine.__init__() for the parameters.
+    """
+    return MelEngine(sample_rate, n_fft, hop_length, win_length, n_mels, fmin, fmax, power)
@@ -3,6 +3,7 @@ import numpy as np
 import librosa
 import vocoder.hparams as hp
 from scipy.signal import lfilter
+from utils import spectrogram as _spectrogram
 
 
 def label_2_float(x, bits) :
@@ -38,18 +39,17 @@ def encode_16bits(x) :
     return np.clip(x * 2**15, -2**15, 2**15 - 1).astype(np.int16)
 
 
-mel_basis = None
+def mel_engine():
+    return _spectrogram.get_engine(hp.sample_rate, hp.n_fft, hp.hop_length, hp.win_length, 
+                                   hp.num_mels, hp.fmin)
 
 
 def linear_to_mel(spectrogram):
-    global mel_basis
-    if mel_basis is None:
-        mel_basis = build_mel_basis()
-    return np.dot(mel_basis, spectrogram)
+    return np.dot(build_mel_basis(), spectrogram)
 
 
 def build_mel_basis():
-    return librosa.filters.mel(hp.sample_rate, hp.n_fft, n_mels=hp.num_mels, fmin=hp.fmin)
+    return mel_engine().mel_basis
 
 
 def normalize(S):
@@ -69,14 +69,12 @@ def db_to_amp(x):
 
 
 def spectrogram(y):
-    D = stft(y)
-    S = amp_to_db(np.abs(D)) - hp.ref_level_db
+    S = amp_to_db(mel_engine().magnitudes([y])[0]) - hp.ref_level_db
     return normalize(S)
 
 
 def melspectrogram(y):
-    D = stft(y)
-    S = amp_to_db(linear_to_mel(np.abs(D)))
+    S = amp_to_db(mel_engine().mel(y))
     return normalize(S)
 
 
@@ -383,9 +383,9 @@ class WaveRNN(nn.Module):
     def get_step(self) :
         return self.step.data.item()
 
-    def checkpoint(self, model_dir, optimizer) :
+    def checkpoint(self, model_dir, optimizer, writer=None) :
         k_steps = self.get_step() // 1000
-        self.save(model_dir.joinpath("checkpoint_%dk_steps.pt" % k_steps), optimizer)
+        self.save(model_dir.joinpath("checkpoint_%dk_steps.pt" % k_steps), optimizer, writer)
 
     def log(self, path, msg) :
         with open(path, 'a') as f:
@@ -400,11 +400,19 @@ class WaveRNN(nn.Module):
             # Backwards compatibility
             self.load_state_dict(checkpoint)
 
-    def save(self, path, optimizer) :
-        torch.save({
+    def save(self, path, optimizer, writer=None) :
+        """
+        :param writer: an optional AsyncCheckpointWriter (see utils.checkpoint) that writes the 
+        checkpoint in the background
+        """
+        state = {
             "model_state": self.state_dict(),
             "optimizer_state": optimizer.state_dict(),
-        }, path)
+        }
+        if writer is None:
+            torch.save(state, path)
+        else:
+            writer.save(state, path, key=self.get_step())
 
     def num_params(self, print_out=True):
         parameters = filter(lambda p: p.requires_grad, self.parameters())
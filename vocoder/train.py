@@ -1,19 +1,25 @@
 from vocoder.models.fatchord_version import WaveRNN
-from vocoder.vocoder_dataset import VocoderDataset, collate_vocoder
+from vocoder.vocoder_dataset import VocoderDataset, PackedVocoderDataset, LabelStore, \
+    VocoderWindows, collate_windows
 from vocoder.distribution import discretized_mix_logistic_loss
 from vocoder.display import stream, simple_table
 from vocoder.gen_wavernn import gen_testset
+from synthesizer.packed_dataset import PackedDataset
+from utils.checkpoint import AsyncCheckpointWriter
+from utils.profiler import Profiler
 from torch.utils.data import DataLoader
 from pathlib import Path
 from torch import optim
 import torch.nn.functional as F
 import vocoder.hparams as hp
 import numpy as np
+import torch
 import time
 
 
 def train(run_id: str, syn_dir: Path, voc_dir: Path, models_dir: Path, ground_truth: bool,
-          save_every: int, backup_every: int, force_restart: bool):
+          save_every: int, backup_every: int, force_restart: bool, profile_every: int=0, 
+          profile_fpath: Path=None):
     # Check to make sure the hop length is correctly factorised
     assert np.cumprod(hp.voc_upsample_factors)[-1] == hp.hop_length
     
@@ -57,7 +63,21 @@ def train(run_id: str, syn_dir: Path, voc_dir: Path, models_dir: Path, ground_tr
         voc_dir.joinpath("synthesized.txt")
     mel_dir = syn_dir.joinpath("mels") if ground_truth else voc_dir.joinpath("mels_gta")
     wav_dir = syn_dir.joinpath("audio")
-    dataset = VocoderDataset(metadata_fpath, mel_dir, wav_dir)
+    pack_dir = syn_dir.joinpath("packed") if ground_truth else voc_dir.joinpath("packed_gta")
+    if PackedDataset.exists(pack_dir):
+        dataset = PackedVocoderDataset(pack_dir)
+    else:
+        dataset = VocoderDataset(metadata_fpath, mel_dir, wav_dir)
+    
+    # The training windows read their labels from a store computed once for the dataset, and 
+    # their frames only from the spectrograms
+    labels_dir = voc_dir.joinpath("labels")
+    sources = dataset.source_digest()
+    if not LabelStore.is_valid(labels_dir, dataset.wav_fnames, dataset.n_frames, sources):
+        print("Computing the labels of the vocoder in %s" % labels_dir)
+        LabelStore.create(labels_dir, dataset.wav_fnames, dataset.n_frames, dataset.load_wav, 
+                          sources)
+    windows = VocoderWindows(dataset, LabelStore(labels_dir))
     test_loader = DataLoader(dataset,
                              batch_size=1,
                              shuffle=True,
@@ -68,18 +88,30 @@ def train(run_id: str, syn_dir: Path, voc_dir: Path, models_dir: Path, ground_tr
                   ('LR', hp.voc_lr),
                   ('Sequence Len', hp.voc_seq_len)])
     
+    # The model runs on the GPU, whose operations are asynchronous: the profiler waits for them 
+    # to complete before each measure
+    profiler = Profiler(summarize_every=profile_every, disabled=profile_every == 0, 
+                        sync_fn=torch.cuda.synchronize)
+    
+    # Checkpoints are written in the background: the training only waits for the copy of the 
+    # weights and of the optimizer state to the CPU memory
+    checkpoint_writer = AsyncCheckpointWriter()
+    
     for epoch in range(1, 350):
-        data_loader = DataLoader(dataset,
-                                 collate_fn=collate_vocoder,
+        data_loader = DataLoader(windows,
+                                 collate_fn=collate_windows,
                                  batch_size=hp.voc_batch_size,
                                  num_workers=2,
                                  shuffle=True,
                                  pin_memory=True)
         start = time.time()
         running_loss = 0.
+        profiler.reset_timer()
 
         for i, (x, y, m) in enumerate(data_loader, 1):
+            profiler.tick("Blocking, waiting for batch")
             x, m, y = x.cuda(), m.cuda(), y.cuda()
+            profiler.tick("Data to cuda")
             
             # Forward pass
             y_hat = model(x, m)
@@ -88,12 +120,16 @@ def train(run_id: str, syn_dir: Path, voc_dir: Path, models_dir: Path, ground_tr
             elif model.mode == 'MOL':
                 y = y.float()
             y = y.unsqueeze(-1)
+            profiler.tick("Forward pass")
             
             # Backward pass
             loss = loss_func(y_hat, y)
+            profiler.tick("Loss")
             optimizer.zero_grad()
             loss.backward()
+            profiler.tick("Backward pass")
             optimizer.step()
+            profiler.tick("Parameter update")
 
             running_loss += loss.item()
             speed = i / (time.time() - start)
@@ -103,17 +139,23 @@ def train(run_id: str, syn_dir: Path, voc_dir: Path, models_dir: Path, ground_tr
             k = step // 1000
 
             if backup_every != 0 and step % backup_every == 0 :
-                model.checkpoint(model_dir, optimizer)
+                model.checkpoint(model_dir, optimizer, checkpoint_writer)
                 
             if save_every != 0 and step % save_every == 0 :
-                model.save(weights_fpath, optimizer)
+                model.save(weights_fpath, optimizer, checkpoint_writer)
+                if profile_fpath is not None:
+                    profiler.export(profile_fpath)
 
             msg = f"| Epoch: {epoch} ({i}/{len(data_loader)}) | " \
                 f"Loss: {avg_loss:.4f} | {speed:.1f} " \
                 f"steps/s | Step: {k}k | "
             stream(msg)
+            profiler.tick("Extras (logging, saving)")
 
 
-        gen_testset(model, test_loader, hp.voc_gen_at_checkpoint, hp.voc_gen_batched,
-                    hp.voc_target, hp.voc_overlap, model_dir)
+        with profiler.section("Test set generation"):
+            gen_testset(model, test_loader, hp.voc_gen_at_checkpoint, hp.voc_gen_batched,
+                        hp.voc_target, hp.voc_overlap, model_dir)
         print("")
+    
+    checkpoint_writer.wait()
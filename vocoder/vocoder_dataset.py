@@ -1,9 +1,17 @@
 from torch.utils.data import Dataset
+from synthesizer.packed_dataset import PackedDataset
+from utils.audio_storage import load_audio
+from utils.mel_storage import decode_mel, load_mel
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
 from vocoder import audio
+from tqdm import tqdm
 import vocoder.hparams as hp
 import numpy as np
+import hashlib
 import torch
+import json
+import uuid
 
 
 class VocoderDataset(Dataset):
@@ -18,55 +26,307 @@ class VocoderDataset(Dataset):
         wav_fnames = [x[0] for x in metadata if int(x[4])]
         wav_fpaths = [wav_dir.joinpath(fname) for fname in wav_fnames]
         self.samples_fpaths = list(zip(gta_fpaths, wav_fpaths))
+        self.wav_fnames = wav_fnames
+        self.n_frames = [int(x[4]) for x in metadata if int(x[4])]
         
         print("Found %d samples" % len(self.samples_fpaths))
     
     def __getitem__(self, index):  
         mel_path, wav_path = self.samples_fpaths[index]
+        return process_sample(load_mel(mel_path), load_audio(wav_path))
+
+    def __len__(self):
+        return len(self.samples_fpaths)
+    
+    def read_mel(self, index, start, end):
+        """
+        Reads frames [start, end) of the mel spectrogram of a sample, prepared as in 
+        process_sample(). Only these frames are read from the disk.
+        """
+        mel = np.load(self.samples_fpaths[index][0], mmap_mode="r")
+        return prepare_mel(decode_mel(np.array(mel[start:end])))
+    
+    def load_wav(self, index):
+        return load_audio(self.samples_fpaths[index][1])
+    
+    def source_digest(self):
+        """
+        Identifies the content of the waveforms of the samples, from the size and the 
+        modification time of their files.
+        """
+        digest = hashlib.md5()
+        for _, wav_fpath in self.samples_fpaths:
+            stat = wav_fpath.stat()
+            digest.update(("%s|%d|%d\n" % (wav_fpath.name, stat.st_size, 
+                                            stat.st_mtime_ns)).encode("utf-8"))
+        return digest.hexdigest()
+        
+        
+class PackedVocoderDataset(Dataset):
+    """
+    Same as VocoderDataset, with the samples read from a packed dataset (see 
+    synthesizer.packed_dataset): the synthesizer dataset to train on ground truth spectrograms, or 
+    the ground truth aligned spectrograms packed by vocoder_preprocess.py.
+    """
+    def __init__(self, pack_dir: Path):
+        print("Using inputs from:\n\t%s" % pack_dir)
+        self.dataset = PackedDataset(pack_dir)
+        self.indices = np.flatnonzero(self.dataset.index["mels_length"])
+        self.wav_fnames = [fname.decode("utf-8") for fname in 
+                           self.dataset.index["wav_fname"][self.indices]]
+        self.n_frames = self.dataset.index["mels_length"][self.indices]
+        print("Found %d samples" % len(self.indices))
+    
+    def __getitem__(self, index):
+        index = self.indices[index]
+        return process_sample(self.dataset.mel(index), self.dataset.audio(index))
+    
+    def __len__(self):
+        return len(self.indices)
+    
+    def read_mel(self, index, start, end):
+        return prepare_mel(decode_mel(self.dataset.read("mels", self.indices[index], start, end)))
+    
+    def load_wav(self, index):
+        return self.dataset.audio(self.indices[index])
+    
+    def source_digest(self):
+        """
+        Identifies the content of the waveforms of the samples, from the version of the packed 
+        dataset that holds them.
+        """
+        dataset = self.dataset
+        while not dataset.fpath("audio").exists():
+            dataset = dataset.source
+        return "packed.%s" % dataset.version
+
+
+class LabelStore:
+    """
+    The training targets of the vocoder, computed once for all from the waveforms of a dataset: 
+    the waveforms after pre-emphasis, clipping, padding and quantization, as done by 
+    process_sample(). They are concatenated in a single memory-mapped array 
+    <store_dir>/labels.<version>.npy, so that a training window only reads its own labels from 
+    the disk. <store_dir>/info.<version>.json holds the parameters the labels were computed with 
+    and an identifier of the content of the waveforms. <store_dir>/index.npz holds the version, 
+    unique to each computation of the labels, and the name of the audio file, the offset and the 
+    length of each waveform.
+    """
+    index_fname = "index.npz"
+    
+    def __init__(self, store_dir: Path):
+        self.store_dir = store_dir
+        with np.load(store_dir.joinpath(self.index_fname)) as index_file:
+            self.version = str(index_file["version"])
+            index = index_file["rows"]
+        self.index = {row["wav_fname"].decode("utf-8"): (int(row["offset"]), int(row["length"]))
+                      for row in index}
+        self._data = None
+    
+    def __getstate__(self):
+        # The memory map is opened again by each process rather than copied
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+    
+    def fpath(self, name, extension=".npy"):
+        return self.store_dir.joinpath(name + "." + self.version + extension)
+    
+    @staticmethod
+    def params():
+        """
+        The parameters of the labels, which must match those of the store.
+        """
+        return {"voc_mode": hp.voc_mode, "bits": hp.bits, "mu_law": hp.mu_law, 
+                "apply_preemphasis": hp.apply_preemphasis, "preemphasis": hp.preemphasis, 
+                "hop_length": hp.hop_length}
+    
+    @classmethod
+    def is_valid(cls, store_dir: Path, wav_fnames, n_frames, sources):
+        """
+        Returns whether the store in <store_dir> exists, was computed with the current 
+        parameters from the same waveforms and holds the labels of all the samples given, with 
+        the right lengths.
+        
+        :param sources: the identifier of the content of the waveforms, as given by the 
+        source_digest() of the dataset
+        """
+        if not store_dir.joinpath(cls.index_fname).exists():
+            return False
+        store = cls(store_dir)
+        with store.fpath("info", ".json").open("r") as info_file:
+            if json.load(info_file) != {"params": cls.params(), "sources": sources}:
+                return False
+        index = store.index
+        return all(index.get(fname, (0, -1))[1] == length * hp.hop_length 
+                   for fname, length in zip(wav_fnames, n_frames))
+    
+    @classmethod
+    def create(cls, store_dir: Path, wav_fnames, n_frames, load_wav, sources, n_threads=8):
+        """
+        Computes the labels of a dataset and writes them to <store_dir>, replacing the previous 
+        store. The labels are written under the names of a new version, which the index switches 
+        to once they are complete: an interrupted computation leaves the previous store in use. 
+        The files of the previous versions are deleted afterwards.
         
-        # Load the mel spectrogram and adjust its range to [-1, 1]
-        mel = np.load(mel_path).T.astype(np.float32) / hp.mel_max_abs_value
+        :param wav_fnames: the names of the audio files of the samples
+        :param n_frames: the number of frames of the mel spectrograms of the samples
+        :param load_wav: a function returning the waveform of a sample given its index
+        :param sources: the identifier of the content of the waveforms, see is_valid()
+        :param n_threads: the number of threads computing the labels
+        """
+        lengths = np.asarray(n_frames, dtype=np.int64) * hp.hop_length
+        offsets = np.cumsum(lengths) - lengths
+        store_dir.mkdir(parents=True, exist_ok=True)
+        version = uuid.uuid4().hex[:8]
+        data = np.lib.format.open_memmap(store_dir.joinpath("labels.%s.npy" % version), 
+                                         mode="w+", dtype=np.uint16, 
+                                         shape=(int(np.sum(lengths)),))
         
-        # Load the wav
-        wav = np.load(wav_path)
-        if hp.apply_preemphasis:
-            wav = audio.pre_emphasis(wav)
-        wav = np.clip(wav, -1, 1)
+        compute = lambda i: wav_to_labels(load_wav(i), n_frames[i])
+        with ThreadPool(n_threads) as pool:
+            job = pool.imap(compute, range(len(wav_fnames)), chunksize=16)
+            for i, labels in enumerate(tqdm(job, "Computing the labels", len(wav_fnames), 
+                                            unit="utterances")):
+                data[offsets[i]:offsets[i] + lengths[i]] = labels
+        data.flush()
+        del data
         
-        # Fix for missing padding   # TODO: settle on whether this is any useful
-        r_pad =  (len(wav) // hp.hop_length + 1) * hp.hop_length - len(wav)
-        wav = np.pad(wav, (0, r_pad), mode='constant')
-        assert len(wav) >= mel.shape[1] * hp.hop_length
-        wav = wav[:mel.shape[1] * hp.hop_length]
-        assert len(wav) % hp.hop_length == 0
+        fname_size = max([len(fname.encode("utf-8")) for fname in wav_fnames] + [1])
+        index = np.zeros(len(wav_fnames), dtype=[("wav_fname", "S%d" % fname_size), 
+                                                 ("offset", np.int64), ("length", np.int64)])
+        index["wav_fname"] = [fname.encode("utf-8") for fname in wav_fnames]
+        index["offset"] = offsets
+        index["length"] = lengths
         
-        # Quantize the wav
-        if hp.voc_mode == 'RAW':
-            if hp.mu_law:
-                quant = audio.encode_mu_law(wav, mu=2 ** hp.bits)
-            else:
-                quant = audio.float_2_label(wav, bits=hp.bits)
-        elif hp.voc_mode == 'MOL':
-            quant = audio.float_2_label(wav, bits=16)
-            
-        return mel.astype(np.float32), quant.astype(np.int64)
+        with store_dir.joinpath("info.%s.json" % version).open("w") as info_file:
+            json.dump({"params": cls.params(), "sources": sources}, info_file)
+        
+        # Switch to the new version by replacing the index, then delete the files of the previous 
+        # versions and of the interrupted computations
+        tmp_index_fpath = store_dir.joinpath("index.tmp.npz")
+        np.savez(tmp_index_fpath, version=np.array(version), rows=index)
+        tmp_index_fpath.replace(store_dir.joinpath(cls.index_fname))
+        for fpath in store_dir.iterdir():
+            name = fpath.name.split(".")
+            if name[0] in ("labels", "info") and name[1] != version:
+                try:
+                    fpath.unlink()
+                except OSError:
+                    # Still open in another process on Windows, deleted at the next computation
+                    pass
+        return cls(store_dir)
+    
+    def read(self, wav_fname, start, end):
+        """
+        Reads labels [start, end) of the waveform of a sample.
+        """
+        if self._data is None:
+            self._data = np.load(self.fpath("labels"), mmap_mode="r")
+        offset, length = self.index[wav_fname]
+        assert 0 <= start <= end <= length
+        return np.array(self._data[offset + start:offset + end])
+
 
+class VocoderWindows(Dataset):
+    """
+    The random training windows of the samples of a VocoderDataset or a PackedVocoderDataset. 
+    Each item is the mel spectrogram of a window of voc_seq_len samples with its padding, and 
+    the labels of the window. Only these are read from the disk, the labels from a LabelStore 
+    instead of being computed from the whole waveform. Batch the items with collate_windows().
+    """
+    def __init__(self, dataset, labels: LabelStore):
+        self.dataset = dataset
+        self.labels = labels
+    
+    def __getitem__(self, index):
+        mel_offset, sig_offset = _random_window(self.dataset.n_frames[index])
+        mel = self.dataset.read_mel(index, mel_offset, mel_offset + _mel_window())
+        labels = self.labels.read(self.dataset.wav_fnames[index], sig_offset, 
+                                  sig_offset + hp.voc_seq_len + 1)
+        return mel, labels
+    
     def __len__(self):
-        return len(self.samples_fpaths)
-        
+        return len(self.dataset)
+
+
+def prepare_mel(mel):
+    """
+    Prepares a mel spectrogram of shape (n_frames, num_mels), as saved by the synthesizer, for 
+    the vocoder.
+    """
+    # Adjust the range of the mel spectrogram to [-1, 1]
+    return mel.T.astype(np.float32) / hp.mel_max_abs_value
+
+
+def wav_to_labels(wav, n_frames):
+    """
+    Computes the training labels of a waveform whose mel spectrogram has <n_frames> frames.
+    """
+    # Process the wav
+    if hp.apply_preemphasis:
+        wav = audio.pre_emphasis(wav)
+    wav = np.clip(wav, -1, 1)
+    
+    # Fix for missing padding   # TODO: settle on whether this is any useful
+    r_pad =  (len(wav) // hp.hop_length + 1) * hp.hop_length - len(wav)
+    wav = np.pad(wav, (0, r_pad), mode='constant')
+    assert len(wav) >= n_frames * hp.hop_length
+    wav = wav[:n_frames * hp.hop_length]
+    assert len(wav) % hp.hop_length == 0
+    
+    # Quantize the wav
+    if hp.voc_mode == 'RAW':
+        if hp.mu_law:
+            quant = audio.encode_mu_law(wav, mu=2 ** hp.bits)
+        else:
+            quant = audio.float_2_label(wav, bits=hp.bits)
+    elif hp.voc_mode == 'MOL':
+        quant = audio.float_2_label(wav, bits=16)
         
-def collate_vocoder(batch):
-    mel_win = hp.voc_seq_len // hp.hop_length + 2 * hp.voc_pad
-    max_offsets = [x[0].shape[-1] -2 - (mel_win + 2 * hp.voc_pad) for x in batch]
-    mel_offsets = [np.random.randint(0, offset) for offset in max_offsets]
-    sig_offsets = [(offset + hp.voc_pad) * hp.hop_length for offset in mel_offsets]
+    return quant
+
+
+def process_sample(mel, wav):
+    """
+    Prepares a sample for training from a mel spectrogram of shape (n_frames, num_mels), as 
+    saved by the synthesizer, and its waveform.
+    """
+    mel = prepare_mel(mel)
+    quant = wav_to_labels(wav, mel.shape[1])
+    return mel, quant.astype(np.int64)
+
 
-    mels = [x[0][:, mel_offsets[i]:mel_offsets[i] + mel_win] for i, x in enumerate(batch)]
+def _mel_window():
+    return hp.voc_seq_len // hp.hop_length + 2 * hp.voc_pad
+
+
+def _random_window(n_frames):
+    # The offsets of a random training window in the mel spectrogram and in the waveform
+    mel_offset = np.random.randint(0, n_frames - 2 - (_mel_window() + 2 * hp.voc_pad))
+    sig_offset = (mel_offset + hp.voc_pad) * hp.hop_length
+    return mel_offset, sig_offset
+
+
+def collate_vocoder(batch):
+    """
+    Batches random windows of the complete samples of a VocoderDataset.
+    """
+    mel_win = _mel_window()
+    windows = []
+    for mel, labels in batch:
+        mel_offset, sig_offset = _random_window(mel.shape[-1])
+        windows.append((mel[:, mel_offset:mel_offset + mel_win], 
+                        labels[sig_offset:sig_offset + hp.voc_seq_len + 1]))
+    return collate_windows(windows)
 
-    labels = [x[1][sig_offsets[i]:sig_offsets[i] + hp.voc_seq_len + 1] for i, x in enumerate(batch)]
 
-    mels = np.stack(mels).astype(np.float32)
-    labels = np.stack(labels).astype(np.int64)
+def collate_windows(batch):
+    """
+    Batches the windows of VocoderWindows.
+    """
+    mels = np.stack([x[0] for x in batch]).astype(np.float32)
+    labels = np.stack([x[1] for x in batch]).astype(np.int64)
 
     mels = torch.tensor(mels)
     labels = torch.tensor(labels).long()
@@ -37,6 +37,12 @@ if __name__ == "__main__":
         "model.")
     parser.add_argument("-f", "--force_restart", action="store_true", help= \
         "Do not load any saved model and restart from scratch.")
+    parser.add_argument("--profile_every", type=int, default=0, help= \
+        "Number of steps between summaries of the time spent in each part of the training loop. "
+        "Set to 0 to disable the profiling.")
+    parser.add_argument("--profile_fpath", type=Path, default=None, help= \
+        "Path to a .json file to which the timings of the training loop are exported in the "
+        "Chrome trace format every time the model is saved. Requires --profile_every.")
     args = parser.parse_args()
 
     # Process the arguments